@@ -5,11 +5,12 @@ from time import time
 from decimal import Decimal
 
 from fastapi import FastAPI, Query
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
 import uvicorn
 
 from saveToDb import mysql_query
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -31,16 +32,15 @@ def _decimal_to_float(obj):
 
 
 def init_api_state(*, order_books, wallets, market_info, routes, exchanges,
-                   order_book_lock, wallets_lock, comparisons_lock,
+                   wallets_lock, comparisons_lock,
                    latest_comparisons, dry_run, bot_start_time, currencies,
-                   selected_currencies=None, markets=None):
+                   selected_currencies=None, markets=None, metadata_cache=None):
     _state.update({
         "order_books": order_books,
         "wallets": wallets,
         "market_info": market_info,
         "routes": routes,
         "exchanges": exchanges,
-        "order_book_lock": order_book_lock,
         "wallets_lock": wallets_lock,
         "comparisons_lock": comparisons_lock,
         "latest_comparisons": latest_comparisons,
@@ -49,6 +49,7 @@ def init_api_state(*, order_books, wallets, market_info, routes, exchanges,
         "currencies": currencies,
         "selected_currencies": selected_currencies or list(currencies.keys()),
         "markets": markets or {},
+        "metadata_cache": metadata_cache,
     })
 
 
@@ -81,14 +82,13 @@ def get_status():
     cross = sum(1 for r in routes if r["type"] == "cross")
 
     exchange_health = {}
-    with _state["order_book_lock"]:
-        for ex_name in _state["exchanges"]:
-            books = _state["order_books"].get(ex_name, {})
-            has_data = any(
-                b.get("lastUpdate") is not None and (time() - b["lastUpdate"]) < 30
-                for b in books.values()
-            )
-            exchange_health[ex_name] = "connected" if has_data else "disconnected"
+    for ex_name in _state["exchanges"]:
+        books = _state["order_books"].get(ex_name, {})
+        has_data = any(
+            b["lastUpdate"] is not None and (time() - b["lastUpdate"]) < 30
+            for b in list(books.values())
+        )
+        exchange_health[ex_name] = "connected" if has_data else "disconnected"
 
     return {
         "mode": "dry-run" if _state.get("dry_run") else "live",
@@ -98,6 +98,12 @@ def get_status():
     }
 
 
+@app.get("/api/metrics", response_class=PlainTextResponse)
+def get_metrics():
+    """Pipeline latency histograms in the Prometheus text format."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/api/live")
 def get_live():
     with _state["comparisons_lock"]:
@@ -121,15 +127,16 @@ def get_wallets():
 @app.get("/api/orderbooks")
 def get_orderbooks():
     result = {}
-    with _state["order_book_lock"]:
-        for ex_name, markets in _state["order_books"].items():
-            result[ex_name] = {}
-            for market, book in markets.items():
-                result[ex_name][market] = {
-                    "buy": [[float(p), float(q)] for p, q in (book["buy"] or [])[:5]],
-                    "sell": [[float(p), float(q)] for p, q in (book["sell"] or [])[:5]],
-                    "lastUpdate": book["lastUpdate"],
-                }
+    for ex_name, markets in _state["order_books"].items():
+        result[ex_name] = {}
+        # Each book is an immutable snapshot, safe to read while feeds publish new ones
+        for market, book in list(markets.items()):
+            result[ex_name][market] = {
+                "buy": [[float(p), float(q)] for p, q in (book["buy"] or [])[:5]],
+                "sell": [[float(p), float(q)] for p, q in (book["sell"] or [])[:5]],
+                "lastUpdate": book["lastUpdate"],
+                "version": book["version"],
+            }
     return result
 
 
@@ -190,51 +197,56 @@ def get_opportunities(
     return {"items": items, "total": total, "page": page, "per_page": per_page}
 
 
+# The analytics read the hourly and daily rollups (see saveToDb.OPPORTUNITY_ROLLUPS), never
+# the opportunities table, so their cost does not grow with its size
+
 @app.get("/api/analytics/top-pairs")
 def analytics_top_pairs(days: int = Query(7, ge=1, le=365)):
     rows = mysql_query(
-        "SELECT route_label, COUNT(*) as cnt FROM opportunities "
-        "WHERE ts >= DATE_SUB(NOW(), INTERVAL %s DAY) "
+        "SELECT route_label, SUM(opportunities) as cnt FROM opportunity_rollup_daily "
+        "WHERE bucket >= DATE(DATE_SUB(NOW(), INTERVAL %s DAY)) "
         "GROUP BY route_label ORDER BY cnt DESC LIMIT 20",
         (days,),
     )
-    return [{"route_label": r[0], "count": r[1]} for r in (rows or [])]
+    return [{"route_label": r[0], "count": int(r[1])} for r in (rows or [])]
 
 
 @app.get("/api/analytics/direction")
 def analytics_direction(days: int = Query(7, ge=1, le=365)):
     rows = mysql_query(
-        "SELECT CONCAT(buy_exchange, ' → ', sell_exchange) as direction, COUNT(*) as cnt "
-        "FROM opportunities WHERE ts >= DATE_SUB(NOW(), INTERVAL %s DAY) "
+        "SELECT CONCAT(buy_exchange, ' → ', sell_exchange) as direction, SUM(opportunities) as cnt "
+        "FROM opportunity_rollup_daily WHERE bucket >= DATE(DATE_SUB(NOW(), INTERVAL %s DAY)) "
         "GROUP BY direction ORDER BY cnt DESC",
         (days,),
     )
-    return [{"direction": r[0], "count": r[1]} for r in (rows or [])]
+    return [{"direction": r[0], "count": int(r[1])} for r in (rows or [])]
 
 
 @app.get("/api/analytics/frequency")
 def analytics_frequency(days: int = Query(7, ge=1, le=365)):
     rows = mysql_query(
-        "SELECT DATE_FORMAT(ts, '%%Y-%%m-%%d %%H:00:00') as hour, COUNT(*) as cnt "
-        "FROM opportunities WHERE ts >= DATE_SUB(NOW(), INTERVAL %s DAY) "
+        "SELECT DATE_FORMAT(bucket, '%%Y-%%m-%%d %%H:00:00') as hour, SUM(opportunities) as cnt "
+        "FROM opportunity_rollup_hourly "
+        "WHERE bucket >= DATE_FORMAT(DATE_SUB(NOW(), INTERVAL %s DAY), '%%Y-%%m-%%d %%H:00:00') "
         "GROUP BY hour ORDER BY hour",
         (days,),
     )
-    return [{"hour": r[0], "count": r[1]} for r in (rows or [])]
+    return [{"hour": r[0], "count": int(r[1])} for r in (rows or [])]
 
 
 @app.get("/api/analytics/returns")
 def analytics_returns():
+    # Executed trades per hour bucket: the span is measured between the first and last bucket
     row = mysql_query(
-        "SELECT AVG(spread_pct), COUNT(*), "
-        "MIN(ts), MAX(ts) FROM opportunities WHERE executed = TRUE"
+        "SELECT SUM(executed_spread_sum) / SUM(executed), SUM(executed), "
+        "MIN(bucket), MAX(bucket) FROM opportunity_rollup_hourly WHERE executed > 0"
     )
     if not row or not row[0][0]:
         return {"avg_spread_pct": 0, "total_trades": 0,
                 "daily": 0, "weekly": 0, "monthly": 0, "yearly": 0}
 
     avg_spread = float(row[0][0])
-    total = row[0][1]
+    total = int(row[0][1])
     min_ts = row[0][2]
     max_ts = row[0][3]
 
@@ -317,6 +329,7 @@ def get_config():
             "BINANCE_API_SECRET": mask("BINANCE_API_SECRET"),
             "KRAKEN_API_KEY": mask("KRAKEN_API_KEY"),
             "KRAKEN_API_SECRET": mask("KRAKEN_API_SECRET"),
+            "KRAKEN_API_KEYS": mask("KRAKEN_API_KEYS"),
         },
     }
 
@@ -365,9 +378,15 @@ def discover_currencies():
     from bnnc import BINANCE
     from krkn import KRAKEN
 
+    # Same endpoints and cache as the bot, so a page load does not download both again
+    cache = _state.get("metadata_cache")
     try:
-        binance_pairs = BINANCE.discover_pairs()
-        kraken_pairs = KRAKEN.discover_pairs()
+        binance_pairs = BINANCE.discover_pairs(
+            os.environ.get("BINANCE_API_BASE_URL", "https://api.binance.com"), cache=cache,
+        )
+        kraken_pairs = KRAKEN.discover_pairs(
+            os.environ.get("KRAKEN_API_BASE_URL", "https://api.kraken.com"), cache=cache,
+        )
     except Exception as e:
         return JSONResponse(
             {"error": f"Failed to query exchanges: {e}"},
@@ -1,18 +1,31 @@
 import os
 import sys
+import queue
+import asyncio
 import argparse
 import threading
 import logging
-from time import time, sleep
+import concurrent.futures
+from time import time, sleep, perf_counter, monotonic
 from decimal import Decimal, ROUND_DOWN, ROUND_UP, ROUND_HALF_UP
 
+import aiohttp
 from dotenv import load_dotenv
 
 from bnnc import BINANCE
-from krkn import KRAKEN
+from krkn import KRAKEN, KRAKEN_WS, ORDER_UNKNOWN
 from binanceOrderBook import BINANCE_ORDER_BOOK
 from krakenOrderBook import KRAKEN_ORDER_BOOK
-from saveToDb import save_wallets, save_order, save_order_data, save_opportunity
+from orderBook import top_price, empty_book, clock
+from routeMatrix import ROUTE_MATRIX
+from marketRecorder import MARKET_RECORDER
+from metrics import COMPARE_WAIT, COMPARE, DECISION, ORDER_ACK, ORDER_QUERY, FILL_CONFIRM
+from httpSession import KEEP_WARM
+from metadataCache import METADATA_CACHE
+from userStreams import FILL_TRACKER, WALLET_TRACKER, WALLET_RECONCILER, BINANCE_USER_STREAM, KRAKEN_USER_STREAM
+from reservations import RESERVATION_LEDGER
+from opportunityEpisodes import EPISODE_TRACKER
+from saveToDb import save_wallets, save_trade_record, save_opportunity, save_episode, db_writer, OPPORTUNITY_ROLLUPS
 from api_server import init_api_state, start_api_server
 
 load_dotenv()
@@ -31,7 +44,8 @@ def _parse_args():
         default=os.environ.get("ARBY_DRY_RUN", "false").lower() in ("true", "1", "yes"),
         help="Log opportunities without executing trades (also settable via ARBY_DRY_RUN env var)",
     )
-    return parser.parse_args()
+    # Tolerate extra arguments when imported by tools such as replay.py
+    return parser.parse_known_args()[0]
 
 _args = _parse_args()
 DRY_RUN = _args.dry_run
@@ -40,6 +54,11 @@ DRY_RUN = _args.dry_run
 # Role codes:
 # 0 - Only base, 1 - Both base and trade, 2 - Trade only (with configurable available_bases)
 _DEFAULT_CURRENCIES = ["ETH", "BTC", "XLM", "XRP", "ADA"]
+# Exchange metadata (exchangeInfo, AssetPairs) is kept in this directory and refreshed in the
+# background once older than ARBY_METADATA_TTL seconds (0 downloads it on every use)
+METADATA_CACHE_DIR = os.environ.get("ARBY_METADATA_CACHE_DIR", ".cache")
+METADATA_TTL = float(os.environ.get("ARBY_METADATA_TTL", "3600"))
+metadata_cache = METADATA_CACHE(METADATA_CACHE_DIR, ttl=METADATA_TTL) if METADATA_TTL > 0 else None
 
 
 def _load_currencies():
@@ -50,10 +69,25 @@ def _load_currencies():
     return list(_DEFAULT_CURRENCIES)
 
 
+def _load_pairs():
+    """Parse ARBY_PAIRS ("XLM/BTC,ETH/BTC") into {(trade, base)}; empty means discover them."""
+    raw = os.environ.get("ARBY_PAIRS", "")
+    pairs = set()
+    for entry in raw.split(","):
+        trade, _, base = entry.strip().upper().partition("/")
+        if trade and base:
+            pairs.add((trade, base))
+    return pairs
+
+
 def _discover_common_pairs():
     """Query both exchanges and return intersection of available pairs."""
-    binance_pairs = BINANCE.discover_pairs()
-    kraken_pairs = KRAKEN.discover_pairs()
+    binance_pairs = BINANCE.discover_pairs(
+        os.environ.get("BINANCE_API_BASE_URL", "https://api.binance.com"), cache=metadata_cache,
+    )
+    kraken_pairs = KRAKEN.discover_pairs(
+        os.environ.get("KRAKEN_API_BASE_URL", "https://api.kraken.com"), cache=metadata_cache,
+    )
     return binance_pairs & kraken_pairs
 
 
@@ -88,7 +122,7 @@ def auto_assign_roles(selected, common_pairs):
 selected_currencies = _load_currencies()
 _common_pairs = set()
 try:
-    _common_pairs = _discover_common_pairs()
+    _common_pairs = _load_pairs() or _discover_common_pairs()
     currencies = auto_assign_roles(selected_currencies, _common_pairs)
     logger.info("Auto-assigned currency roles: %s", currencies)
 except Exception as e:
@@ -100,6 +134,74 @@ MIN_PROFIT = Decimal(os.environ.get("ARBY_MIN_PROFIT", "0.001"))
 MIN_VOLUME_DIFF = Decimal("2")
 MIN_VOLUME_MARGIN = Decimal("2")
 MAX_TIME_SINCE_UPDATE = Decimal("5")
+MAX_BOOK_AGE = float(MAX_TIME_SINCE_UPDATE)
+# Full sweep of every route at least this often, even without book updates
+COMPARE_SWEEP_INTERVAL = 1.0
+# An opportunity episode closes after this many seconds without its route above threshold
+EPISODE_GAP = float(os.environ.get("ARBY_EPISODE_GAP", "2.0"))
+# Rows written to opportunities: each episode's first tick and executed ticks, plus every
+# Nth tick of an episode (1 writes every tick, 0 none besides those)
+OPPORTUNITY_SAMPLE_EVERY = int(os.environ.get("ARBY_OPPORTUNITY_SAMPLE_EVERY", "0"))
+# Kraken book subscription depth (10, 25, 100, 500 or 1000)
+KRAKEN_BOOK_DEPTH = int(os.environ.get("ARBY_KRAKEN_BOOK_DEPTH", "10"))
+# Kraken levels published per side to the engine (capped at the book depth)
+KRAKEN_PUBLISH_DEPTH = int(os.environ.get("ARBY_KRAKEN_PUBLISH_DEPTH", "10"))
+# Binance book feed: "partial" (20-level snapshots) or "diff" (local book from the diff stream)
+BINANCE_BOOK_MODE = os.environ.get("ARBY_BINANCE_BOOK_MODE", "partial").lower()
+BINANCE_BOOK_DEPTH = int(os.environ.get("ARBY_BINANCE_BOOK_DEPTH", "20"))
+# Book price/qty storage: "decimal" ([Decimal, Decimal] levels) or "ticks" (scaled integers,
+# screened as floats; Decimal is only materialized for routes above threshold)
+BOOK_REPR = os.environ.get("ARBY_BOOK_REPR", "decimal").lower()
+TICK_BOOKS = BOOK_REPR == "ticks"
+# Screening values are compared against their own type: Decimal/float comparisons are slow
+NO_ARB = 0.0 if TICK_BOOKS else Decimal("0")
+ARB_COUNTER_LEVELS = [Decimal("0.004"), Decimal("0.005"), Decimal("0.0075"), Decimal("0.01")]
+if TICK_BOOKS:
+    ARB_COUNTER_LEVELS = [float(level) for level in ARB_COUNTER_LEVELS]
+# Raw market-data recording (see marketRecorder.py / replay.py); empty disables it
+RECORD_DIR = os.environ.get("ARBY_RECORD_DIR", "")
+RECORD_ROTATE_BYTES = int(os.environ.get("ARBY_RECORD_ROTATE_MB", "256")) * 1024 * 1024
+# Route evaluation: "python" (per route, per exchange pair) or "numpy" (all routes at once
+# on a top-of-book matrix; only routes above threshold take the per-route path)
+COMPARE_ENGINE = os.environ.get("ARBY_COMPARE_ENGINE", "python").lower()
+# Order execution: "threads" (one TRADE thread per leg, blocking REST) or "asyncio" (legs run
+# concurrently as coroutines on one loop over pooled aiohttp sessions)
+ORDER_EXECUTOR = os.environ.get("ARBY_ORDER_EXECUTOR", "threads").lower()
+# Connections kept per exchange by the asyncio executor
+ORDER_POOL_SIZE = int(os.environ.get("ARBY_ORDER_POOL_SIZE", "8"))
+# Keep-alive REST sessions: connections per exchange, retries on connection errors (and on
+# read errors/5xx for GET/DELETE only), and the idle time after which a ping keeps them open
+HTTP_POOL_SIZE = int(os.environ.get("ARBY_HTTP_POOL_SIZE", "4"))
+HTTP_RETRIES = int(os.environ.get("ARBY_HTTP_RETRIES", "2"))
+HTTP_KEEP_WARM = float(os.environ.get("ARBY_HTTP_KEEP_WARM", "30"))
+# Kraken order entry: "rest" (AddOrder/CancelOrder, one private call per API key at a time) or
+# "ws" (add_order/cancel_order on the authenticated v2 WebSocket; queries stay on REST)
+KRAKEN_ORDER_TRANSPORT = os.environ.get("ARBY_KRAKEN_ORDER_TRANSPORT", "rest").lower()
+# Kraken verification tier (starter, intermediate, pro): sizes the rate limiter's counters
+KRAKEN_TIER = os.environ.get("ARBY_KRAKEN_TIER", "starter").lower()
+# Fills pushed by the exchanges' user data streams end an order's wait without a cancel or
+# query; while an exchange's stream is down its orders are cancelled and queried over REST
+USER_STREAMS = os.environ.get("ARBY_USER_STREAMS", "true").lower() in ("true", "1", "yes")
+# With user streams, wallets follow pushed balances and fills; REST balances are fetched every
+# this many seconds only to report drift and correct it (0 disables)
+BALANCE_RECONCILE_INTERVAL = float(os.environ.get("ARBY_BALANCE_RECONCILE", "300"))
+# Seconds an order rests before the unfilled part is cancelled and repriced
+ORDER_REST_TIME = 1.0
+# Seconds to wait for a streamed cancel before falling back to getOrderData
+CANCEL_CONFIRM_WAIT = 2.0
+# Seconds a leg stopped at its trade's timeout gets to settle its last order before it is abandoned
+TRADE_STOP_TIMEOUT = 60.0
+# Order time in force: "GTC" orders rest ORDER_REST_TIME and the rest is cancelled; "IOC" and
+# "FOK" orders are closed by the exchange on arrival (Kraken has no FOK and uses IOC)
+TIME_IN_FORCE = os.environ.get("ARBY_TIME_IN_FORCE", "GTC").upper()
+TIMES_IN_FORCE = ("GTC", "IOC", "FOK")
+if TIME_IN_FORCE not in TIMES_IN_FORCE:
+    raise ValueError("ARBY_TIME_IN_FORCE must be one of %s, not %r" % (TIMES_IN_FORCE, TIME_IN_FORCE))
+# With IOC/FOK, orders per leg (each repriced 0.1% further) before what is unfilled is dropped
+IMMEDIATE_ATTEMPTS = 10
+# Trades executed at once; MAIN_LOOP keeps scanning while they run. Routes sharing a market
+# wait for each other, and wallet funds reserved by a running trade are not sized into another
+TRADE_WORKERS = int(os.environ.get("ARBY_TRADE_WORKERS", "4"))
 
 
 def _load_currency_bases():
@@ -200,12 +302,31 @@ def build_routes():
                     })
     return routes
 
+
+def route_markets(route):
+    """Return the markets whose order books a route reads."""
+    if route["type"] == "direct":
+        return (route["market"],)
+    if route["type"] == "multi_leg":
+        return (route["buy_market"], route["sell_market"], route["cross_pair"])
+    return (route["market_x"], route["market_y"])
+
+
+def build_route_index(routes):
+    """Map each market to the routes that have a leg on it, preserving route order."""
+    index = {}
+    for route in routes:
+        for market in route_markets(route):
+            index.setdefault(market, []).append(route)
+    return index
+
 routes = build_routes()
+routes_by_market = build_route_index(routes)
 
 
 def reload_routes():
     """Hot-reload routes by re-reading currency_bases from env and rebuilding routes."""
-    global currency_bases, routes
+    global currency_bases, routes, routes_by_market
     from dotenv import dotenv_values
     env_file = os.path.join(os.path.dirname(__file__), ".env")
     new_val = dotenv_values(env_file).get("ARBY_CURRENCY_BASES", "")
@@ -215,6 +336,7 @@ def reload_routes():
     with routes_lock:
         currency_bases = new_currency_bases
         routes = build_routes()
+        routes_by_market = build_route_index(routes)
     logger.info("Routes reloaded: %d routes, currency_bases=%s", len(routes), currency_bases)
     return len(routes)
 
@@ -224,10 +346,21 @@ binance_api_details = {
     "API_KEY": os.environ.get("BINANCE_API_KEY", ""),
     "API_SECRET": os.environ.get("BINANCE_API_SECRET", ""),
     "API_BASE_URL": os.environ.get("BINANCE_API_BASE_URL", "https://api.binance.com"),
+    # Stream base URL; empty uses python-binance's default (set for exchangeSim.py)
+    "WS_URL": os.environ.get("BINANCE_WS_URL", ""),
+    # WebSocket API URL (user data stream); empty uses python-binance's default
+    "WS_API_URL": os.environ.get("BINANCE_WS_API_URL", ""),
 }
 kraken_api_details = {
     "API_KEY": os.environ.get("KRAKEN_API_KEY", ""),
     "API_SECRET": os.environ.get("KRAKEN_API_SECRET", ""),
+    # More keys of the same account ("key:secret,key:secret"); private calls go to the least loaded key
+    "API_KEYS": [
+        tuple(p.strip().split(":", 1)) for p in os.environ.get("KRAKEN_API_KEYS", "").split(",") if ":" in p
+    ],
+    "API_BASE_URL": os.environ.get("KRAKEN_API_BASE_URL", "https://api.kraken.com"),
+    "WS_URL": os.environ.get("KRAKEN_WS_URL", "wss://ws.kraken.com/v2"),
+    "WS_AUTH_URL": os.environ.get("KRAKEN_WS_AUTH_URL", "wss://ws-auth.kraken.com/v2"),
 }
 
 # --- Validate required env vars ---
@@ -239,24 +372,64 @@ def _validate_env():
         logger.warning("The bot will start but trading will fail without valid API keys.")
 
 # --- Thread locks ---
-order_book_lock = threading.Lock()
+# Order books need no lock: feeds publish immutable snapshots (see orderBook.publish_book)
 wallets_lock = threading.Lock()
 data_lock = threading.Lock()
 comparisons_lock = threading.Lock()
 routes_lock = threading.Lock()
 
+
+
+class BOOK_UPDATES:
+    """Collects the (exchange, market) books touched by the feeds and wakes MAIN2."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._changed = set()
+
+    def notify(self, exchange, market):
+        with self._cond:
+            self._changed.add((exchange, market))
+            self._cond.notify()
+
+    def wait(self, timeout=None):
+        """Block until a book changes or timeout expires; return and reset the changed set."""
+        with self._cond:
+            if not self._changed:
+                self._cond.wait(timeout)
+            changed, self._changed = self._changed, set()
+        return changed
+
+
+book_updates = BOOK_UPDATES()
+# Order states pushed by the user data streams, started in __main__
+fill_tracker = FILL_TRACKER()
+# ASYNC_EXECUTOR when ARBY_ORDER_EXECUTOR=asyncio, started in __main__; None uses the TRADE threads
+order_executor = None
+# Wallet funds and markets held by trades in flight
+reservations = RESERVATION_LEDGER()
+# Looked up at close time, so replay can swap save_episode out
+episodes = EPISODE_TRACKER(EPISODE_GAP, lambda episode: save_episode(episode, DRY_RUN))
+# Every tick goes into the analytics rollups, whether it is sampled into opportunities or not
+rollups = OPPORTUNITY_ROLLUPS()
+
 # --- Live comparison state (for API) ---
 latest_comparisons = {}
 bot_start_time = None
 
 # --- Exchanges ---
 exchanges = {
-    "binance": BINANCE(binance_api_details, currencies),
-    "kraken": KRAKEN(kraken_api_details, currencies),
+    "binance": BINANCE(
+        binance_api_details, currencies, pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES, cache=metadata_cache,
+    ),
+    "kraken": (KRAKEN_WS if KRAKEN_ORDER_TRANSPORT == "ws" else KRAKEN)(
+        kraken_api_details, currencies, pool_size=HTTP_POOL_SIZE, retries=HTTP_RETRIES, tier=KRAKEN_TIER,
+        cache=metadata_cache,
+    ),
 }
 order_books = {
     exchange: {
-        market: {"sell": None, "buy": None, "lastUpdate": None}
+        market: empty_book()
         for market in markets
     }
     for exchange in exchanges
@@ -264,6 +437,8 @@ order_books = {
 
 wallets = {}
 market_info = {}
+# Applies streamed balances and fills to wallets
+wallet_tracker = WALLET_TRACKER(wallets, wallets_lock, markets)
 
 
 def init_wallets():
@@ -276,6 +451,22 @@ def init_wallets():
         wallets[name] = funds
 
 
+ZERO = Decimal("0")
+NO_BALANCE = {}
+
+
+def available(exchange, currency):
+    """Wallet balance not reserved by a trade in flight; callers hold wallets_lock.
+
+    Sizes every route on every pass: no Decimal is built unless something is reserved.
+    """
+    balance = wallets[exchange].get(currency, NO_BALANCE).get("available", ZERO)
+    reserved = reservations.amounts.get((exchange, currency))
+    if reserved is None:
+        return balance
+    return balance - reserved if balance > reserved else ZERO
+
+
 def init_market_info():
     global market_info
     for name, obj in exchanges.items():
@@ -286,6 +477,25 @@ def init_market_info():
         market_info[name] = info
 
 
+def book_precisions(exchange):
+    """Return {market: (ratePrecision, volumePrecision)} for an exchange's books."""
+    return {m: (mi["ratePrecision"], mi["volumePrecision"]) for m, mi in market_info[exchange].items()}
+
+
+def recording_meta():
+    """Everything replay.py needs to rebuild this session's routes and engine inputs."""
+    return {
+        "currencies": selected_currencies,
+        "pairs": sorted("%s/%s" % (m["trade"], m["base"]) for m in markets.values()),
+        "currency_bases": os.environ.get("ARBY_CURRENCY_BASES", ""),
+        "binance_book_mode": BINANCE_BOOK_MODE,
+        "binance_book_depth": BINANCE_BOOK_DEPTH,
+        "kraken_book_depth": KRAKEN_BOOK_DEPTH,
+        "market_info": market_info,
+        "wallets": wallets,
+    }
+
+
 # --- Rounding helpers using Decimal.quantize ---
 def rnd_down(x, n):
     """Round down to n decimal places."""
@@ -311,6 +521,117 @@ def rnd(x, n):
     return Decimal(str(x)).quantize(quant, rounding=ROUND_HALF_UP)
 
 
+def reprice_leg(side, rate, order_value, order_data, mi):
+    """Rate, volume and remaining order value for the next attempt at a partly filled leg."""
+    filled = Decimal(str(order_data["quantity"])) - Decimal(str(order_data["quantityRemaining"]))
+    order_value -= Decimal(str(rate)) * filled
+    change = max(rate * Decimal("0.001"), Decimal(10) ** -mi["ratePrecision"])
+    rate += (-1 if side == "SELL" else 1) * change
+    if side == "BUY":
+        volume = rnd_down(order_value / rate, mi["volumePrecision"])
+    else:
+        volume = rnd_down(Decimal(str(order_data["quantityRemaining"])), mi["volumePrecision"])
+    return rate, volume, order_value
+
+
+def may_place(attempts):
+    """Whether a leg may place another order after `attempts` orders; only IOC/FOK legs are capped."""
+    return TIME_IN_FORCE == "GTC" or attempts < IMMEDIATE_ATTEMPTS
+
+
+def follow_up_volume(td, follow_up, mi):
+    """Volume of a follow-up order, from what the first leg of td actually filled."""
+    fills = [od for od in td["orderData"] if not od.get("follow_up")]
+    if follow_up["side"] == "BUY" and td["side"] == "SELL":
+        # First leg SELL produced base currency proceeds; divide by follow-up rate
+        # to get trade currency volume to buy
+        proceeds = sum(Decimal(str(od["rate"])) * Decimal(str(od["volume"])) for od in fills)
+        return rnd_down(proceeds / follow_up["rate"], mi["volumePrecision"])
+    if follow_up["side"] == "BUY" and td["side"] == "BUY":
+        # First leg BUY spent base currency (proceeds = base spent);
+        # follow-up buys back the same base amount as trade currency volume
+        proceeds = sum(Decimal(str(od["rate"])) * Decimal(str(od["volume"])) for od in fills)
+        return rnd_down(proceeds, mi["volumePrecision"])
+    # SELL: volume is the trade currency received from first leg
+    total_vol = sum(Decimal(str(od["volume"])) for od in fills)
+    return rnd_down(total_vol, mi["volumePrecision"])
+
+
+def fund_follow_up(td):
+    """Size td's BUY follow-up up front from the base the wallet already holds.
+
+    A cross leg SELLs, then BUYs with the proceeds. Funded from the wallet,
+    the BUY goes out together with td instead of after it, capped at what
+    the wallet covers without the sale's proceeds; follow_up_correction()
+    squares it with what td actually sold once both are done. Callers hold
+    wallets_lock.
+    """
+    follow_up = td.get("follow_up")
+    if not follow_up or td["side"] != "SELL" or follow_up["side"] != "BUY":
+        return
+    mi = market_info[td["exchange"]][follow_up["market"]]
+    base = markets[follow_up["market"]]["base"]
+    affordable = available(td["exchange"], base) / (follow_up["rate"] * (1 + mi["tradeFees"]))
+    volume = rnd_down(min(td["rate"] * td["volume"] / follow_up["rate"], affordable), mi["volumePrecision"])
+    min_order = mi.get("minOrderValue" + base) or Decimal("0.0001")
+    if volume * follow_up["rate"] > min_order:
+        follow_up["volume"] = volume
+
+
+def follow_up_correction(td, follow_up, mi):
+    """The order that squares a funded follow-up with td's actual sale, or None.
+
+    The funded BUY was sized before the SELL filled: it falls short of the
+    proceeds when the wallet capped it and overbuys when the SELL came back
+    short. The shortfall is bought with the proceeds at the follow-up rate,
+    the excess sold back at the best bid.
+    """
+    target = follow_up_volume(td, follow_up, mi)
+    bought = sum(Decimal(str(od["volume"])) for od in td["orderData"] if od.get("follow_up"))
+    volume = rnd_down(abs(target - bought), mi["volumePrecision"])
+    if volume <= 0:
+        return None
+    if bought < target:
+        return {"side": "BUY", "market": follow_up["market"], "rate": follow_up["rate"], "volume": volume}
+    bids = order_books[td["exchange"]][follow_up["market"]]["buy"]
+    rate = Decimal(str(bids[0][0])) if bids else follow_up["rate"]
+    logger.warning(
+        "%s %s: follow-up bought %.8f %s more than the sale covers, selling it back at %.8f",
+        td["exchange"], follow_up["market"], volume, markets[follow_up["market"]]["trade"], rate,
+    )
+    return {"side": "SELL", "market": follow_up["market"], "rate": rate, "volume": volume}
+
+
+def trade_reservation(legs):
+    """Wallet amounts {(exchange, currency): amount} and (exchange, market) books the legs use."""
+    amounts = {}
+    trade_markets = set()
+    for td in legs:
+        exchange, market = td["exchange"], markets[td["market"]]
+        trade_markets.add((exchange, td["market"]))
+        if td["side"] == "SELL":
+            key, amount = (exchange, market["trade"]), td["volume"]
+        else:
+            fee = market_info[exchange][td["market"]]["tradeFees"]
+            key, amount = (exchange, market["base"]), td["rate"] * td["volume"] * (1 + fee)
+        amounts[key] = amounts.get(key, Decimal("0")) + amount
+        follow_up = td.get("follow_up")
+        if not follow_up:
+            continue
+        trade_markets.add((exchange, follow_up["market"]))
+        # After a SELL the follow-up spends the sale's proceeds, unless fund_follow_up() sized
+        # it from the wallet; after a BUY it buys the spent base back with wallet funds
+        if "volume" in follow_up:
+            fee = market_info[exchange][follow_up["market"]]["tradeFees"]
+            key = (exchange, markets[follow_up["market"]]["base"])
+            amounts[key] = amounts.get(key, Decimal("0")) + follow_up["rate"] * follow_up["volume"] * (1 + fee)
+        elif td["side"] == "BUY" and follow_up["side"] == "BUY":
+            key = (exchange, markets[follow_up["market"]]["base"])
+            amount = td["rate"] * td["volume"] * follow_up["rate"]
+            amounts[key] = amounts.get(key, Decimal("0")) + amount
+    return amounts, trade_markets
+
+
 def compute_threshold(target_profit, fees):
     """Compute minimum arbitrage threshold from target profit and per-leg fees.
 
@@ -322,16 +643,51 @@ def compute_threshold(target_profit, fees):
     return result - Decimal("1")
 
 
+def route_label(route):
+    """Human-readable route name used for logs, the live view and the DB."""
+    if route["type"] == "direct":
+        return route["market"]
+    if route["type"] == "multi_leg":
+        return "%s>%s" % (route["buy_market"], route["sell_market"])
+    return "%s×%s/%s" % (route["trade_x"], route["trade_y"], route["base"])
+
+
+def route_threshold(route, A, B):
+    """Minimum arbitrage for a route with exchange A on the sell side and B on the buy side."""
+    def fee(exchange, market):
+        return market_info.get(exchange, {}).get(market, {}).get("tradeFees", Decimal("0.001"))
+
+    if route["type"] == "direct":
+        fees = [fee(A, route["market"]), fee(B, route["market"])]
+    elif route["type"] == "multi_leg":
+        # Cross leg fee: use best available from either exchange
+        fee_cross = Decimal("0.001")
+        for ex in exchanges:
+            mi_cp = market_info.get(ex, {}).get(route["cross_pair"])
+            if mi_cp:
+                fee_cross = mi_cp["tradeFees"]
+                break
+        fees = [fee(A, route["buy_market"]), fee(B, route["sell_market"]), fee_cross]
+    else:
+        fees = [
+            fee(A, route["market_x"]), fee(A, route["market_y"]),
+            fee(B, route["market_y"]), fee(B, route["market_x"]),
+        ]
+    return compute_threshold(MIN_PROFIT, fees)
+
+
 class TRADE(threading.Thread):
     MAX_RETRIES = 5
 
-    def __init__(self, threadId, name, tradeNum, tradeData, e):
+    def __init__(self, threadId, name, tradeNum, tradeData, e, stopping):
         threading.Thread.__init__(self)
         self.threadId = threadId
         self.name = name
         self.tradeNum = tradeNum
         self.tradeData = tradeData
         self.e = e
+        # Set by the TRADE_WORKER past the trade's timeout: settle the order out, place no more
+        self.stopping = stopping
         self.order_value = Decimal("0")
         self.daemon = True
 
@@ -340,23 +696,65 @@ class TRADE(threading.Thread):
             self.trade()
 
     def update_rate_and_volume(self, td, order_data):
-        self.order_value -= Decimal(str(td["rate"])) * (Decimal(str(order_data["quantity"])) - Decimal(str(order_data["quantityRemaining"])))
         mi = market_info[td["exchange"]][td["market"]]
-        change = max(td["rate"] * Decimal("0.001"), Decimal(10) ** -mi["ratePrecision"])
-        td["rate"] += (-1 if td["side"] == "SELL" else 1) * change
-
-        if td["side"] == "BUY":
-            td["volume"] = rnd_down(self.order_value / td["rate"], mi["volumePrecision"])
-        else:
-            td["volume"] = rnd_down(Decimal(str(order_data["quantityRemaining"])), mi["volumePrecision"])
+        td["rate"], td["volume"], self.order_value = reprice_leg(
+            td["side"], td["rate"], self.order_value, order_data, mi,
+        )
         return td
 
+    def query_order(self, exchange_name, exchange, order_id, market, sent):
+        """getOrderData, timed; sent is the perf_counter() reading when the order went out."""
+        started = perf_counter()
+        order_data = exchange.getOrderData(order_id, markets[market]["trade"], markets[market]["base"])
+        done = perf_counter()
+        ORDER_QUERY.observe(done - started, exchange_name)
+        if order_data:
+            FILL_CONFIRM.observe(done - sent, exchange_name)
+        return order_data
+
+    def settle_order(self, exchange_name, exchange, order_id, market, sent):
+        """Let the order rest, cancel what is left of it, and return its final order data.
+
+        While the exchange's user stream is live, a pushed fill ends the wait
+        at once and needs neither the cancel nor the query. IOC/FOK orders
+        never rest, and one whose order response was final needs no call.
+        """
+        order_data = exchange.placedOrderData(order_id)
+        if order_data:
+            FILL_CONFIRM.observe(perf_counter() - sent, exchange_name)
+            return order_data
+        streaming = fill_tracker.live(exchange_name)
+        if TIME_IN_FORCE == "GTC":
+            if streaming:
+                order_data = fill_tracker.wait(exchange_name, order_id, ORDER_REST_TIME)
+                if order_data:
+                    FILL_CONFIRM.observe(perf_counter() - sent, exchange_name)
+                    return order_data
+            else:
+                sleep(ORDER_REST_TIME)
+            exchange.closeOrder(order_id, markets[market]["trade"], markets[market]["base"])
+        if streaming:
+            order_data = fill_tracker.wait(exchange_name, order_id, CANCEL_CONFIRM_WAIT)
+            if order_data:
+                FILL_CONFIRM.observe(perf_counter() - sent, exchange_name)
+                return order_data
+        return self.query_order(exchange_name, exchange, order_id, market, sent)
+
     def trade(self):
+        # This leg's own (start, done) events: the other leg never clears them
+        start, done = self.e
         # Wait for signal to trade, with timeout to prevent infinite hang
-        signalled = self.e[0].wait(timeout=30)
+        signalled = start.wait(timeout=30)
         if not signalled:
             return
+        start.clear()
+        try:
+            self._trade()
+        finally:
+            # The worker waits for this before it releases the trade's reservation and data
+            done.set()
 
+    def _trade(self):
         with data_lock:
             td = self.tradeData[self.tradeNum - 1]
             if not td:
@@ -365,25 +763,43 @@ class TRADE(threading.Thread):
         self.order_value = td["rate"] * td["volume"]
         exchange = exchanges[td["exchange"]]
         retries = 0
+        attempts = 0
 
-        while td["volume"] * td["rate"] > td["minOrderValue"] and retries < self.MAX_RETRIES:
+        follow_up = td.get("follow_up")
+        funded = None
+        if follow_up and "volume" in follow_up:
+            # Funded from the wallet: the follow-up goes out with this leg, not after it
+            funded = threading.Thread(
+                target=self._execute_follow_up, args=(td, follow_up, exchange),
+                name=self.name + "_FOLLOW_UP", daemon=True,
+            )
+            funded.start()
+
+        while (td["volume"] * td["rate"] > td["minOrderValue"] and retries < self.MAX_RETRIES and may_place(attempts)
+               and not self.stopping.is_set()):
             mi = market_info[td["exchange"]][td["market"]]
             logger.info(
                 "%s %s %s %.8f %.8f %s",
                 td["exchange"], markets[td["market"]]["trade"],
                 markets[td["market"]]["base"], td["rate"], td["volume"], td["side"],
             )
+            sent = perf_counter()
             order_id = exchange.order(
                 markets[td["market"]]["trade"],
                 markets[td["market"]]["base"],
                 rnd(td["rate"], mi["ratePrecision"]),
                 rnd(td["volume"], mi["volumePrecision"]),
                 td["side"],
+                TIME_IN_FORCE,
             )
+            ORDER_ACK.observe(perf_counter() - sent, td["exchange"])
+            if order_id == ORDER_UNKNOWN:
+                # It may have been placed: another order could double the position
+                logger.error("%s %s: order outcome unknown, leg stopped", td["exchange"], td["market"])
+                break
             if order_id:
-                sleep(1)
-                exchange.closeOrder(order_id, markets[td["market"]]["trade"], markets[td["market"]]["base"])
-                order_data = exchange.getOrderData(order_id, markets[td["market"]]["trade"], markets[td["market"]]["base"])
+                attempts += 1
+                order_data = self.settle_order(td["exchange"], exchange, order_id, td["market"], sent)
                 if order_data:
                     td["orderData"].append({
                         "id": order_id,
@@ -399,76 +815,69 @@ class TRADE(threading.Thread):
                 backoff = min(2 ** retries, 30)
                 logger.warning("Order failed, retry %d/%d in %ds", retries, self.MAX_RETRIES, backoff)
                 sleep(backoff)
+        if td["volume"] * td["rate"] > td["minOrderValue"] and not may_place(attempts):
+            logger.warning(
+                "%s %s: %.8f left unfilled after %d %s orders",
+                td["exchange"], td["market"], td["volume"], attempts, TIME_IN_FORCE,
+            )
 
         # Execute follow-up order if present (multi-leg 3rd leg, cross routes)
-        follow_up = td.get("follow_up")
-        if follow_up:
+        if funded:
+            funded.join()
+            mi = market_info[td["exchange"]][follow_up["market"]]
+            correction = follow_up_correction(td, follow_up, mi)
+            if correction:
+                self._execute_follow_up(td, correction, exchange)
+        elif follow_up:
             self._execute_follow_up(td, follow_up, exchange)
 
-        self.e[self.tradeNum].set()
-        self.e[0].clear()
-
     def _execute_follow_up(self, td, follow_up, exchange):
-        """Execute a sequential follow-up order after the main order completes."""
-        # Compute proceeds from first leg
-        proceeds = Decimal("0")
-        for od in td["orderData"]:
-            proceeds += Decimal(str(od["rate"])) * Decimal(str(od["volume"]))
-
+        """Execute a follow-up order: after the main order completes, alongside it if funded up front, or a correction."""
         fu_market = follow_up["market"]
         fu_side = follow_up["side"]
         fu_rate = follow_up["rate"]
         mi = market_info[td["exchange"]][fu_market]
-
-        if fu_side == "BUY" and td["side"] == "SELL":
-            # First leg SELL produced base currency proceeds; divide by follow-up rate
-            # to get trade currency volume to buy
-            fu_volume = rnd_down(proceeds / fu_rate, mi["volumePrecision"])
-        elif fu_side == "BUY" and td["side"] == "BUY":
-            # First leg BUY spent base currency (proceeds = base spent);
-            # follow-up buys back the same base amount as trade currency volume
-            fu_volume = rnd_down(proceeds, mi["volumePrecision"])
-        else:
-            # SELL: volume is the trade currency received from first leg
-            total_vol = sum(Decimal(str(od["volume"])) for od in td["orderData"])
-            fu_volume = rnd_down(total_vol, mi["volumePrecision"])
+        fu_volume = follow_up["volume"] if "volume" in follow_up else follow_up_volume(td, follow_up, mi)
 
         fu_order_value = fu_rate * fu_volume
-        fu_min_order = mi.get("minOrderValueBTC", Decimal("0.0001"))
+        # Min order value in the follow-up market's base (None where the exchange has none)
+        fu_min_order = mi.get("minOrderValue" + markets[fu_market]["base"]) or Decimal("0.0001")
         retries = 0
+        attempts = 0
 
-        while fu_volume * fu_rate > fu_min_order and retries < self.MAX_RETRIES:
+        while (fu_volume * fu_rate > fu_min_order and retries < self.MAX_RETRIES and may_place(attempts)
+               and not self.stopping.is_set()):
             logger.info(
                 "FOLLOW-UP %s %s %s %.8f %.8f %s",
                 td["exchange"], markets[fu_market]["trade"],
                 markets[fu_market]["base"], fu_rate, fu_volume, fu_side,
             )
+            sent = perf_counter()
             order_id = exchange.order(
                 markets[fu_market]["trade"],
                 markets[fu_market]["base"],
                 rnd(fu_rate, mi["ratePrecision"]),
                 rnd(fu_volume, mi["volumePrecision"]),
                 fu_side,
+                TIME_IN_FORCE,
             )
+            ORDER_ACK.observe(perf_counter() - sent, td["exchange"])
+            if order_id == ORDER_UNKNOWN:
+                logger.error("FOLLOW-UP %s %s: order outcome unknown, follow-up stopped", td["exchange"], fu_market)
+                break
             if order_id:
-                sleep(1)
-                exchange.closeOrder(order_id, markets[fu_market]["trade"], markets[fu_market]["base"])
-                order_data = exchange.getOrderData(order_id, markets[fu_market]["trade"], markets[fu_market]["base"])
+                attempts += 1
+                order_data = self.settle_order(td["exchange"], exchange, order_id, fu_market, sent)
                 if order_data:
                     td["orderData"].append({
                         "id": order_id,
                         "rate": order_data["price"],
                         "volume": Decimal(str(order_data["quantity"])) - Decimal(str(order_data["quantityRemaining"])),
                         "follow_up": True,
+                        "side": fu_side,
                     })
                     # Update remaining volume/rate
-                    fu_order_value -= Decimal(str(fu_rate)) * (Decimal(str(order_data["quantity"])) - Decimal(str(order_data["quantityRemaining"])))
-                    change = max(fu_rate * Decimal("0.001"), Decimal(10) ** -mi["ratePrecision"])
-                    fu_rate += (-1 if fu_side == "SELL" else 1) * change
-                    if fu_side == "BUY":
-                        fu_volume = rnd_down(fu_order_value / fu_rate, mi["volumePrecision"])
-                    else:
-                        fu_volume = rnd_down(Decimal(str(order_data["quantityRemaining"])), mi["volumePrecision"])
+                    fu_rate, fu_volume, fu_order_value = reprice_leg(fu_side, fu_rate, fu_order_value, order_data, mi)
                 else:
                     logger.warning("Could not get follow-up order data for %s", order_id)
                     break
@@ -477,27 +886,431 @@ class TRADE(threading.Thread):
                 backoff = min(2 ** retries, 30)
                 logger.warning("Follow-up order failed, retry %d/%d in %ds", retries, self.MAX_RETRIES, backoff)
                 sleep(backoff)
+        if fu_volume * fu_rate > fu_min_order and not may_place(attempts):
+            logger.warning(
+                "FOLLOW-UP %s %s: %.8f left unfilled after %d %s orders",
+                td["exchange"], fu_market, fu_volume, attempts, TIME_IN_FORCE,
+            )
+
+
+class ASYNC_EXECUTOR(threading.Thread):
+    """Runs the legs of a trade as coroutines on one asyncio loop.
+
+    Every leg is submitted at once over a pooled aiohttp session per
+    exchange, so the legs of a route go out together instead of whenever
+    each TRADE thread wakes. A leg follows the same place / wait / cancel /
+    query / reprice cycle as TRADE, then its follow-up order if any, or
+    alongside it when fund_follow_up() sized the follow-up from the wallet,
+    followed by the order follow_up_correction() squares it with.
+    """
+
+    MAX_RETRIES = TRADE.MAX_RETRIES
+
+    def __init__(self, threadId, name, pool_size=ORDER_POOL_SIZE):
+        threading.Thread.__init__(self)
+        self.threadId = threadId
+        self.name = name
+        self.pool_size = pool_size
+        self.daemon = True
+        self.loop = asyncio.new_event_loop()
+        self.sessions = {}
+        self._ready = threading.Event()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._open_sessions())
+        self._ready.set()
+        self.loop.run_forever()
+
+    async def _open_sessions(self):
+        for name in exchanges:
+            self.sessions[name] = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.pool_size, ttl_dns_cache=300,
+                    # Outlive the keep-warm period so pinged connections stay open
+                    keepalive_timeout=max(15.0, HTTP_KEEP_WARM * 2),
+                ),
+                timeout=aiohttp.ClientTimeout(total=10),
+            )
+        if HTTP_KEEP_WARM > 0:
+            self.loop.create_task(self._keep_warm())
+
+    async def _keep_warm(self):
+        while True:
+            await asyncio.sleep(HTTP_KEEP_WARM)
+            for name, session in self.sessions.items():
+                try:
+                    await exchanges[name].pingAsync(session)
+                except Exception as e:
+                    logger.warning("Keep-warm ping to %s failed: %s", name, e)
+
+    def execute(self, legs, timeout):
+        """Run the legs concurrently; blocks the calling thread until they have returned.
+
+        False when they outlive timeout: they are then told to stop, and each
+        settles (cancels and queries) the order it has out and places no
+        more. Cancelling the coroutines could leave an order nothing settles.
+        """
+        self._ready.wait()
+        stopping = threading.Event()
+        future = asyncio.run_coroutine_threadsafe(self._execute(legs, stopping), self.loop)
+        try:
+            future.result(timeout)
+            return True
+        except concurrent.futures.TimeoutError:
+            stopping.set()
+            future.result()
+            return False
+
+    async def _execute(self, legs, stopping):
+        results = await asyncio.gather(*(self._run_leg(td, stopping) for td in legs), return_exceptions=True)
+        for td, result in zip(legs, results):
+            if isinstance(result, Exception):
+                logger.error("Order leg %s %s failed: %s", td["exchange"], td["market"], result)
+
+    async def _run_leg(self, td, stopping):
+        first = self._place_until_filled(
+            td, td["market"], td["side"], td["rate"], td["volume"], td["minOrderValue"], stopping,
+        )
+        follow_up = td.get("follow_up")
+        if not follow_up:
+            await first
+            return
+        fu_market = follow_up["market"]
+        mi = market_info[td["exchange"]][fu_market]
+        fu_min_order = mi.get("minOrderValue" + markets[fu_market]["base"]) or Decimal("0.0001")
+        if "volume" in follow_up:
+            # Funded from the wallet: both orders go out together
+            await asyncio.gather(first, self._place_until_filled(
+                td, fu_market, follow_up["side"], follow_up["rate"], follow_up["volume"], fu_min_order, stopping,
+                follow_up=True,
+            ))
+            correction = follow_up_correction(td, follow_up, mi)
+            if correction:
+                await self._place_until_filled(
+                    td, fu_market, correction["side"], correction["rate"], correction["volume"], fu_min_order,
+                    stopping, follow_up=True,
+                )
+        else:
+            await first
+            await self._place_until_filled(
+                td, fu_market, follow_up["side"], follow_up["rate"], follow_up_volume(td, follow_up, mi),
+                fu_min_order, stopping,
+                follow_up=True,
+            )
+
+    async def _settle_order(self, exchange_name, order_id, trade, base, sent):
+        """TRADE.settle_order() without blocking the loop."""
+        exchange = exchanges[exchange_name]
+        session = self.sessions[exchange_name]
+        order_data = exchange.placedOrderData(order_id)
+        if order_data:
+            FILL_CONFIRM.observe(perf_counter() - sent, exchange_name)
+            return order_data
+        streaming = fill_tracker.live(exchange_name)
+        if TIME_IN_FORCE == "GTC":
+            if streaming:
+                order_data = await fill_tracker.wait_async(exchange_name, order_id, ORDER_REST_TIME)
+                if order_data:
+                    FILL_CONFIRM.observe(perf_counter() - sent, exchange_name)
+                    return order_data
+            else:
+                await asyncio.sleep(ORDER_REST_TIME)
+            await exchange.closeOrderAsync(session, order_id, trade, base)
+        if streaming:
+            order_data = await fill_tracker.wait_async(exchange_name, order_id, CANCEL_CONFIRM_WAIT)
+            if order_data:
+                FILL_CONFIRM.observe(perf_counter() - sent, exchange_name)
+                return order_data
+        started = perf_counter()
+        order_data = await exchange.getOrderDataAsync(session, order_id, trade, base)
+        done = perf_counter()
+        ORDER_QUERY.observe(done - started, exchange_name)
+        if order_data:
+            FILL_CONFIRM.observe(done - sent, exchange_name)
+        return order_data
+
+    async def _place_until_filled(self, td, market, side, rate, volume, min_order_value, stopping, follow_up=False):
+        exchange = exchanges[td["exchange"]]
+        session = self.sessions[td["exchange"]]
+        trade, base = markets[market]["trade"], markets[market]["base"]
+        mi = market_info[td["exchange"]][market]
+        order_value = rate * volume
+        retries = 0
+        attempts = 0
+
+        while (volume * rate > min_order_value and retries < self.MAX_RETRIES and may_place(attempts)
+               and not stopping.is_set()):
+            logger.info(
+                "%s%s %s %s %.8f %.8f %s",
+                "FOLLOW-UP " if follow_up else "", td["exchange"], trade, base, rate, volume, side,
+            )
+            sent = perf_counter()
+            order_id = await exchange.orderAsync(
+                session, trade, base, rnd(rate, mi["ratePrecision"]), rnd(volume, mi["volumePrecision"]), side,
+                TIME_IN_FORCE,
+            )
+            ORDER_ACK.observe(perf_counter() - sent, td["exchange"])
+            if order_id == ORDER_UNKNOWN:
+                # It may have been placed: another order could double the position
+                logger.error(
+                    "%s%s %s: order outcome unknown, stopped",
+                    "FOLLOW-UP " if follow_up else "", td["exchange"], market,
+                )
+                break
+            if not order_id:
+                retries += 1
+                backoff = min(2 ** retries, 30)
+                logger.warning("Order failed, retry %d/%d in %ds", retries, self.MAX_RETRIES, backoff)
+                await asyncio.sleep(backoff)
+                continue
+            attempts += 1
+
+            order_data = await self._settle_order(td["exchange"], order_id, trade, base, sent)
+            if not order_data:
+                logger.warning("Could not get order data for %s", order_id)
+                break
+            fill = {
+                "id": order_id,
+                "rate": order_data["price"],
+                "volume": Decimal(str(order_data["quantity"])) - Decimal(str(order_data["quantityRemaining"])),
+            }
+            if follow_up:
+                fill["follow_up"] = True
+                fill["side"] = side
+            td["orderData"].append(fill)
+            rate, volume, order_value = reprice_leg(side, rate, order_value, order_data, mi)
+        if volume * rate > min_order_value and not may_place(attempts):
+            logger.warning(
+                "%s%s %s: %.8f left unfilled after %d %s orders",
+                "FOLLOW-UP " if follow_up else "", td["exchange"], market, volume, attempts, TIME_IN_FORCE,
+            )
+
+
+class TRADE_WORKER(threading.Thread):
+    """Executes the trades MAIN_LOOP queues, one at a time.
+
+    A job holds the two legs of one opportunity and its reservation in the
+    ledger, which is released once the trade is saved and the wallets are
+    refreshed. With the threads executor every worker drives its own pair
+    of TRADE threads; with asyncio the legs go to the shared ORDER_EXECUTOR.
+    Legs still running at the job's timeout are told to stop and waited for:
+    the reservation and the legs' data outlive every order of the trade.
+    """
+
+    def __init__(self, threadId, name, jobs):
+        threading.Thread.__init__(self)
+        self.threadId = threadId
+        self.name = name
+        self.jobs = jobs
+        self.daemon = True
+        self.data = [{}, {}]
+        # (start, done) events per leg, one TRADE thread each
+        self.eventFlags = []
+        self.traders = []
+        if order_executor is None:
+            for n in (1, 2):
+                self._start_trader(n)
+
+    def _start_trader(self, n):
+        """Start a TRADE thread for leg n with fresh events; an abandoned one keeps its own, stopped."""
+        events = (threading.Event(), threading.Event())
+        trader = TRADE(self.threadId, "%s_LEG_%d" % (self.name, n), n, self.data, events, threading.Event())
+        if len(self.traders) < n:
+            self.eventFlags.append(events)
+            self.traders.append(trader)
+        else:
+            self.eventFlags[n - 1] = events
+            self.traders[n - 1] = trader
+        if self.is_alive():
+            trader.start()
+
+    def run(self):
+        for thread in self.traders:
+            thread.start()
+        while True:
+            job = self.jobs.get()
+            try:
+                self.execute(job)
+            except Exception:
+                logger.exception("Trade %s failed", job["label"])
+            finally:
+                reservations.release(job["reservation"])
+
+    def execute(self, job):
+        with data_lock:
+            self.data[0], self.data[1] = job["legs"]
+        self._execute_legs(job["timeout"], job["kind"])
+        update_wallets()
+        save_trade_record(job["label"], self.data)
+        with data_lock:
+            self.data[0] = {}
+            self.data[1] = {}
+
+    def _execute_legs(self, timeout, kind=""):
+        """Run the two legs in self.data and wait until both have returned.
+
+        Past timeout the legs are stopped: each settles the order it has out
+        and places no more, and only then may the reservation be released.
+        A leg still not back TRADE_STOP_TIMEOUT later is abandoned, stopped
+        for good, and replaced by a fresh TRADE thread.
+        """
+        if order_executor is not None:
+            if not order_executor.execute([self.data[0], self.data[1]], timeout):
+                logger.error("Order execution timed out%s; legs stopped", kind)
+            return
+        for trader, (start, done) in zip(self.traders, self.eventFlags):
+            trader.stopping.clear()
+            done.clear()
+            start.set()
+        deadline = monotonic() + timeout
+        for n, (start, done) in enumerate(list(self.eventFlags), 1):
+            if done.wait(timeout=max(deadline - monotonic(), 0)):
+                continue
+            logger.error("TRADE %d timed out%s; stopping the legs", n, kind)
+            for trader in self.traders:
+                trader.stopping.set()
+            if not done.wait(timeout=TRADE_STOP_TIMEOUT):
+                # Wedged in an exchange call: give up on it, and on its events, for a fresh thread
+                logger.error("TRADE %d still running %gs after the stop; abandoning it", n, TRADE_STOP_TIMEOUT)
+                self._start_trader(n)
 
 
 class MAIN2(threading.Thread):
-    def __init__(self, threadId, name, eventFlags, data):
+    def __init__(self, threadId, name, jobs=None):
         threading.Thread.__init__(self)
         self.threadId = threadId
         self.name = name
-        self.eventFlags = eventFlags
-        self.data = data
+        # Queue feeding the TRADE_WORKERs; None (dry run, replay, bench) never trades
+        self.jobs = jobs
         self.highest_arb = Decimal("0")
         self.arb_counter = [0, 0, 0, 0]
         self.daemon = True
+        self.matrix = None
+        self._matrix_routes = None
+        # Routes evaluated so far (all exchange pairs of a route count once)
+        self.routes_evaluated = 0
 
     def run(self):
+        last_sweep = 0
         while True:
-            self.compare()
-            sleep(0.1)
+            changed = book_updates.wait(timeout=COMPARE_SWEEP_INTERVAL)
+            sweep = time() - last_sweep >= COMPARE_SWEEP_INTERVAL
+            self.step(changed, sweep)
+            if sweep:
+                last_sweep = time()
+            episodes.expire(time())
+            rollups.flush()
+
+    def step(self, changed, sweep):
+        """One engine pass: a full sweep, or the routes touched by the changed (exchange, market) books."""
+        started = perf_counter()
+        if changed:
+            now = clock()
+            for exchange, market in changed:
+                last = order_books[exchange][market]["lastUpdate"]
+                if last is not None:
+                    COMPARE_WAIT.observe(max(0.0, now - last), exchange)
+        if sweep:
+            # Periodic full pass keeps staleness and the live view current
+            if COMPARE_ENGINE == "numpy":
+                self.compare_vectorized()
+            else:
+                self.compare()
+        elif changed:
+            if COMPARE_ENGINE == "numpy":
+                self.compare_vectorized(changed)
+            else:
+                self.compare_markets({market for _, market in changed})
+        else:
+            return
+        COMPARE.observe(perf_counter() - started, COMPARE_ENGINE, "sweep" if sweep else "incremental")
+
+    def compare_vectorized(self, changed=None):
+        """Evaluate every route at once on the top-of-book matrix.
+
+        changed is a set of (exchange, market) book updates; None means a full
+        sweep, which also refreshes the live view for every route.
+        """
+        # The market index and the routes it was built from must come from the same reload
+        with routes_lock:
+            current_routes = routes
+            current_index = routes_by_market
+        if self._matrix_routes is not current_routes:
+            # Routes were (re)built: rebuild index arrays and fee thresholds
+            self.matrix = ROUTE_MATRIX(
+                exchanges, current_index.keys(), current_routes, route_threshold, MAX_BOOK_AGE,
+            )
+            self._matrix_routes = current_routes
+            changed = None
+
+        if changed is None:
+            self.matrix.refresh(order_books)
+        else:
+            for exchange, market in changed:
+                self.matrix.update(exchange, market, order_books[exchange][market])
+        now = clock()
+        results = self.matrix.evaluate(now, None if changed is None else {m for _, m in changed})
+
+        for route_type, result in results.items():
+            self.routes_evaluated += int(result["touched"].sum())
+            if changed is None:
+                self._publish_comparisons(route_type, result, now)
+            if route_type == "direct":
+                screened = result["touched"] & ~result["candidates"]
+                for i, level in enumerate(ARB_COUNTER_LEVELS):
+                    self.arb_counter[i] += int((result["best_arb"][screened] > float(level)).sum())
+            for i in result["candidates"].nonzero()[0]:
+                self._compare_routes([result["routes"][i]])
+
+    def _publish_comparisons(self, route_type, result, now):
+        """Write the live view for every route of a type from the matrix results."""
+        pairs = self.matrix.pairs
+        with comparisons_lock:
+            for route, pair, arb, prices in zip(
+                result["routes"], result["best_pair"], result["best_arb"], result["prices"],
+            ):
+                A, B = pairs[pair]
+                if route_type == "cross":
+                    # legs: bid_x on A, bid_y on B, ask_y on A, ask_x on B
+                    buy_rate, sell_rate, cross_rate = prices[3], prices[0], None
+                elif route_type == "multi_leg":
+                    buy_rate, sell_rate, cross_rate = prices[0], prices[1], float(prices[2])
+                else:
+                    buy_rate, sell_rate, cross_rate = prices[0], prices[1], None
+                label = route_label(route)
+                latest_comparisons[label] = {
+                    "route_type": route_type,
+                    "route_label": label,
+                    "spread_pct": float(arb * 100),
+                    "buy_rate": float(buy_rate),
+                    "sell_rate": float(sell_rate),
+                    "buy_exchange": B,
+                    "sell_exchange": A,
+                    "cross_rate": cross_rate,
+                    "ts": now,
+                }
 
     def compare(self):
         with routes_lock:
             current_routes = list(routes)
+        self.routes_evaluated += len(current_routes)
+        self._compare_routes(current_routes)
+
+    def compare_markets(self, changed_markets):
+        """Re-evaluate only the routes with a leg on one of the changed markets."""
+        with routes_lock:
+            seen = set()
+            current_routes = []
+            for market in changed_markets:
+                for route in routes_by_market.get(market, ()):
+                    if id(route) not in seen:
+                        seen.add(id(route))
+                        current_routes.append(route)
+        self.routes_evaluated += len(current_routes)
+        self._compare_routes(current_routes)
+
+    def _compare_routes(self, current_routes):
         for route in current_routes:
             if route["type"] == "direct":
                 self._compare_direct(route)
@@ -508,16 +1321,15 @@ class MAIN2(threading.Thread):
 
     def _compare_direct(self, route):
         market = route["market"]
-        with order_book_lock:
-            info = [
-                {
-                    "info": self.get_market_info(A, B, market),
-                    "A": A, "B": B, "market": market, "makeTrade": False,
-                }
-                for B in exchanges
-                for A in exchanges
-                if A != B
-            ]
+        info = [
+            {
+                "info": self.get_market_info(A, B, market),
+                "A": A, "B": B, "market": market, "makeTrade": False,
+            }
+            for B in exchanges
+            for A in exchanges
+            if A != B
+        ]
         best = max(info, key=lambda x: x["info"]["arbitrage"])
 
         with comparisons_lock:
@@ -541,11 +1353,10 @@ class MAIN2(threading.Thread):
             self.highest_arb * 100, ac,
         )
         # Dynamic threshold based on per-leg fees
-        fee_a = market_info.get(best["A"], {}).get(market, {}).get("tradeFees", Decimal("0.001"))
-        fee_b = market_info.get(best["B"], {}).get(market, {}).get("tradeFees", Decimal("0.001"))
-        threshold = compute_threshold(MIN_PROFIT, [fee_a, fee_b])
+        threshold = route_threshold(route, best["A"], best["B"])
 
-        if best["info"]["arbitrage"] >= threshold:
+        exact_info = lambda: self.get_market_info(best["A"], best["B"], market, exact=True)
+        if self._above_threshold(best, threshold, exact_info):
             best = self.calc_rates(best)
             best = self.calc_r(best)
             with wallets_lock:
@@ -554,44 +1365,51 @@ class MAIN2(threading.Thread):
                 logger.info("TRADE OPPORTUNITY: %s arb=%.5f%%", market, best["info"]["arbitrage"] * 100)
                 if DRY_RUN:
                     self._log_opportunity("direct", market, best)
-                else:
+                elif self.trade(best):
                     self._log_opportunity("direct", market, best, executed=True)
-                    self.trade(best)
                     logger.info(
                         "%s | buy: %.8f, sell: %.8f, r: %.8f",
                         market, best["info"]["A"], best["info"]["B"], best["info"]["r"],
                     )
-                    self.update_wallets()
-                    self.save_trade(best["market"])
-                    with data_lock:
-                        self.data[0] = {}
-                        self.data[1] = {}
+                else:
+                    # Every worker busy or a market already trading: still an opportunity seen
+                    self._log_opportunity("direct", market, best)
             if best["info"]["arbitrage"] > self.highest_arb:
                 self.highest_arb = best["info"]["arbitrage"]
 
-        self.arb_counter[0] += 1 if best["info"]["arbitrage"] > Decimal("0.004") else 0
-        self.arb_counter[1] += 1 if best["info"]["arbitrage"] > Decimal("0.005") else 0
-        self.arb_counter[2] += 1 if best["info"]["arbitrage"] > Decimal("0.0075") else 0
-        self.arb_counter[3] += 1 if best["info"]["arbitrage"] > Decimal("0.01") else 0
+        for i, level in enumerate(ARB_COUNTER_LEVELS):
+            self.arb_counter[i] += 1 if best["info"]["arbitrage"] > level else 0
+
+    def _above_threshold(self, best, threshold, exact_info):
+        """Check the best pair against its threshold.
+
+        With tick books the screen runs on float prices; a pair that passes is
+        re-read exactly via exact_info() and checked again in Decimal.
+        """
+        if not TICK_BOOKS:
+            return best["info"]["arbitrage"] >= threshold
+        if best["info"]["arbitrage"] < float(threshold):
+            return False
+        best["info"] = exact_info()
+        return best["info"]["arbitrage"] >= threshold
 
     def _compare_multi_leg(self, route):
-        with order_book_lock:
-            info = [
-                {
-                    "info": self.get_multi_leg_info(A, B, route),
-                    "A": A, "B": B, "route": route, "makeTrade": False,
-                }
-                for B in exchanges
-                for A in exchanges
-                if A != B
-            ]
+        info = [
+            {
+                "info": self.get_multi_leg_info(A, B, route),
+                "A": A, "B": B, "route": route, "makeTrade": False,
+            }
+            for B in exchanges
+            for A in exchanges
+            if A != B
+        ]
         best = max(info, key=lambda x: x["info"]["arbitrage"])
-        route_label = "%s>%s" % (route["buy_market"], route["sell_market"])
+        label = route_label(route)
 
         with comparisons_lock:
-            latest_comparisons[route_label] = {
+            latest_comparisons[label] = {
                 "route_type": "multi_leg",
-                "route_label": route_label,
+                "route_label": label,
                 "spread_pct": float(best["info"]["arbitrage"] * 100),
                 "buy_rate": float(best["info"]["A"]),
                 "sell_rate": float(best["info"]["B"]),
@@ -603,23 +1421,15 @@ class MAIN2(threading.Thread):
 
         logger.debug(
             "ML %s - %.5f%% A:%.8f B:%.8f cross:%.8f",
-            route_label, best["info"]["arbitrage"] * 100,
+            label, best["info"]["arbitrage"] * 100,
             best["info"]["A"], best["info"]["B"], best["info"]["cross_rate"],
         )
         # Dynamic threshold based on per-leg fees (3 legs for multi-leg)
         route = best["route"]
-        fee_sell = market_info.get(best["A"], {}).get(route["buy_market"], {}).get("tradeFees", Decimal("0.001"))
-        fee_buy = market_info.get(best["B"], {}).get(route["sell_market"], {}).get("tradeFees", Decimal("0.001"))
-        # Cross leg fee: use best available from either exchange
-        fee_cross = Decimal("0.001")
-        for ex in exchanges:
-            mi_cp = market_info.get(ex, {}).get(route["cross_pair"])
-            if mi_cp:
-                fee_cross = mi_cp["tradeFees"]
-                break
-        threshold = compute_threshold(MIN_PROFIT, [fee_sell, fee_buy, fee_cross])
+        threshold = route_threshold(route, best["A"], best["B"])
 
-        if best["info"]["arbitrage"] >= threshold:
+        exact_info = lambda: self.get_multi_leg_info(best["A"], best["B"], route, exact=True)
+        if self._above_threshold(best, threshold, exact_info):
             best = self.calc_rates_multi_leg(best)
             best = self.calc_r_multi_leg(best)
             with wallets_lock:
@@ -627,27 +1437,24 @@ class MAIN2(threading.Thread):
             if best["makeTrade"]:
                 logger.info(
                     "MULTI-LEG OPPORTUNITY: %s arb=%.5f%%",
-                    route_label, best["info"]["arbitrage"] * 100,
+                    label, best["info"]["arbitrage"] * 100,
                 )
                 if DRY_RUN:
-                    self._log_opportunity("multi_leg", route_label, best)
-                else:
-                    self._log_opportunity("multi_leg", route_label, best, executed=True)
-                    self.trade_multi_leg(best)
+                    self._log_opportunity("multi_leg", label, best)
+                elif self.trade_multi_leg(best):
+                    self._log_opportunity("multi_leg", label, best, executed=True)
                     logger.info(
                         "%s | buy: %.8f, sell: %.8f, cross: %.8f, r: %.8f",
-                        route_label, best["info"]["A"], best["info"]["B"],
+                        label, best["info"]["A"], best["info"]["B"],
                         best["info"]["cross_rate"], best["info"]["r"],
                     )
-                    self.update_wallets()
-                    self.save_trade(route_label)
-                    with data_lock:
-                        self.data[0] = {}
-                        self.data[1] = {}
+                else:
+                    # Every worker busy or a market already trading: still an opportunity seen
+                    self._log_opportunity("multi_leg", label, best)
             if best["info"]["arbitrage"] > self.highest_arb:
                 self.highest_arb = best["info"]["arbitrage"]
 
-    def get_cross_info(self, A, B, route):
+    def get_cross_info(self, A, B, route, exact=False):
         """Get arbitrage info for a cross route.
 
         Exchange A: SELL trade_x/base, BUY trade_y/base
@@ -655,7 +1462,7 @@ class MAIN2(threading.Thread):
         Arbitrage = (bid_x_A * bid_y_B) / (ask_y_A * ask_x_B) - 1
         """
         zero = {
-            "arbitrage": Decimal("0"),
+            "arbitrage": NO_ARB,
             "bid_x": Decimal("0"), "ask_y": Decimal("0"),
             "bid_y": Decimal("0"), "ask_x": Decimal("0"),
             "qtyA": Decimal("0"), "qtyB": Decimal("0"), "r": Decimal("0"),
@@ -671,15 +1478,16 @@ class MAIN2(threading.Thread):
             return zero
 
         # Staleness checks
-        now = time()
+        now = clock()
         for ob in [ob_x_A, ob_y_A, ob_y_B, ob_x_B]:
-            if ob["lastUpdate"] is not None and Decimal(str(now - ob["lastUpdate"])) > MAX_TIME_SINCE_UPDATE:
+            if ob["lastUpdate"] is not None and now - ob["lastUpdate"] > MAX_BOOK_AGE:
                 return zero
 
-        bid_x = ob_x_A["buy"][0][0]   # best bid for x on A
-        ask_y = ob_y_A["sell"][0][0]   # best ask for y on A
-        bid_y = ob_y_B["buy"][0][0]    # best bid for y on B
-        ask_x = ob_x_B["sell"][0][0]   # best ask for x on B
+        price = (lambda levels: levels[0][0]) if exact else top_price
+        bid_x = price(ob_x_A["buy"])   # best bid for x on A
+        ask_y = price(ob_y_A["sell"])  # best ask for y on A
+        bid_y = price(ob_y_B["buy"])   # best bid for y on B
+        ask_x = price(ob_x_B["sell"])  # best ask for x on B
 
         arbitrage = (bid_x * bid_y) / (ask_y * ask_x) - 1
 
@@ -692,23 +1500,22 @@ class MAIN2(threading.Thread):
         }
 
     def _compare_cross(self, route):
-        with order_book_lock:
-            info = [
-                {
-                    "info": self.get_cross_info(A, B, route),
-                    "A": A, "B": B, "route": route, "makeTrade": False,
-                }
-                for B in exchanges
-                for A in exchanges
-                if A != B
-            ]
+        info = [
+            {
+                "info": self.get_cross_info(A, B, route),
+                "A": A, "B": B, "route": route, "makeTrade": False,
+            }
+            for B in exchanges
+            for A in exchanges
+            if A != B
+        ]
         best = max(info, key=lambda x: x["info"]["arbitrage"])
-        route_label = "%s×%s/%s" % (route["trade_x"], route["trade_y"], route["base"])
+        label = route_label(route)
 
         with comparisons_lock:
-            latest_comparisons[route_label] = {
+            latest_comparisons[label] = {
                 "route_type": "cross",
-                "route_label": route_label,
+                "route_label": label,
                 "spread_pct": float(best["info"]["arbitrage"] * 100),
                 "buy_rate": float(best["info"]["ask_x"]),
                 "sell_rate": float(best["info"]["bid_x"]),
@@ -719,17 +1526,14 @@ class MAIN2(threading.Thread):
             }
 
         logger.debug(
-            "CROSS %s - %.5f%%", route_label, best["info"]["arbitrage"] * 100,
+            "CROSS %s - %.5f%%", label, best["info"]["arbitrage"] * 100,
         )
 
         # Dynamic threshold: 4 legs
-        fee_1 = market_info.get(best["A"], {}).get(route["market_x"], {}).get("tradeFees", Decimal("0.001"))
-        fee_2 = market_info.get(best["A"], {}).get(route["market_y"], {}).get("tradeFees", Decimal("0.001"))
-        fee_3 = market_info.get(best["B"], {}).get(route["market_y"], {}).get("tradeFees", Decimal("0.001"))
-        fee_4 = market_info.get(best["B"], {}).get(route["market_x"], {}).get("tradeFees", Decimal("0.001"))
-        threshold = compute_threshold(MIN_PROFIT, [fee_1, fee_2, fee_3, fee_4])
+        threshold = route_threshold(route, best["A"], best["B"])
 
-        if best["info"]["arbitrage"] >= threshold:
+        exact_info = lambda: self.get_cross_info(best["A"], best["B"], route, exact=True)
+        if self._above_threshold(best, threshold, exact_info):
             best = self.calc_rates_cross(best)
             best = self.calc_r_cross(best)
             with wallets_lock:
@@ -737,28 +1541,26 @@ class MAIN2(threading.Thread):
             if best["makeTrade"]:
                 logger.info(
                     "CROSS OPPORTUNITY: %s arb=%.5f%%",
-                    route_label, best["info"]["arbitrage"] * 100,
+                    label, best["info"]["arbitrage"] * 100,
                 )
                 if DRY_RUN:
-                    self._log_opportunity("cross", route_label, best)
-                else:
-                    self._log_opportunity("cross", route_label, best, executed=True)
-                    self.trade_cross(best)
+                    self._log_opportunity("cross", label, best)
+                elif self.trade_cross(best):
+                    self._log_opportunity("cross", label, best, executed=True)
                     logger.info(
                         "%s | bid_x: %.8f, ask_y: %.8f, bid_y: %.8f, ask_x: %.8f",
-                        route_label, best["info"]["bid_x"], best["info"]["ask_y"],
+                        label, best["info"]["bid_x"], best["info"]["ask_y"],
                         best["info"]["bid_y"], best["info"]["ask_x"],
                     )
-                    self.update_wallets()
-                    self.save_trade(route_label)
-                    with data_lock:
-                        self.data[0] = {}
-                        self.data[1] = {}
+                else:
+                    # Every worker busy or a market already trading: still an opportunity seen
+                    self._log_opportunity("cross", label, best)
             if best["info"]["arbitrage"] > self.highest_arb:
                 self.highest_arb = best["info"]["arbitrage"]
 
     def _log_opportunity(self, route_type, label, best, executed=False):
-        mode_tag = "EXECUTED" if executed else "DRY-RUN"
+        self._observe_decision(route_type, best)
+        mode_tag = "EXECUTED" if executed else "DRY-RUN" if DRY_RUN else "SKIPPED"
         # Cross routes use bid_x/ask_x instead of A/B
         if route_type == "cross":
             sell_rate = best["info"]["bid_x"]
@@ -766,14 +1568,26 @@ class MAIN2(threading.Thread):
         else:
             sell_rate = best["info"]["A"]
             buy_rate = best["info"]["B"]
-        logger.info(
+        spread_pct = best["info"]["arbitrage"] * 100
+        now = clock()
+        tick = episodes.tick(
+            route_type, label, best["A"], best["B"], spread_pct, buy_rate, sell_rate,
+            best["info"]["qtyA"], best["info"]["qtyB"], executed, now,
+        )
+        rollups.add(label, best["B"], best["A"], spread_pct, executed, now)
+        # The rest of the episode is summed up in opportunity_episodes
+        sampled = executed or tick == 1 or (OPPORTUNITY_SAMPLE_EVERY > 0 and (tick - 1) % OPPORTUNITY_SAMPLE_EVERY == 0)
+        logger.log(
+            logging.INFO if sampled else logging.DEBUG,
             "[%s] OPPORTUNITY %s %s | sell_exchange=%s buy_exchange=%s "
-            "spread=%.5f%% sell_rate=%.8f buy_rate=%.8f qtyA=%.8f qtyB=%.8f",
+            "spread=%.5f%% sell_rate=%.8f buy_rate=%.8f qtyA=%.8f qtyB=%.8f tick=%d",
             mode_tag, route_type, label, best["A"], best["B"],
-            best["info"]["arbitrage"] * 100,
+            spread_pct,
             sell_rate, buy_rate,
-            best["info"]["qtyA"], best["info"]["qtyB"],
+            best["info"]["qtyA"], best["info"]["qtyB"], tick,
         )
+        if not sampled:
+            return
         cross_rate = best["info"].get("cross_rate")
         try:
             save_opportunity(
@@ -781,7 +1595,7 @@ class MAIN2(threading.Thread):
                 route_label=label,
                 buy_exchange=best["B"],
                 sell_exchange=best["A"],
-                spread_pct=best["info"]["arbitrage"] * 100,
+                spread_pct=spread_pct,
                 buy_rate=buy_rate,
                 sell_rate=sell_rate,
                 cross_rate=cross_rate if cross_rate and cross_rate != Decimal("0") else None,
@@ -793,18 +1607,30 @@ class MAIN2(threading.Thread):
         except Exception:
             logger.exception("Failed to save opportunity to DB")
 
-    def save_trade(self, market):
-        order_id = save_order(market)
-        save_order_data(self.data[0], order_id)
-        save_order_data(self.data[1], order_id)
+    def _observe_decision(self, route_type, best):
+        """Time from the newest book update on any leg of the route to this decision."""
+        markets = route_markets(best["route"]) if "route" in best else (best["market"],)
+        updates = [
+            order_books[ex][m]["lastUpdate"] for ex in (best["A"], best["B"]) for m in markets
+            if m in order_books[ex] and order_books[ex][m]["lastUpdate"] is not None
+        ]
+        if updates:
+            DECISION.observe(max(0.0, clock() - max(updates)), route_type)
+
+    def get_market_info(self, A, B, market, exact=False):
+        """Get arbitrage info for a direct route.
 
-    def get_market_info(self, A, B, market):
-        buy = order_books[A][market]["buy"]
-        sell = order_books[B][market]["sell"]
-        last_a = order_books[A][market]["lastUpdate"]
-        last_b = order_books[B][market]["lastUpdate"]
+        With tick books, prices are floats unless exact=True, which materializes Decimal.
+        """
+        # One reference per snapshot keeps each book's fields consistent
+        book_a = order_books[A][market]
+        book_b = order_books[B][market]
+        buy = book_a["buy"]
+        sell = book_b["sell"]
+        last_a = book_a["lastUpdate"]
+        last_b = book_b["lastUpdate"]
         zero = {
-            "arbitrage": Decimal("0"), "A": Decimal("0"), "B": Decimal("0"),
+            "arbitrage": NO_ARB, "A": Decimal("0"), "B": Decimal("0"),
             "qtyA": Decimal("0"), "qtyB": Decimal("0"), "r": Decimal("0"),
             "minOrderValueA": Decimal("0"), "minOrderValueB": Decimal("0"),
         }
@@ -813,15 +1639,15 @@ class MAIN2(threading.Thread):
             return zero
 
         # Staleness check
-        now = time()
-        if last_a is not None and Decimal(str(now - last_a)) > MAX_TIME_SINCE_UPDATE:
+        now = clock()
+        if last_a is not None and now - last_a > MAX_BOOK_AGE:
             return zero
-        if last_b is not None and Decimal(str(now - last_b)) > MAX_TIME_SINCE_UPDATE:
+        if last_b is not None and now - last_b > MAX_BOOK_AGE:
             return zero
 
         # Use index [0] for best price
-        buy_rate = buy[0][0]
-        sell_rate = sell[0][0]
+        buy_rate = buy[0][0] if exact else top_price(buy)
+        sell_rate = sell[0][0] if exact else top_price(sell)
         return {
             "arbitrage": buy_rate / sell_rate - 1,
             "A": buy_rate,
@@ -833,14 +1659,14 @@ class MAIN2(threading.Thread):
             "minOrderValueB": Decimal("0"),
         }
 
-    def get_multi_leg_info(self, A, B, route):
+    def get_multi_leg_info(self, A, B, route, exact=False):
         """Get arbitrage info for a multi-leg route.
 
         Buy trade/buy_base on exchange A, sell trade/sell_base on exchange B,
         using cross pair to convert between bases.
         """
         zero = {
-            "arbitrage": Decimal("0"), "A": Decimal("0"), "B": Decimal("0"),
+            "arbitrage": NO_ARB, "A": Decimal("0"), "B": Decimal("0"),
             "cross_rate": Decimal("0"),
             "qtyA": Decimal("0"), "qtyB": Decimal("0"), "r": Decimal("0"),
             "minOrderValueA": Decimal("0"), "minOrderValueB": Decimal("0"),
@@ -854,20 +1680,23 @@ class MAIN2(threading.Thread):
 
         # Cross rate: ask from exchange B (where the 3rd leg follow_up executes)
         cp_B = order_books[B][route["cross_pair"]]
-        if not cp_B["sell"] or cp_B["sell"][0][0] <= 0:
+        if not cp_B["sell"]:
+            return zero
+        cross_rate = cp_B["sell"][0][0] if exact else top_price(cp_B["sell"])
+        if cross_rate <= 0:
             return zero
-        cross_rate = cp_B["sell"][0][0]
 
         # Staleness checks
-        now = time()
+        now = clock()
         for ob, label in [(buy_ob, "buy"), (sell_ob, "sell")]:
-            if ob["lastUpdate"] is not None and Decimal(str(now - ob["lastUpdate"])) > MAX_TIME_SINCE_UPDATE:
+            if ob["lastUpdate"] is not None and now - ob["lastUpdate"] > MAX_BOOK_AGE:
                 return zero
-        if cp_B["lastUpdate"] is not None and Decimal(str(now - cp_B["lastUpdate"])) > MAX_TIME_SINCE_UPDATE:
+        if cp_B["lastUpdate"] is not None and now - cp_B["lastUpdate"] > MAX_BOOK_AGE:
             return zero
 
-        buy_rate = buy_ob["buy"][0][0]   # best bid on buy market (revenue from selling)
-        sell_rate = sell_ob["sell"][0][0]  # best ask on sell market (cost of buying)
+        # best bid on buy market (revenue from selling), best ask on sell market (cost of buying)
+        buy_rate = buy_ob["buy"][0][0] if exact else top_price(buy_ob["buy"])
+        sell_rate = sell_ob["sell"][0][0] if exact else top_price(sell_ob["sell"])
 
         # Effective arb: revenue / cost - 1
         # buy_rate is in buy_base; sell_rate is in sell_base
@@ -918,10 +1747,11 @@ class MAIN2(threading.Thread):
             if mov_btc is not None:
                 return mov_btc
         elif markets[info["market"]]["base"] == "ETH":
+            eth_bids = order_books[exchange]["ETHBTC"]["buy"]
             if mov_eth is not None:
                 return mov_eth
-            elif order_books[exchange]["ETHBTC"]["buy"]:
-                return (mov_btc or Decimal("0.0001")) / Decimal(str(order_books[exchange]["ETHBTC"]["buy"][0][0]))
+            elif eth_bids:
+                return (mov_btc or Decimal("0.0001")) / Decimal(str(eth_bids[0][0]))
         logger.warning("Could not determine min order value for %s on %s", info["market"], exchange)
         return Decimal("1e99")
 
@@ -932,8 +1762,8 @@ class MAIN2(threading.Thread):
         base = markets[info["market"]]["base"]
         trade = markets[info["market"]]["trade"]
 
-        wallet_buy = wallets[buy_exchange].get(base, {}).get("available", Decimal("0"))
-        wallet_sell = wallets[sell_exchange].get(trade, {}).get("available", Decimal("0")) * info["info"]["B"]
+        wallet_buy = available(buy_exchange, base)
+        wallet_sell = available(sell_exchange, trade) * info["info"]["B"]
 
         info["info"]["minOrderValueA"] = self.get_min_order_value(info["A"], info)
         info["info"]["minOrderValueB"] = self.get_min_order_value(info["B"], info)
@@ -1033,12 +1863,12 @@ class MAIN2(threading.Thread):
         cross_rate = info["info"]["cross_rate"]
 
         # Buy exchange needs buy_base currency; sell exchange needs trade currency
-        wallet_buy = wallets[buy_exchange].get(route["buy_base"], {}).get("available", Decimal("0"))
+        wallet_buy = available(buy_exchange, route["buy_base"])
         # Sell exchange wallet: trade currency valued in sell_base, convert to buy_base
-        wallet_sell_raw = wallets[sell_exchange].get(route["trade"], {}).get("available", Decimal("0")) * info["info"]["B"]
+        wallet_sell_raw = available(sell_exchange, route["trade"]) * info["info"]["B"]
         wallet_sell = wallet_sell_raw * cross_rate  # convert to buy_base for comparison
         # Also need buy_base on sell exchange to fund the 3rd leg (cross pair BUY)
-        wallet_cross = wallets[sell_exchange].get(route["buy_base"], {}).get("available", Decimal("0"))
+        wallet_cross = available(sell_exchange, route["buy_base"])
 
         # Min order values (in buy_base terms)
         mi_buy = market_info.get(buy_exchange, {}).get(buy_market)
@@ -1088,14 +1918,14 @@ class MAIN2(threading.Thread):
         route = info["route"]
         cross_pair = route["cross_pair"]
         cross_rate = info["info"]["cross_rate"]
-        with data_lock:
-            self.data[0] = {
+        legs = [
+            {
                 "side": "SELL", "exchange": info["A"],
                 "rate": info["info"]["A"], "volume": info["info"]["qtyA"],
                 "market": route["buy_market"], "minOrderValue": info["info"]["minOrderValueA"],
                 "orderData": [],
-            }
-            self.data[1] = {
+            },
+            {
                 "side": "BUY", "exchange": info["B"],
                 "rate": info["info"]["B"], "volume": info["info"]["qtyB"],
                 "market": route["sell_market"], "minOrderValue": info["info"]["minOrderValueB"],
@@ -1105,15 +1935,9 @@ class MAIN2(threading.Thread):
                     "market": cross_pair,
                     "rate": cross_rate,
                 },
-            }
-        self.eventFlags[0].set()
-        if not self.eventFlags[1].wait(timeout=120):
-            logger.error("TRADE 1 timed out (multi-leg)")
-        if not self.eventFlags[2].wait(timeout=120):
-            logger.error("TRADE 2 timed out (multi-leg)")
-
-        self.eventFlags[1].clear()
-        self.eventFlags[2].clear()
+            },
+        ]
+        return self._submit(route_label(route), legs, 120, " (multi-leg)")
 
     def calc_rates_cross(self, info):
         route = info["route"]
@@ -1179,12 +2003,12 @@ class MAIN2(threading.Thread):
         trade_y = route["trade_y"]
 
         # Exchange A: needs trade_x to sell, base to buy trade_y
-        wallet_x_A = wallets[A].get(trade_x, {}).get("available", Decimal("0")) * info["info"]["bid_x"]
-        wallet_base_A = wallets[A].get(base, {}).get("available", Decimal("0"))
+        wallet_x_A = available(A, trade_x) * info["info"]["bid_x"]
+        wallet_base_A = available(A, base)
 
         # Exchange B: needs trade_y to sell, base to buy trade_x
-        wallet_y_B = wallets[B].get(trade_y, {}).get("available", Decimal("0")) * info["info"]["bid_y"]
-        wallet_base_B = wallets[B].get(base, {}).get("available", Decimal("0"))
+        wallet_y_B = available(B, trade_y) * info["info"]["bid_y"]
+        wallet_base_B = available(B, base)
 
         mi_x_A = market_info.get(A, {}).get(route["market_x"])
         mi_y_A = market_info.get(A, {}).get(route["market_y"])
@@ -1230,9 +2054,9 @@ class MAIN2(threading.Thread):
 
     def trade_cross(self, info):
         route = info["route"]
-        with data_lock:
-            # Thread 1 (exchange A): SELL x/base → then BUY y/base
-            self.data[0] = {
+        legs = [
+            # Leg 1 (exchange A): SELL x/base → then BUY y/base
+            {
                 "side": "SELL", "exchange": info["A"],
                 "rate": info["info"]["bid_x"], "volume": info["info"]["qtyA"],
                 "market": route["market_x"], "minOrderValue": info["info"]["minOrderValueA"],
@@ -1242,9 +2066,9 @@ class MAIN2(threading.Thread):
                     "market": route["market_y"],
                     "rate": info["info"]["ask_y"],
                 },
-            }
-            # Thread 2 (exchange B): SELL y/base → then BUY x/base
-            self.data[1] = {
+            },
+            # Leg 2 (exchange B): SELL y/base → then BUY x/base
+            {
                 "side": "SELL", "exchange": info["B"],
                 "rate": info["info"]["bid_y"], "volume": info["info"]["qtyB"],
                 "market": route["market_y"], "minOrderValue": info["info"]["minOrderValueB"],
@@ -1254,55 +2078,70 @@ class MAIN2(threading.Thread):
                     "market": route["market_x"],
                     "rate": info["info"]["ask_x"],
                 },
-            }
-        self.eventFlags[0].set()
-        if not self.eventFlags[1].wait(timeout=120):
-            logger.error("TRADE 1 timed out (cross)")
-        if not self.eventFlags[2].wait(timeout=120):
-            logger.error("TRADE 2 timed out (cross)")
-
-        self.eventFlags[1].clear()
-        self.eventFlags[2].clear()
+            },
+        ]
+        with wallets_lock:
+            for td in legs:
+                fund_follow_up(td)
+        return self._submit(route_label(route), legs, 120, " (cross)")
 
     def trade(self, info):
-        with data_lock:
-            self.data[0] = {
+        legs = [
+            {
                 "side": "SELL", "exchange": info["A"],
                 "rate": info["info"]["A"], "volume": info["info"]["qtyA"],
                 "market": info["market"], "minOrderValue": info["info"]["minOrderValueA"],
                 "orderData": [],
-            }
-            self.data[1] = {
+            },
+            {
                 "side": "BUY", "exchange": info["B"],
                 "rate": info["info"]["B"], "volume": info["info"]["qtyB"],
                 "market": info["market"], "minOrderValue": info["info"]["minOrderValueB"],
                 "orderData": [],
-            }
-        self.eventFlags[0].set()
-        # Wait with timeouts to prevent infinite hang
-        if not self.eventFlags[1].wait(timeout=60):
-            logger.error("TRADE 1 timed out")
-        if not self.eventFlags[2].wait(timeout=60):
-            logger.error("TRADE 2 timed out")
+            },
+        ]
+        return self._submit(info["market"], legs, 60)
 
-        self.eventFlags[1].clear()
-        self.eventFlags[2].clear()
+    def _submit(self, label, legs, timeout, kind=""):
+        """Reserve the legs' funds and markets and queue them for a TRADE_WORKER.
 
-    def update_wallets(self):
+        Returns False, leaving the opportunity to a later pass, when every
+        worker is taken or a trade in flight uses one of the same markets.
+        """
+        if self.jobs is None:
+            return False
+        if reservations.in_flight() >= TRADE_WORKERS:
+            logger.debug("%s skipped: all %d trade workers busy", label, TRADE_WORKERS)
+            return False
+        amounts, trade_markets = trade_reservation(legs)
+        reservation = reservations.reserve(amounts, trade_markets)
+        if reservation is None:
+            logger.debug("%s skipped: a trade on one of its markets is in flight", label)
+            return False
+        self.jobs.put({
+            "label": label, "legs": legs, "timeout": timeout, "kind": kind, "reservation": reservation,
+        })
+        return True
+
+
+def update_wallets():
+    """Refresh balances after a trade; exchanges with a live balance stream are already current."""
+    polled = {e_name: obj for e_name, obj in exchanges.items() if not wallet_tracker.live(e_name)}
+    if polled:
         sleep(1)
-        for e_name, obj in exchanges.items():
-            funds = None
-            for attempt in range(3):
-                funds = obj.getBalances()
-                if funds is not None:
-                    break
-                sleep(1)
+    for e_name, obj in polled.items():
+        funds = None
+        for attempt in range(3):
+            funds = obj.getBalances()
             if funds is not None:
-                with wallets_lock:
-                    wallets[e_name] = funds
-            else:
-                logger.error("Failed to update wallets for %s after 3 attempts", e_name)
-        print_wallets()
+                break
+            sleep(1)
+        if funds is not None:
+            with wallets_lock:
+                wallets[e_name] = funds
+        else:
+            logger.error("Failed to update wallets for %s after 3 attempts", e_name)
+    print_wallets()
 
 
 def print_wallets():
@@ -1338,7 +2177,6 @@ if __name__ == "__main__":
         market_info=market_info,
         routes=routes,
         exchanges=exchanges,
-        order_book_lock=order_book_lock,
         wallets_lock=wallets_lock,
         comparisons_lock=comparisons_lock,
         latest_comparisons=latest_comparisons,
@@ -1347,6 +2185,7 @@ if __name__ == "__main__":
         currencies=currencies,
         selected_currencies=selected_currencies,
         markets=markets,
+        metadata_cache=metadata_cache,
     )
     start_api_server(port=8000)
 
@@ -1355,24 +2194,57 @@ if __name__ == "__main__":
     logger.info("Initializing wallets...")
     init_wallets()
 
-    e = [threading.Event(), threading.Event(), threading.Event()]
-    data = [{}, {}]
+    recorder = None
+    if RECORD_DIR:
+        recorder = MARKET_RECORDER(RECORD_DIR, recording_meta(), rotate_bytes=RECORD_ROTATE_BYTES)
+        recorder.start()
 
-    binance_ob = BINANCE_ORDER_BOOK(1, "BINANCE_ORDER_BOOK", order_books["binance"], binance_api_details)
-    kraken_ob = KRAKEN_ORDER_BOOK(2, "KRAKEN_ORDER_BOOK", order_books["kraken"])
-    main = MAIN2(3, "MAIN_LOOP", e, data)
-    trade1 = TRADE(4, "TRADE_1", 1, data, e)
-    trade2 = TRADE(5, "TRADE_2", 2, data, e)
+    binance_ob = BINANCE_ORDER_BOOK(
+        1, "BINANCE_ORDER_BOOK", order_books["binance"], binance_api_details,
+        on_update=book_updates.notify, mode=BINANCE_BOOK_MODE, depth=BINANCE_BOOK_DEPTH,
+        precisions=book_precisions("binance"), ticks=TICK_BOOKS, recorder=recorder, client=exchanges["binance"],
+    )
+    kraken_ob = KRAKEN_ORDER_BOOK(
+        2, "KRAKEN_ORDER_BOOK", order_books["kraken"], on_update=book_updates.notify,
+        depth=KRAKEN_BOOK_DEPTH, precisions=book_precisions("kraken"), ticks=TICK_BOOKS,
+        recorder=recorder, ws_url=kraken_api_details["WS_URL"], publish_depth=KRAKEN_PUBLISH_DEPTH,
+    )
+    trade_threads = []
+    if ORDER_EXECUTOR == "asyncio":
+        order_executor = ASYNC_EXECUTOR(4, "ORDER_EXECUTOR")
+        trade_threads.append(order_executor)
+    trade_jobs = queue.Queue()
+    trade_threads += [TRADE_WORKER(10 + i, "TRADE_WORKER_%d" % (i + 1), trade_jobs) for i in range(TRADE_WORKERS)]
+    main = MAIN2(3, "MAIN_LOOP", trade_jobs)
 
     binance_ob.daemon = True
     kraken_ob.daemon = True
 
+    if HTTP_KEEP_WARM > 0:
+        KEEP_WARM(list(exchanges.values()), interval=HTTP_KEEP_WARM).start()
+    if KRAKEN_ORDER_TRANSPORT == "ws" and not DRY_RUN:
+        # Connect up front so the first order does not wait for the token and handshake
+        exchanges["kraken"].connect()
+    if USER_STREAMS and not DRY_RUN:
+        BINANCE_USER_STREAM(
+            6, "BINANCE_USER_STREAM", binance_api_details, fill_tracker, wallets=wallet_tracker,
+        ).start()
+        KRAKEN_USER_STREAM(
+            7, "KRAKEN_USER_STREAM", exchanges["kraken"], fill_tracker, ws_url=kraken_api_details["WS_AUTH_URL"],
+            wallets=wallet_tracker,
+        ).start()
+        if BALANCE_RECONCILE_INTERVAL > 0:
+            WALLET_RECONCILER(
+                exchanges, wallet_tracker, interval=BALANCE_RECONCILE_INTERVAL,
+                busy=lambda: reservations.in_flight() > 0,
+            ).start()
+
     logger.info("Starting threads...")
     binance_ob.start()
     kraken_ob.start()
     main.start()
-    trade1.start()
-    trade2.start()
+    for thread in trade_threads:
+        thread.start()
 
     # Keep main thread alive
     try:
@@ -1380,3 +2252,8 @@ if __name__ == "__main__":
             sleep(60)
     except KeyboardInterrupt:
         logger.info("Shutting down...")
+        episodes.close_all()
+        rollups.flush(force=True)
+        db_writer().flush()
+        if recorder:
+            recorder.stop()
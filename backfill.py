@@ -0,0 +1,31 @@
+"""Fill the hourly and daily opportunity rollups from the opportunities table.
+
+    python backfill.py [--since YYYY-MM-DD] [--until YYYY-MM-DD]
+
+The bot keeps the rollups current from every opportunity tick; run this once
+after creating the rollup tables on an existing database. Hours the bot has
+already rolled up are kept, since opportunities only holds sampled ticks.
+Days are filled one transaction each, so the bot may keep running.
+"""
+import argparse
+import logging
+from datetime import date
+
+from dotenv import load_dotenv
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill opportunity rollups from the opportunities table")
+    parser.add_argument("--since", type=date.fromisoformat, default=None, help="First day (default: oldest row)")
+    parser.add_argument("--until", type=date.fromisoformat, default=None, help="Last day (default: newest row)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    load_dotenv()
+    # saveToDb reads DB_* when imported
+    from saveToDb import backfill_rollups
+    days = backfill_rollups(args.since, args.until)
+    logging.getLogger(__name__).info("Filled %d days of rollups", days)
+
+
+if __name__ == "__main__":
+    main()
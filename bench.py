@@ -0,0 +1,291 @@
+"""Hot-path benchmarks with a stored regression baseline.
+
+    python bench.py                       # run and compare against bench_baseline.json
+    python bench.py --update-baseline     # run and overwrite the baseline
+    python bench.py --currencies 50       # scale the synthetic market set
+
+Each repeat of a benchmark is timed between two runs of a fixed calibration
+loop, and its throughput relative to that loop (median of the repeats) is
+compared with the baseline: a slower or busier host slows both alike, so the
+same baseline holds across machines. The run fails when any benchmark is
+slower than the baseline by more than --tolerance; the ops/s printed are
+scaled to the baseline's host. Books are synthetic and priced below every
+fee threshold, so nothing touches the network or the DB.
+"""
+import gc
+import os
+import sys
+import json
+import random
+import statistics
+import argparse
+import itertools
+from time import perf_counter
+from decimal import Decimal
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+BOOK_LEVELS = 20
+REPEATS = 21
+MIN_TIME = 0.05  # seconds per repeat
+# Calibration workload: the Decimal arithmetic and list walking the hot paths are made of
+CALIBRATION_LEVELS = [(Decimal("0.0005") + Decimal(i) / 100000, Decimal(i % 7 + 1)) for i in range(20)]
+CALIBRATION_RATE = Decimal("0.0005")
+
+
+def _synthetic_config(n_currencies):
+    """Two bases (BTC, ETH) plus n trade currencies listed against both."""
+    trades = ["T%02d" % i for i in range(n_currencies)]
+    pairs = ["ETH/BTC"] + ["%s/%s" % (t, b) for t in trades for b in ("BTC", "ETH")]
+    return ["BTC", "ETH"] + trades, pairs
+
+
+def setup(n_currencies, seed=1):
+    """Import arby for a synthetic market set and fill every book; returns (arby, MAIN2)."""
+    currencies, pairs = _synthetic_config(n_currencies)
+    os.environ.update({
+        "ARBY_CURRENCIES": ",".join(currencies),
+        "ARBY_PAIRS": ",".join(pairs),
+        "ARBY_CURRENCY_BASES": "",
+        "ARBY_DRY_RUN": "true",
+    })
+    sys.argv = sys.argv[:1]
+    import arby
+    from orderBook import TICK_LEVELS, to_ticks, publish_book
+
+    # The books are published once: without this they turn stale mid-run, and every
+    # route then takes the early return, so throughput would depend on elapsed time
+    arby.MAX_BOOK_AGE = float("inf")
+
+    rng = random.Random(seed)
+    mids = {"ETHBTC": Decimal("0.05")}
+    for market, m in arby.markets.items():
+        if market not in mids:
+            btc = Decimal(str(round(rng.uniform(0.000001, 0.001), 8)))
+            mids[market] = btc if m["base"] == "BTC" else (btc / mids["ETHBTC"]).quantize(Decimal("1e-8"))
+    for ex in arby.exchanges:
+        arby.market_info[ex] = {
+            m: {
+                "minOrderValueBTC": Decimal("0.0001"), "minOrderValueETH": Decimal("0.001"),
+                "tradeFees": Decimal("0.001"), "ratePrecision": 8,
+                "minTradeVolume": Decimal("0.001"), "volumePrecision": 4,
+            }
+            for m in arby.markets
+        }
+        arby.wallets[ex] = {
+            c: {"available": Decimal("10"), "reserved": Decimal("0"), "total": Decimal("10")}
+            for c in arby.currencies
+        }
+        for market in arby.markets:
+            # Within +/-0.02% across exchanges: every route stays below its fee threshold
+            mid = mids[market] * (1 + Decimal(rng.randint(-2, 2)) / 10000)
+            step = mid / 10000
+            buy = [[(mid - step * (i + 1)).quantize(Decimal("1e-8")), Decimal("100")] for i in range(BOOK_LEVELS)]
+            sell = [[(mid + step * (i + 1)).quantize(Decimal("1e-8")), Decimal("100")] for i in range(BOOK_LEVELS)]
+            if arby.TICK_BOOKS:
+                buy = TICK_LEVELS([to_ticks(p, 8) for p, _ in buy], [to_ticks(q, 4) for _, q in buy], 8, 4)
+                sell = TICK_LEVELS([to_ticks(p, 8) for p, _ in sell], [to_ticks(q, 4) for _, q in sell], 8, 4)
+            publish_book(arby.order_books[ex], market, buy, sell)
+    return arby, arby.MAIN2(3, "MAIN_LOOP")
+
+
+def calibration():
+    """The fixed workload every benchmark is measured against."""
+    total = Decimal("0")
+    for price, qty in CALIBRATION_LEVELS:
+        if price >= CALIBRATION_RATE:
+            total += price * qty
+    return total
+
+
+def measure(fn, repeats=REPEATS, min_time=MIN_TIME):
+    """Calls per second of fn(), and fn's throughput relative to calibration().
+
+    Every repeat of fn is timed between two of calibration(), and each
+    figure is the median over the repeats. The GC is paused as in timeit.
+    """
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return _measure(fn, repeats, min_time)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def _loops(fn, min_time):
+    """A loop count that runs fn for about min_time, and the time it took."""
+    loops = 1
+    while True:
+        elapsed = _time(fn, loops)
+        if elapsed >= min_time:
+            return loops, elapsed
+        loops *= 2 if elapsed == 0 else max(2, int(min_time / elapsed))
+
+
+def _time(fn, loops):
+    start = perf_counter()
+    for _ in range(loops):
+        fn()
+    return perf_counter() - start
+
+
+def _measure(fn, repeats, min_time):
+    loops, _ = _loops(fn, min_time)
+    cal_loops, _ = _loops(calibration, min_time)
+    before = _time(calibration, cal_loops) / cal_loops
+    ops, relative = [], []
+    for _ in range(repeats):
+        elapsed = _time(fn, loops) / loops
+        after = _time(calibration, cal_loops) / cal_loops
+        ops.append(1 / elapsed)
+        relative.append((before + after) / 2 / elapsed)
+        before = after
+    return statistics.median(ops), statistics.median(relative)
+
+
+def _priced_best(arby, main, route, A="binance", B="kraken"):
+    """Exact info for one route, run through calc_rates/calc_r, ready for calc_volumes*."""
+    if route["type"] == "direct":
+        best = {"info": main.get_market_info(A, B, route["market"], exact=True),
+                "A": A, "B": B, "market": route["market"], "makeTrade": False}
+        return main.calc_r(main.calc_rates(best))
+    if route["type"] == "multi_leg":
+        best = {"info": main.get_multi_leg_info(A, B, route, exact=True),
+                "A": A, "B": B, "route": route, "makeTrade": False}
+        return main.calc_r_multi_leg(main.calc_rates_multi_leg(best))
+    best = {"info": main.get_cross_info(A, B, route, exact=True),
+            "A": A, "B": B, "route": route, "makeTrade": False}
+    return main.calc_r_cross(main.calc_rates_cross(best))
+
+
+def benchmarks(arby, main):
+    """Return {name: zero-argument callable} for every hot path."""
+    from krakenOrderBook import KRAKEN_ORDER_BOOK, kraken_checksum
+    from binanceOrderBook import BINANCE_ORDER_BOOK
+    from orderBook import empty_book
+
+    by_type = {}
+    for route in arby.routes:
+        by_type.setdefault(route["type"], route)
+    direct, multi_leg, cross = by_type["direct"], by_type["multi_leg"], by_type["cross"]
+    market = direct["market"]
+
+    # Kraken incremental updates on a seeded depth-10 book, as parsed from JSON
+    kraken = KRAKEN_ORDER_BOOK(2, "KRAKEN_ORDER_BOOK", {market: empty_book()}, depth=10)
+    kraken_market = arby.order_books["kraken"][market]
+    bids = [{"price": p, "qty": q} for p, q in kraken_market["buy"][:10]]
+    asks = [{"price": p, "qty": q} for p, q in kraken_market["sell"][:10]]
+    kraken._apply_snapshot(market, {"bids": bids, "asks": asks})
+    updates = [
+        {"bids": [{"price": bids[i % 10]["price"], "qty": Decimal(i % 7 + 1)}],
+         "asks": [{"price": asks[(i * 3) % 10]["price"], "qty": Decimal(i % 5 + 1)}]}
+        for i in range(64)
+    ]
+    update_iter = itertools.cycle(updates)
+    checksum_bids = [[p, q] for p, q in kraken_market["buy"][:10]]
+    checksum_asks = [[p, q] for p, q in kraken_market["sell"][:10]]
+
+    binance = BINANCE_ORDER_BOOK(1, "BINANCE_ORDER_BOOK", {}, {})
+    raw_levels = [["%.8f" % p, "%.8f" % q] for p, q in arby.order_books["binance"][market]["sell"][:20]]
+
+    best_direct = _priced_best(arby, main, direct)
+    best_multi = _priced_best(arby, main, multi_leg)
+    best_cross = _priced_best(arby, main, cross)
+    # Walks ten levels before the rate stops matching
+    deep_bid = arby.order_books["binance"][market]["buy"][9][0]
+
+    return {
+        "kraken_apply_update": lambda: kraken._apply_update(market, next(update_iter)),
+        "kraken_checksum": lambda: kraken_checksum(checksum_bids, checksum_asks, 8, 4),
+        "binance_convert_order_data": lambda: binance._convert_order_data(raw_levels),
+        "get_market_info": lambda: main.get_market_info("binance", "kraken", market),
+        "get_multi_leg_info": lambda: main.get_multi_leg_info("binance", "kraken", multi_leg),
+        "get_cross_info": lambda: main.get_cross_info("binance", "kraken", cross),
+        "calc_volumes": lambda: main.calc_volumes(best_direct),
+        "calc_volumes_multi_leg": lambda: main.calc_volumes_multi_leg(best_multi),
+        "calc_volumes_cross": lambda: main.calc_volumes_cross(best_cross),
+        "get_order_book_value": lambda: main.get_order_book_value(deep_bid, "buy", "binance", market),
+        "compare_full": main.compare,
+        "compare_vectorized_full": main.compare_vectorized,
+    }
+
+
+def run(n_currencies, only=None):
+    arby, main = setup(n_currencies)
+    results = {}
+    relative = {}
+    for name, fn in benchmarks(arby, main).items():
+        if only and name not in only:
+            continue
+        ops, ratio = measure(fn)
+        results[name] = round(ops, 1)
+        relative[name] = round(ratio, 6)
+    config = {"currencies": n_currencies, "routes": len(arby.routes), "book_repr": arby.BOOK_REPR}
+    return config, results, relative
+
+
+def compare_to_baseline(config, results, relative, baseline, tolerance):
+    """Return a list of (name, current, baseline, ratio, failed) rows.
+
+    ratio compares throughput relative to the calibration loop; current is
+    this run's ops/s as they would be on the baseline's host.
+    """
+    if baseline.get("config") != config:
+        raise SystemExit("Baseline was recorded for %s, this run is %s; use --update-baseline"
+                         % (baseline.get("config"), config))
+    if "relative" not in baseline:
+        raise SystemExit("Baseline has no calibration-relative figures; use --update-baseline")
+    rows = []
+    for name, ops in results.items():
+        reference = baseline["results"].get(name)
+        if reference is None:
+            rows.append((name, ops, None, None, False))
+            continue
+        ratio = relative[name] / baseline["relative"][name]
+        rows.append((name, reference * ratio, reference, ratio, ratio < 1 - tolerance))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the order-book and route-evaluation hot paths")
+    parser.add_argument("--currencies", type=int, default=10, help="Synthetic trade currencies (default 10)")
+    parser.add_argument("--tolerance", type=float, default=0.35,
+                        help="Allowed throughput drop vs the baseline, as a fraction (default 0.35)")
+    parser.add_argument("--baseline", default=BASELINE_FILE, help="Baseline JSON file")
+    parser.add_argument("--update-baseline", action="store_true", help="Overwrite the baseline with this run")
+    parser.add_argument("--only", nargs="*", help="Run only these benchmarks")
+    args = parser.parse_args()
+
+    config, results, relative = run(args.currencies, only=args.only)
+    print("config: %s" % json.dumps(config))
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"config": config, "results": results, "relative": relative}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        for name, ops in results.items():
+            print("%-28s %14.1f ops/s" % (name, ops))
+        print("Baseline written to %s" % args.baseline)
+        return
+
+    if not os.path.exists(args.baseline):
+        raise SystemExit("No baseline at %s; run with --update-baseline first" % args.baseline)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    failed = False
+    for name, current, reference, ratio, regressed in compare_to_baseline(config, results, relative, baseline, args.tolerance):
+        if reference is None:
+            print("%-28s %14.1f ops/s  (no baseline)" % (name, current))
+            continue
+        failed = failed or regressed
+        print("%-28s %14.1f ops/s  baseline %14.1f  %+6.1f%%%s" % (
+            name, current, reference, (ratio - 1) * 100, "  REGRESSION" if regressed else "",
+        ))
+    if failed:
+        print("Throughput regressed by more than %.0f%%" % (args.tolerance * 100))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,104 @@
 import threading
 import logging
 import functools
-from time import time, sleep
+from time import sleep, time, perf_counter
 from decimal import Decimal
-from binance import ThreadedWebsocketManager
+import asyncio
+from binance import AsyncClient, ThreadedWebsocketManager
+from binance.ws.websocket_api import WebsocketAPI
+
+from orderBook import SORTED_BOOK, TICK_LEVELS, to_ticks, publish_book, clear_book
+from metrics import FEED_LAG, BOOK_APPLY
 
 logger = logging.getLogger(__name__)
 
+# "partial": top-N snapshot per message; "diff": local book kept from the @depth@100ms diff stream
+BINANCE_BOOK_MODES = ("partial", "diff")
+# /api/v3/depth limits Binance accepts; up to 100 levels all weigh the same 5
+SNAPSHOT_LIMITS = (5, 10, 20, 50, 100, 500, 1000, 5000)
+SNAPSHOT_RETRIES = 5
+
+
+def snapshot_limit(depth):
+    """Levels to seed a diff-mode book of `depth` levels with: the cheapest limit covering it."""
+    return next((limit for limit in SNAPSHOT_LIMITS if limit >= max(depth, 100)), SNAPSHOT_LIMITS[-1])
+
+
+class CUSTOM_URL_WEBSOCKET_MANAGER(ThreadedWebsocketManager):
+    """ThreadedWebsocketManager whose REST and stream base URLs can be overridden.
+
+    python-binance builds its URLs from fixed Binance hosts; this points them
+    at another server (e.g. exchangeSim.py). It also skips the ping/time
+    calls AsyncClient.create() makes, which depth streams do not need.
+    ws_api_url moves the WebSocket API, which carries the user data stream.
+    """
+
+    def __init__(self, api_url, stream_url, ws_api_url=None, **kwargs):
+        super().__init__(**kwargs)
+        self._api_url = api_url.rstrip("/") + "/api"
+        self._stream_url = stream_url.rstrip("/") + "/" if stream_url else None
+        self._ws_api_url = ws_api_url
+
+    async def socket_listener(self):
+        try:
+            self._client = AsyncClient(loop=self._loop, **self._client_params)
+            self._client.API_URL = self._api_url
+            if self._ws_api_url:
+                self._client.ws_api = WebsocketAPI(url=self._ws_api_url)
+            await self._before_socket_listener_start()
+            if self._stream_url:
+                self._bsm.STREAM_URL = self._stream_url
+        except Exception as e:
+            logger.error("Failed to create Binance client: %s", e)
+            self.stop()
+        while self._running:
+            await asyncio.sleep(0.2)
+        while self._socket_running:
+            await asyncio.sleep(0.2)
+
 
 class BINANCE_ORDER_BOOK(threading.Thread):
-    def __init__(self, threadId, name, order_book, api_details):
+    def __init__(self, threadId, name, order_book, api_details, on_update=None, mode="partial", depth=20,
+                 precisions=None, ticks=False, recorder=None, auto_snapshot=True, client=None):
         threading.Thread.__init__(self)
         self.threadId = threadId
         self.name = name
         self.order_book = order_book
         self.api_details = api_details
+        # Called with (exchange, market) after a book changes
+        self.on_update = on_update
+        if mode not in BINANCE_BOOK_MODES:
+            raise ValueError("Binance book mode must be one of %s" % (BINANCE_BOOK_MODES,))
+        self.mode = mode
+        # Levels published per side in diff mode (partial mode always streams 20)
+        self.depth = depth
+        # market -> (price precision, qty precision) for books stored as integer ticks
+        self.tick_precisions = (precisions or {}) if ticks else {}
+        # Optional MARKET_RECORDER receiving every stream message and REST snapshot
+        self.recorder = recorder
+        # Fetch diff-mode snapshots from REST; off when a replay feeds recorded snapshots
+        self.auto_snapshot = auto_snapshot
+        # BINANCE REST client the snapshots go through, so they count against its request weight
+        self.client = client
+        if mode == "diff" and auto_snapshot and client is None:
+            raise ValueError("Binance diff mode needs a REST client for its depth snapshots")
         self.reset_time = 108000
         self.twm = None
+        # Set by a stream whose read loop died (e.g. queue overflow); run() restarts the sockets
+        self._restart = threading.Event()
+        self._feed_lag = FEED_LAG.labels("binance")
+        self._book_apply = BOOK_APPLY.labels("binance")
+        # Diff mode: symbol -> local book and update-id sync state
+        self._diff_books = {}
+        self._diff_lock = threading.Lock()
 
     def run(self):
         while True:
             try:
+                self._restart.clear()
                 self._start_ws()
-                sleep(self.reset_time)
+                if self._restart.wait(self.reset_time):
+                    logger.warning("Binance WS read loop closed, restarting")
                 self._stop_ws()
             except Exception as e:
                 logger.error("Binance WS error: %s", e)
@@ -32,25 +108,166 @@ class BINANCE_ORDER_BOOK(threading.Thread):
     def _convert_order_data(self, res):
         return [[Decimal(r[0]), Decimal(r[1])] for r in res]
 
+    def _convert_order_ticks(self, res, precision):
+        pp, qp = precision
+        return TICK_LEVELS([to_ticks(r[0], pp) for r in res], [to_ticks(r[1], qp) for r in res], pp, qp)
+
+    def _parse_level(self, symbol, price, qty):
+        precision = self.tick_precisions.get(symbol)
+        if precision:
+            return to_ticks(price, precision[0]), to_ticks(qty, precision[1])
+        return Decimal(price), Decimal(qty)
+
     def _process_message(self, msg, symbol=None):
+        received = perf_counter()
+        if self.recorder:
+            self.recorder.record("binance", msg, symbol)
         if msg.get("e") == "error":
+            if msg.get("type") == "ReadLoopClosed":
+                # python-binance keeps returning this until the socket is reset
+                self._restart.set()
+                return
             logger.error("Binance WS stream error: %s", msg)
             return
-        if "asks" in msg and "bids" in msg:
-            self.order_book[symbol]["sell"] = self._convert_order_data(msg["asks"])
-            self.order_book[symbol]["buy"] = self._convert_order_data(msg["bids"])
-            self.order_book[symbol]["lastUpdate"] = time()
+        if msg.get("e") == "depthUpdate":
+            # E: event time in ms (partial-depth messages carry no time)
+            if "E" in msg:
+                self._feed_lag.observe(max(0.0, time() - msg["E"] / 1000))
+            self._process_diff(msg, symbol)
+            self._book_apply.observe(perf_counter() - received)
+        elif "asks" in msg and "bids" in msg:
+            precision = self.tick_precisions.get(symbol)
+            if precision:
+                sell = self._convert_order_ticks(msg["asks"], precision)
+                buy = self._convert_order_ticks(msg["bids"], precision)
+            else:
+                sell = self._convert_order_data(msg["asks"])
+                buy = self._convert_order_data(msg["bids"])
+            publish_book(self.order_book, symbol, buy, sell)
+            self._book_apply.observe(perf_counter() - received)
+            if self.on_update:
+                self.on_update("binance", symbol)
+
+    # --- Diff-depth local book ---
+
+    def _new_diff_book(self):
+        return {
+            "bids": SORTED_BOOK(descending=True),
+            "asks": SORTED_BOOK(),
+            "lastUpdateId": None,  # u of the last applied event; None until seeded
+            "buffer": [],          # events received while the snapshot is in flight
+            "syncing": False,
+        }
+
+    def _process_diff(self, msg, symbol):
+        with self._diff_lock:
+            book = self._diff_books.setdefault(symbol, self._new_diff_book())
+            if book["lastUpdateId"] is not None:
+                if msg["u"] <= book["lastUpdateId"]:
+                    return
+                if msg["U"] <= book["lastUpdateId"] + 1:
+                    self._apply_diff(symbol, book, msg)
+                    self._publish_diff(symbol, book)
+                    return
+                logger.warning(
+                    "Binance depth gap for %s (expected U<=%d, got %d), resyncing",
+                    symbol, book["lastUpdateId"] + 1, msg["U"],
+                )
+                book = self._diff_books[symbol] = self._new_diff_book()
+                clear_book(self.order_book, symbol)
+            book["buffer"].append(msg)
+            if not book["syncing"] and self.auto_snapshot:
+                book["syncing"] = True
+                threading.Thread(target=self._sync_snapshot, args=(symbol,), daemon=True).start()
+
+    def _apply_diff(self, symbol, book, msg):
+        # Only the levels named in the event are parsed
+        for price, qty in msg["b"]:
+            book["bids"].set(*self._parse_level(symbol, price, qty))
+        for price, qty in msg["a"]:
+            book["asks"].set(*self._parse_level(symbol, price, qty))
+        book["lastUpdateId"] = msg["u"]
+
+    def _publish_diff(self, symbol, book):
+        precision = self.tick_precisions.get(symbol)
+        if precision:
+            buy = TICK_LEVELS(*book["bids"].columns(self.depth), *precision)
+            sell = TICK_LEVELS(*book["asks"].columns(self.depth), *precision)
+        else:
+            buy = book["bids"].levels(self.depth)
+            sell = book["asks"].levels(self.depth)
+        publish_book(self.order_book, symbol, buy, sell)
+        if self.on_update:
+            self.on_update("binance", symbol)
+
+    def _sync_snapshot(self, symbol):
+        """Seed a diff-mode book from REST, retrying while the snapshot predates the buffer."""
+        for attempt in range(SNAPSHOT_RETRIES):
+            try:
+                snapshot = self.client.getDepth(symbol, snapshot_limit(self.depth))
+                if self.recorder:
+                    self.recorder.record("binance", snapshot, symbol, kind="snapshot")
+                if self._apply_snapshot(symbol, snapshot):
+                    return
+            except Exception as e:
+                logger.error("Binance depth snapshot failed for %s: %s", symbol, e)
+            sleep(1)
+        logger.error("Binance depth snapshot for %s did not sync after %d attempts", symbol, SNAPSHOT_RETRIES)
+        with self._diff_lock:
+            # Let the next event trigger a fresh attempt
+            self._diff_books[symbol] = self._new_diff_book()
+
+    def _apply_snapshot(self, symbol, snapshot):
+        """Load a REST snapshot and replay buffered events; False if it is too old to bridge."""
+        with self._diff_lock:
+            book = self._diff_books.setdefault(symbol, self._new_diff_book())
+            if book["lastUpdateId"] is not None:
+                return True  # already seeded by a concurrent sync
+            last_id = snapshot["lastUpdateId"]
+            pending = [m for m in book["buffer"] if m["u"] > last_id]
+            if pending and pending[0]["U"] > last_id + 1:
+                return False
+            book["bids"].clear()
+            book["asks"].clear()
+            for price, qty in snapshot["bids"]:
+                book["bids"].set(*self._parse_level(symbol, price, qty))
+            for price, qty in snapshot["asks"]:
+                book["asks"].set(*self._parse_level(symbol, price, qty))
+            book["lastUpdateId"] = last_id
+            for i, msg in enumerate(pending):
+                if msg["U"] > book["lastUpdateId"] + 1:
+                    logger.warning("Binance depth gap in buffered events for %s, resyncing", symbol)
+                    book["lastUpdateId"] = None
+                    book["buffer"] = pending[i:]
+                    return False
+                self._apply_diff(symbol, book, msg)
+            book["buffer"] = []
+            book["syncing"] = False
+            self._publish_diff(symbol, book)
+        return True
 
     def _start_ws(self):
-        logger.info("Binance WS starting")
-        self.twm = ThreadedWebsocketManager(
-            api_key=self.api_details["API_KEY"],
-            api_secret=self.api_details["API_SECRET"],
-        )
+        logger.info("Binance WS starting (%s mode)", self.mode)
+        with self._diff_lock:
+            self._diff_books = {}
+        if self.api_details.get("WS_URL"):
+            self.twm = CUSTOM_URL_WEBSOCKET_MANAGER(
+                self.api_details["API_BASE_URL"], self.api_details["WS_URL"],
+                api_key=self.api_details["API_KEY"],
+                api_secret=self.api_details["API_SECRET"],
+            )
+        else:
+            self.twm = ThreadedWebsocketManager(
+                api_key=self.api_details["API_KEY"],
+                api_secret=self.api_details["API_SECRET"],
+            )
         self.twm.start()
         for pair in self.order_book:
             callback = functools.partial(self._process_message, symbol=pair)
-            self.twm.start_depth_socket(callback=callback, symbol=pair, depth=20)
+            if self.mode == "diff":
+                self.twm.start_depth_socket(callback=callback, symbol=pair, interval=100)
+            else:
+                self.twm.start_depth_socket(callback=callback, symbol=pair, depth=20)
 
     def _stop_ws(self):
         logger.info("Binance WS stopping")
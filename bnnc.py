@@ -5,26 +5,138 @@ import requests
 from time import time
 from decimal import Decimal
 
+from httpSession import pooled_session
+from rateLimit import TOKEN_BUCKET, PRIORITY_ORDER, PRIORITY_QUERY, PRIORITY_BACKGROUND
+
 logger = logging.getLogger(__name__)
 
+# Request weight per (method, path), from the Binance API docs; other requests weigh 1
+REQUEST_WEIGHTS = {
+    ("GET", "/api/v3/order"): 4,
+    ("GET", "/api/v3/account"): 20,
+    ("GET", "/api/v3/exchangeInfo"): 20,
+}
+# GET /api/v3/depth weight by its limit parameter: (largest limit, weight)
+DEPTH_WEIGHTS = ((100, 5), (500, 25), (1000, 50), (5000, 250))
+# Share of each published limit the buckets allow, for requests in flight when the
+# used-weight headers come back
+LIMIT_HEADROOM = 0.9
+# exchangeInfo filters getMarketInfo reads; the rest are dropped before caching
+USED_FILTERS = ("PRICE_FILTER", "LOT_SIZE", "MIN_NOTIONAL", "NOTIONAL")
+
+
+def depth_weight(limit):
+    """Request weight of an order book snapshot of `limit` levels."""
+    return next((weight for largest, weight in DEPTH_WEIGHTS if limit <= largest), DEPTH_WEIGHTS[-1][1])
+
+
+def parse_exchange_info(data):
+    """The parts of exchangeInfo the bot uses; the full payload runs to megabytes."""
+    return {
+        "symbols": [
+            {
+                "baseAsset": s["baseAsset"], "quoteAsset": s["quoteAsset"], "status": s.get("status"),
+                "filters": [f for f in s.get("filters", []) if f.get("filterType") in USED_FILTERS],
+            }
+            for s in data.get("symbols", [])
+        ],
+        "rateLimits": data.get("rateLimits", []),
+    }
+
 
 class BINANCE:
+    PING_PATH = "/api/v3/ping"
+
     @staticmethod
-    def discover_pairs():
+    def discover_pairs(base_url="https://api.binance.com", session=None, cache=None):
         """Query Binance exchangeInfo and return set of (baseAsset, quoteAsset) for active pairs."""
-        res = requests.get("https://api.binance.com/api/v3/exchangeInfo", timeout=15)
-        res.raise_for_status()
-        data = res.json()
+        def fetch():
+            res = (session or requests).get(base_url + "/api/v3/exchangeInfo", timeout=15)
+            res.raise_for_status()
+            return parse_exchange_info(res.json())
+
+        data = cache.get(cache.key("binance-exchangeInfo", base_url), fetch) if cache else fetch()
+        if data is None:
+            raise RuntimeError("Binance exchangeInfo unavailable")
         return {
             (s["baseAsset"], s["quoteAsset"])
             for s in data.get("symbols", [])
             if s.get("status") == "TRADING"
         }
 
-    def __init__(self, api_details, currencies):
+    def __init__(self, api_details, currencies, pool_size=4, retries=2, cache=None):
         self.api_details = api_details
         self.currencies = currencies
         self.name = "binance"
+        # METADATA_CACHE for exchangeInfo; None fetches it on every call
+        self.cache = cache
+        # Client order id -> order data of orders closed on placement, until placedOrderData() takes it
+        self._closed = {}
+        # Keep-alive connection pool shared by every REST call
+        self.session = pooled_session(pool_size, retries)
+        self.last_request = 0
+        # REQUEST_WEIGHT per minute and ORDERS per 10 seconds, until exchangeInfo gives the real limits
+        self.weight_limit = TOKEN_BUCKET("binance weight", 6000 * LIMIT_HEADROOM, 6000 / 60)
+        self.order_limit = TOKEN_BUCKET("binance orders", 100 * LIMIT_HEADROOM, 100 / 10)
+
+    def ping(self):
+        """Unsigned request that keeps a pooled connection open."""
+        self.weight_limit.acquire(1, PRIORITY_BACKGROUND)
+        self.last_request = time()
+        res = self.session.get(self.api_details["API_BASE_URL"] + self.PING_PATH, timeout=10)
+        self._sync_limits(res.status_code, res.headers)
+
+    async def pingAsync(self, session):
+        await self.weight_limit.acquire_async(1, PRIORITY_BACKGROUND)
+        async with session.get(self.api_details["API_BASE_URL"] + self.PING_PATH) as res:
+            await res.read()
+            self._sync_limits(res.status, res.headers)
+
+    def getDepth(self, symbol, limit):
+        """REST order book snapshot of `limit` levels, weighed against the shared request weight."""
+        self.weight_limit.acquire(depth_weight(limit), PRIORITY_BACKGROUND)
+        self.last_request = time()
+        res = self.session.get(
+            self.api_details["API_BASE_URL"] + "/api/v3/depth", params={"symbol": symbol, "limit": limit}, timeout=10,
+        )
+        self._sync_limits(res.status_code, res.headers)
+        res.raise_for_status()
+        return res.json()
+
+    def _limits(self, url_part, method):
+        """[(bucket, cost)] for a request, and its queue priority."""
+        method = "GET" if method == "simple_get" else method.upper()
+        path = url_part.rstrip("?")
+        limits = [(self.weight_limit, REQUEST_WEIGHTS.get((method, path), 1))]
+        if path == "/api/v3/order":
+            if method == "POST":
+                limits.append((self.order_limit, 1))
+            return limits, PRIORITY_QUERY if method == "GET" else PRIORITY_ORDER
+        return limits, PRIORITY_BACKGROUND
+
+    def _sync_limits(self, status, headers):
+        """Follow the used weight/order count Binance reports, and back off on 429/418."""
+        used = headers.get("X-MBX-USED-WEIGHT-1M")
+        if used is not None:
+            self.weight_limit.sync(int(used))
+        orders = headers.get("X-MBX-ORDER-COUNT-10S")
+        if orders is not None:
+            self.order_limit.sync(int(orders))
+        if status in (418, 429):
+            retry_after = int(headers.get("Retry-After") or 60)
+            logger.error("Binance rate limit hit (%s), pausing requests for %ds", status, retry_after)
+            self.weight_limit.hold(retry_after)
+            self.order_limit.hold(retry_after)
+
+    def _configure_limits(self, rate_limits):
+        """Size the buckets from exchangeInfo's rateLimits."""
+        seconds = {"SECOND": 1, "MINUTE": 60, "HOUR": 3600, "DAY": 86400}
+        for rl in rate_limits:
+            window = seconds.get(rl.get("interval"), 0) * rl.get("intervalNum", 1)
+            if rl.get("rateLimitType") == "REQUEST_WEIGHT" and window == 60:
+                self.weight_limit.configure(rl["limit"] * LIMIT_HEADROOM, rl["limit"] / window)
+            elif rl.get("rateLimitType") == "ORDERS" and window == 10:
+                self.order_limit.configure(rl["limit"] * LIMIT_HEADROOM, rl["limit"] / window)
 
     def auth(self, query):
         return hmac.new(
@@ -33,7 +145,8 @@ class BINANCE:
             hashlib.sha256,
         ).hexdigest()
 
-    def req(self, url_part, query, method):
+    def _signed(self, url_part, query):
+        """Return (url, headers) for a signed request."""
         timestamp = str(int(time() * 1000))
         query += "timestamp=" + timestamp
         api_sign = self.auth(query)
@@ -44,34 +157,74 @@ class BINANCE:
             "User-Agent": "binance/python",
             "X-MBX-APIKEY": self.api_details["API_KEY"],
         }
+        return url, header
 
+    def req(self, url_part, query, method):
+        limits, priority = self._limits(url_part, method)
+        for bucket, cost in limits:
+            bucket.acquire(cost, priority)
+        url, header = self._signed(url_part, query)
+
+        self.last_request = time()
         try:
             if method == "simple_get":
                 url = url.split("?")[0]
-                res = requests.get(url, headers=header, timeout=10)
+                res = self.session.get(url, headers=header, timeout=10)
             elif method == "get":
-                res = requests.get(url, headers=header, timeout=10)
+                res = self.session.get(url, headers=header, timeout=10)
             elif method == "post":
-                res = requests.post(url, headers=header, timeout=10)
+                res = self.session.post(url, headers=header, timeout=10)
             elif method == "delete":
-                res = requests.delete(url, headers=header, timeout=10)
+                res = self.session.delete(url, headers=header, timeout=10)
             else:
                 return None
         except Exception as e:
             logger.error("Binance request failed (%s): %s", url_part, e)
             return None
 
+        self._sync_limits(res.status_code, res.headers)
         if not res.ok:
             logger.error("Binance API error %s: %s", res.status_code, res.text)
         return res
 
+    async def req_async(self, session, url_part, query, method):
+        """req() over an aiohttp session; returns (status, decoded body) or None."""
+        if method not in ("get", "post", "delete"):
+            return None
+        limits, priority = self._limits(url_part, method)
+        for bucket, cost in limits:
+            await bucket.acquire_async(cost, priority)
+        url, header = self._signed(url_part, query)
+        try:
+            async with session.request(method.upper(), url, headers=header) as res:
+                body = await res.json(content_type=None)
+                self._sync_limits(res.status, res.headers)
+                if res.status != 200:
+                    logger.error("Binance API error %s: %s", res.status, body)
+                return res.status, body
+        except Exception as e:
+            logger.error("Binance request failed (%s): %s", url_part, e)
+            return None
+
     def getOrderData(self, order_id, currency, base_currency):
         query = "symbol=%s&origClientOrderId=%s&" % (currency + base_currency, order_id)
         res = self.req("/api/v3/order?", query, "get")
         if res is None:
             return None
-        r = res.json()
+        return self._order_data(res.json())
+
+    async def getOrderDataAsync(self, session, order_id, currency, base_currency):
+        query = "symbol=%s&origClientOrderId=%s&" % (currency + base_currency, order_id)
+        res = await self.req_async(session, "/api/v3/order?", query, "get")
+        if res is None:
+            return None
+        return self._order_data(res[1])
 
+    def placedOrderData(self, order_id):
+        """Final order data from the response of an order that closed when placed, once; else None."""
+        return self._closed.pop(order_id, None)
+
+    def _order_data(self, r):
         if "clientOrderId" in r:
             return {
                 "quantity": r["origQty"],
@@ -113,12 +266,21 @@ class BINANCE:
             return 0 if filt["stepSize"][0] == "1" else len(filt["stepSize"].split(".")[1].split("1")[0]) + 1
         return None
 
-    def getMarketInfo(self, markets):
-        query = ""
-        res = self.req("/api/v3/exchangeInfo?", query, "simple_get")
+    def _exchange_info(self):
+        res = self.req("/api/v3/exchangeInfo?", "", "simple_get")
         if res is None:
             return None
-        r = res.json()
+        return parse_exchange_info(res.json())
+
+    def getMarketInfo(self, markets):
+        if self.cache:
+            key = self.cache.key("binance-exchangeInfo", self.api_details["API_BASE_URL"])
+            r = self.cache.get(key, self._exchange_info)
+        else:
+            r = self._exchange_info()
+        if r is None:
+            return None
+        self._configure_limits(r.get("rateLimits", []))
 
         if "symbols" in r:
             result = r["symbols"]
@@ -137,17 +299,31 @@ class BINANCE:
             }
         return None
 
-    def order(self, currency, base_currency, rate, volume, side):
-        query = "symbol=%s&side=%s&timeInForce=GTC&type=LIMIT&quantity=%.8f&price=%.8f&" % (
-            (currency + base_currency), side, volume, rate
+    def _order_query(self, currency, base_currency, rate, volume, side, time_in_force):
+        return "symbol=%s&side=%s&timeInForce=%s&type=LIMIT&quantity=%.8f&price=%.8f&" % (
+            (currency + base_currency), side, time_in_force, volume, rate
         )
+
+    def order(self, currency, base_currency, rate, volume, side, time_in_force="GTC"):
+        query = self._order_query(currency, base_currency, rate, volume, side, time_in_force)
         res = self.req("/api/v3/order?", query, "post")
         if res is None:
             return False
+        return self._order_placed(res.status_code, res.json())
 
-        r = res.json()
-        if res.status_code == 200:
+    async def orderAsync(self, session, currency, base_currency, rate, volume, side, time_in_force="GTC"):
+        query = self._order_query(currency, base_currency, rate, volume, side, time_in_force)
+        res = await self.req_async(session, "/api/v3/order?", query, "post")
+        if res is None:
+            return False
+        return self._order_placed(*res)
+
+    def _order_placed(self, status, r):
+        if status == 200:
             logger.info("Binance order placed: %s", r.get("clientOrderId"))
+            # IOC/FOK orders, and orders that filled in full, are already closed in the response
+            if r.get("status") not in (None, "NEW", "PARTIALLY_FILLED"):
+                self._closed[r["clientOrderId"]] = self._order_data(r)
             return r["clientOrderId"]
 
         logger.error("Binance order failed: %s", r)
@@ -158,8 +334,17 @@ class BINANCE:
         res = self.req("/api/v3/order?", query, "delete")
         if res is None:
             return False
-        r = res.json()
-        if res.status_code == 200:
+        return self._order_closed(order_id, res.status_code, res.json())
+
+    async def closeOrderAsync(self, session, order_id, currency, base_currency):
+        query = "origClientOrderId=%s&symbol=%s&" % (order_id, (currency + base_currency))
+        res = await self.req_async(session, "/api/v3/order?", query, "delete")
+        if res is None:
+            return False
+        return self._order_closed(order_id, *res)
+
+    def _order_closed(self, order_id, status, r):
+        if status == 200:
             logger.info("Binance order cancelled: %s", order_id)
             return True
         logger.warning("Binance cancel failed: %s", r)
@@ -0,0 +1,872 @@
+"""Local stand-in for the Binance and Kraken endpoints the bot uses, for load testing.
+
+    python exchangeSim.py --rate 10000 --synthetic 20
+
+REST (one HTTP port serves both exchanges):
+    Binance  GET /api/v3/exchangeInfo, /api/v3/depth, /api/v3/ping, /api/v3/time, /api/v3/account
+             POST, GET, DELETE /api/v3/order
+    Kraken   GET /0/public/AssetPairs, /0/public/Time
+             POST /0/private/AddOrder, CancelOrder, QueryOrders, OpenOrders, ClosedOrders, Balance,
+                  GetWebSocketsToken
+WebSocket (one port serves both exchanges):
+    Binance  /ws/<symbol>@depth<N>[@100ms] partial books, /ws/<symbol>@depth[@100ms] diff events
+             /ws-api/v3 userDataStream.subscribe.signature: executionReport, outboundAccountPosition
+    Kraken   /v2 book channel: snapshot and updates with CRC32 checksums
+             /v2 executions and balances channels; add_order, cancel_order
+
+Point the bot at it with
+    BINANCE_API_BASE_URL=http://127.0.0.1:8100  KRAKEN_API_BASE_URL=http://127.0.0.1:8100
+    BINANCE_WS_URL=ws://127.0.0.1:8101/         KRAKEN_WS_URL=ws://127.0.0.1:8101/v2
+    BINANCE_WS_API_URL=ws://127.0.0.1:8101/ws-api/v3  KRAKEN_WS_AUTH_URL=ws://127.0.0.1:8101/v2
+
+Prices follow a random walk per currency (quoted in BTC). Each exchange
+trades at its own offset from that price, which drifts within
+--dislocation. --rate book updates per second are spread over random
+(exchange, market) books. Kraken subscribers get every update; Binance
+streams get the changes batched every 100ms or 1000ms, as Binance sends them.
+Binance requests are weighed as Binance does and answered with the used-weight
+headers, and with 429 past the limit. Signatures are not checked; Kraken
+nonces are, per API key. A limit order fills in full if it crosses the
+book when submitted, otherwise it rests until cancelled. Balances move at
+the order price, without fees.
+"""
+import json
+import math
+import random
+import asyncio
+import logging
+import argparse
+import threading
+import itertools
+import urllib.parse
+from time import time
+from datetime import datetime, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from websockets.asyncio.server import serve, broadcast
+
+from krakenOrderBook import internal_to_ws_pair, kraken_checksum, CHECKSUM_DEPTH
+
+logger = logging.getLogger("exchangeSim")
+
+EXCHANGES = ("binance", "kraken")
+BASES = ("BTC", "ETH")
+PRICE_PRECISION = 8
+QTY_PRECISION = 4
+# Levels kept per side of every simulated book
+SIM_DEPTH = 25
+# Binance REQUEST_WEIGHT per minute and ORDERS per 10 seconds
+BINANCE_WEIGHT_LIMIT = 6000
+BINANCE_ORDER_LIMIT = 100
+BINANCE_WEIGHTS = {("GET", "order"): 4, ("GET", "account"): 20, ("GET", "exchangeInfo"): 20}
+BINANCE_STATUS = {"open": "NEW", "filled": "FILLED", "canceled": "CANCELED", "expired": "EXPIRED"}
+# Starting prices in BTC; other currencies get a random one
+START_PRICES = {"BTC": 1.0, "ETH": 0.05, "XLM": 0.000005, "XRP": 0.00001, "ADA": 0.000015}
+
+
+def fmt(ticks, precision):
+    """Integer ticks to a plain decimal string (never exponent form)."""
+    sign = "-" if ticks < 0 else ""
+    whole, frac = divmod(abs(ticks), 10 ** precision)
+    return "%s%d.%0*d" % (sign, whole, precision, frac)
+
+
+def to_kraken_asset_code(asset):
+    """Legacy Kraken asset code, e.g. BTC -> XXBT, ETH -> XETH."""
+    return "X" + ("XBT" if asset == "BTC" else asset)
+
+
+class SIM_BOOK:
+    """One exchange's book for one market, as integer price/qty ticks."""
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.bids = []  # [(price, qty)], best first
+        self.asks = []
+        self.update_id = 1
+        self.gap = None  # price grid step, fixed at the first move
+
+    def move(self, mid):
+        """Rebuild the levels around mid (in price ticks); returns (old bids, old asks).
+
+        Levels sit on a fixed price grid, so a small move only adds and
+        removes levels at the edges, as in a real book.
+        """
+        if self.gap is None:
+            self.gap = max(1, mid // 20000)  # ~0.5 bp between levels
+        gap = self.gap
+        best_bid = (mid - 1) // gap * gap
+        best_ask = (mid // gap + 1) * gap
+        old_bids, old_asks = self.bids, self.asks
+        self.bids = self._side(old_bids, [best_bid - gap * i for i in range(SIM_DEPTH)])
+        self.asks = self._side(old_asks, [best_ask + gap * i for i in range(SIM_DEPTH)])
+        # Some churn in the size of one level, as real books have
+        side = self.bids if self.rng.random() < 0.5 else self.asks
+        i = self.rng.randrange(len(side))
+        side[i] = (side[i][0], self.rng.randint(1, 10 ** (QTY_PRECISION + 2)))
+        self.update_id += 1
+        return old_bids, old_asks
+
+    def _side(self, old, prices):
+        kept = dict(old)
+        return [(p, kept.get(p) or self.rng.randint(1, 10 ** (QTY_PRECISION + 2))) for p in prices if p > 0]
+
+
+def level_changes(old, new):
+    """Levels to send so a client holding `old` ends up with `new` (qty 0 deletes)."""
+    new_map = dict(new)
+    changes = [(p, 0) for p, _ in old if p not in new_map]
+    old_map = dict(old)
+    changes.extend((p, q) for p, q in new if old_map.get(p) != q)
+    return changes
+
+
+class MARKET_SIM:
+    """Prices and books for every (exchange, market)."""
+
+    def __init__(self, currencies, volatility_bps, dislocation_bps, seed=None):
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.prices = {
+            c: START_PRICES.get(c) or 10 ** self.rng.uniform(-6, -3) for c in currencies
+        }
+        self.markets = {
+            trade + base: {"trade": trade, "base": base}
+            for trade in currencies for base in BASES
+            if trade != base and not (trade == "BTC" and base == "ETH")
+        }
+        self.volatility = volatility_bps / 10000
+        self.dislocation = dislocation_bps / 10000
+        self.offsets = {ex: {m: 0.0 for m in self.markets} for ex in EXCHANGES}
+        self.books = {ex: {m: SIM_BOOK(self.rng) for m in self.markets} for ex in EXCHANGES}
+        for ex in EXCHANGES:
+            for market in self.markets:
+                self.books[ex][market].move(self.mid_ticks(ex, market))
+
+    def mid_ticks(self, exchange, market):
+        m = self.markets[market]
+        price = self.prices[m["trade"]] / self.prices[m["base"]] * (1 + self.offsets[exchange][market])
+        return max(1, int(round(price * 10 ** PRICE_PRECISION)))
+
+    def step(self):
+        """Move one random book; returns (exchange, market, old bids, old asks)."""
+        exchange = self.rng.choice(EXCHANGES)
+        market = self.rng.choice(list(self.markets))
+        trade = self.markets[market]["trade"]
+        with self.lock:
+            if trade != "BTC":
+                self.prices[trade] *= math.exp(self.rng.gauss(0, self.volatility))
+            offset = self.offsets[exchange][market] + self.rng.gauss(0, self.dislocation / 4)
+            self.offsets[exchange][market] = max(-self.dislocation, min(self.dislocation, offset))
+            old_bids, old_asks = self.books[exchange][market].move(self.mid_ticks(exchange, market))
+        return exchange, market, old_bids, old_asks
+
+
+# --- WebSocket streams ---
+
+class STREAMS:
+    """Pushes book changes to Binance stream and Kraken v2 subscribers."""
+
+    def __init__(self, sim, rate):
+        self.sim = sim
+        self.rate = rate
+        self.ws_symbols = {internal_to_ws_pair(m): m for m in sim.markets}
+        # market -> {connection: (depth, update interval in ms)}; depth None marks a diff stream
+        self.binance = {m: {} for m in sim.markets}
+        # market -> {interval: (first update id, bids, asks) at the start of the pending batch}
+        self.binance_pending = {m: {} for m in sim.markets}
+        # market -> {connection: subscribed depth}
+        self.kraken = {m: {} for m in sim.markets}
+        # User data: {connection: subscription id} on the Binance WS API, Kraken executions subscribers
+        self.binance_users = {}
+        self.kraken_executions = set()
+        self.kraken_balances = set()
+        self._subscription_ids = itertools.count()
+        # ORDER_DESK for WebSocket order entry, set by attach()
+        self.desk = None
+        # Seconds add_order replies are held back, e.g. past the client's timeout
+        self.order_reply_delay = 0.0
+        self.sent = 0
+        self.updates = 0
+
+    async def handler(self, connection):
+        path = connection.request.path
+        try:
+            if path.startswith("/ws/"):
+                await self._binance_stream(connection, path[len("/ws/"):])
+            elif path.rstrip("/") == "/ws-api/v3":
+                await self._binance_ws_api(connection)
+            elif path.rstrip("/") == "/v2":
+                await self._kraken_session(connection)
+            else:
+                await connection.close(1008, "unknown path")
+        finally:
+            for subscribers in itertools.chain(self.binance.values(), self.kraken.values()):
+                subscribers.pop(connection, None)
+            self.binance_users.pop(connection, None)
+            self.kraken_executions.discard(connection)
+            self.kraken_balances.discard(connection)
+
+    async def _binance_stream(self, connection, stream):
+        # <symbol>@depth<N>[@100ms] (partial) or <symbol>@depth[@100ms] (diff)
+        symbol, _, rest = stream.partition("@")
+        market = symbol.upper()
+        kind, _, speed = rest.partition("@")
+        if market not in self.binance or not kind.startswith("depth"):
+            await connection.close(1008, "unknown stream")
+            return
+        depth = int(kind[len("depth"):]) if kind != "depth" else None
+        # Like Binance, changes are pushed every 100ms or 1000ms, not per update
+        self.binance[market][connection] = (depth, 100 if speed == "100ms" else 1000)
+        await connection.wait_closed()
+
+    async def _binance_ws_api(self, connection):
+        # Only the user data stream requests; signatures are not checked
+        async for raw in connection:
+            try:
+                msg = json.loads(raw)
+            except ValueError:
+                continue
+            method = msg.get("method")
+            if method == "userDataStream.subscribe.signature":
+                subscription_id = next(self._subscription_ids)
+                self.binance_users[connection] = subscription_id
+                result = {"subscriptionId": subscription_id}
+            elif method == "userDataStream.unsubscribe":
+                self.binance_users.pop(connection, None)
+                result = {}
+            else:
+                await connection.send(json.dumps({
+                    "id": msg.get("id"), "status": 400,
+                    "error": {"code": -1020, "msg": "Unsupported method %s" % method},
+                }))
+                continue
+            await connection.send(json.dumps({"id": msg.get("id"), "status": 200, "result": result}))
+
+    async def _kraken_session(self, connection):
+        async for raw in connection:
+            try:
+                msg = json.loads(raw)
+            except ValueError:
+                continue
+            method = msg.get("method")
+            params = msg.get("params", {})
+            if method == "ping":
+                await connection.send(json.dumps({"method": "pong", "time_in": "", "time_out": ""}))
+                continue
+            if method in ("add_order", "cancel_order"):
+                reply = self._kraken_order(method, params, msg.get("req_id"))
+                if method == "add_order" and self.order_reply_delay:
+                    await asyncio.sleep(self.order_reply_delay)
+                await connection.send(json.dumps(reply))
+                continue
+            if method in ("subscribe", "unsubscribe") and params.get("channel") == "executions":
+                if method == "subscribe":
+                    self.kraken_executions.add(connection)
+                else:
+                    self.kraken_executions.discard(connection)
+                await connection.send(json.dumps({
+                    "method": method, "success": True, "result": {"channel": "executions"},
+                }))
+                continue
+            if method in ("subscribe", "unsubscribe") and params.get("channel") == "balances":
+                await connection.send(json.dumps({
+                    "method": method, "success": True, "result": {"channel": "balances"},
+                }))
+                if method == "subscribe":
+                    self.kraken_balances.add(connection)
+                    if params.get("snapshot", True):
+                        await connection.send(json.dumps({
+                            "channel": "balances", "type": "snapshot",
+                            "data": [{"asset": c, "asset_class": "currency", "balance": round(v, 10)}
+                                     for c, v in self.desk.balances["kraken"].items()],
+                        }))
+                else:
+                    self.kraken_balances.discard(connection)
+                continue
+            if method not in ("subscribe", "unsubscribe") or params.get("channel") != "book":
+                continue
+            depth = params.get("depth", 10)
+            for symbol in params.get("symbol", []):
+                market = self.ws_symbols.get(symbol)
+                ack = {"method": method, "success": market is not None,
+                       "result": {"channel": "book", "depth": depth, "symbol": symbol}}
+                if market is None:
+                    ack["error"] = "Currency pair not supported %s" % symbol
+                await connection.send(json.dumps(ack))
+                if market is None:
+                    continue
+                if method == "subscribe":
+                    self.kraken[market][connection] = depth
+                    await connection.send(self._kraken_message("snapshot", market, depth))
+                else:
+                    self.kraken[market].pop(connection, None)
+
+    def _kraken_order(self, method, params, req_id):
+        """add_order / cancel_order on the authenticated v2 WebSocket; the token is not checked."""
+        time_in = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        reply = {"method": method, "req_id": req_id, "time_in": time_in}
+        if method == "add_order":
+            market = self.ws_symbols.get(params.get("symbol"))
+            if market is None or params.get("order_type") != "limit":
+                error = "EQuery:Unknown asset pair" if market is None else "EGeneral:Invalid arguments:order_type"
+                return dict(reply, success=False, error=error)
+            order = self.desk.place("kraken", market, params["side"], float(params["limit_price"]),
+                                    float(params["order_qty"]), params.get("time_in_force", "gtc") != "gtc",
+                                    userref=params.get("order_userref"))
+            result = {"order_id": order["id"]}
+        else:
+            order_ids = params.get("order_id") or []
+            if not order_ids or any(self.desk.cancel("kraken", i) is None for i in order_ids):
+                return dict(reply, success=False, error="EOrder:Unknown order")
+            result = {"order_id": order_ids[0]}
+        reply.update(success=True, result=result,
+                     time_out=datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ"))
+        return reply
+
+    def _kraken_message(self, msg_type, market, depth, old=None):
+        book = self.sim.books["kraken"][market]
+        bids, asks = book.bids[:depth], book.asks[:depth]
+        if old is None:
+            send_bids, send_asks = bids, asks
+        else:
+            send_bids = level_changes(old[0][:depth], bids)
+            send_asks = level_changes(old[1][:depth], asks)
+        checksum = kraken_checksum(bids[:CHECKSUM_DEPTH], asks[:CHECKSUM_DEPTH], PRICE_PRECISION, QTY_PRECISION)
+        # Built by hand so prices go out as plain JSON numbers at full precision
+        levels = lambda side: ",".join(
+            '{"price":%s,"qty":%s}' % (fmt(p, PRICE_PRECISION), fmt(q, QTY_PRECISION)) for p, q in side
+        )
+        # Updates carry the event time, as Kraken's do
+        stamp = ""
+        if old is not None:
+            stamp = ',"timestamp":"%s"' % datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        return (
+            '{"channel":"book","type":"%s","data":[{"symbol":"%s","bids":[%s],"asks":[%s],"checksum":%d%s}]}'
+            % (msg_type, internal_to_ws_pair(market), levels(send_bids), levels(send_asks), checksum, stamp)
+        )
+
+    def _binance_messages(self, market, first_id, old, depths):
+        book = self.sim.books["binance"][market]
+        levels = lambda side: [[fmt(p, PRICE_PRECISION), fmt(q, QTY_PRECISION)] for p, q in side]
+        messages = {}
+        for depth in depths:
+            if depth not in messages:
+                if depth is None:
+                    messages[depth] = json.dumps({
+                        "e": "depthUpdate", "E": int(time() * 1000), "s": market,
+                        "U": first_id, "u": book.update_id,
+                        "b": levels(level_changes(old[0], book.bids)),
+                        "a": levels(level_changes(old[1], book.asks)),
+                    })
+                else:
+                    messages[depth] = json.dumps({
+                        "lastUpdateId": book.update_id,
+                        "bids": levels(book.bids[:depth]), "asks": levels(book.asks[:depth]),
+                    })
+        return messages
+
+    def push_execution(self, exchange, order, exec_type):
+        """Send an order event to the exchange's user data subscribers."""
+        now = datetime.now(timezone.utc)
+        if exchange == "binance":
+            if not self.binance_users:
+                return
+            status = BINANCE_STATUS[order["status"]]
+            canceled = exec_type == "canceled"
+            report = {
+                "e": "executionReport", "E": int(now.timestamp() * 1000), "s": order["market"],
+                # A cancel reports the cancel request's id in c and the order's in C
+                "c": "cancel%d" % next(self._subscription_ids) if canceled else order["id"],
+                "C": order["id"] if canceled else "",
+                "S": order["side"].upper(), "o": "LIMIT", "f": "GTC",
+                "q": "%.8f" % order["volume"], "p": "%.8f" % order["price"],
+                "x": {"new": "NEW", "trade": "TRADE", "canceled": "CANCELED", "expired": "EXPIRED"}[exec_type],
+                "X": status,
+                "l": "%.8f" % (order["executed"] if exec_type == "trade" else 0),
+                "z": "%.8f" % order["executed"], "L": "%.8f" % order["price"],
+                "T": int(now.timestamp() * 1000),
+            }
+            events = [report]
+            if exec_type == "trade":
+                m = self.sim.markets[order["market"]]
+                events.append({
+                    "e": "outboundAccountPosition", "E": report["E"], "u": report["T"],
+                    "B": [{"a": c, "f": "%.8f" % self.desk.balances["binance"][c], "l": "0.00000000"}
+                          for c in (m["trade"], m["base"])],
+                })
+            for connection, subscription_id in list(self.binance_users.items()):
+                for event in events:
+                    broadcast([connection], json.dumps({"subscriptionId": subscription_id, "event": event}))
+        else:
+            if not self.kraken_executions:
+                return
+            status = {"open": "new", "filled": "filled", "canceled": "canceled", "expired": "expired"}[order["status"]]
+            execution = {
+                "order_id": order["id"], "exec_type": exec_type, "order_status": status,
+                "symbol": internal_to_ws_pair(order["market"]), "side": order["side"],
+                "order_qty": order["volume"], "cum_qty": order["executed"], "limit_price": order["price"],
+                "timestamp": now.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+            }
+            if order["executed"]:
+                execution["avg_price"] = order["price"]
+            if exec_type == "trade":
+                execution.update(last_qty=order["executed"], last_price=order["price"])
+            broadcast(self.kraken_executions, json.dumps({
+                "channel": "executions", "type": "update", "data": [execution],
+            }))
+            if exec_type == "trade":
+                # One ledger entry per currency the trade moved
+                m = self.sim.markets[order["market"]]
+                sign = 1 if order["side"] == "buy" else -1
+                amounts = {m["trade"]: sign * order["executed"], m["base"]: -sign * order["executed"] * order["price"]}
+                broadcast(self.kraken_balances, json.dumps({
+                    "channel": "balances", "type": "update",
+                    "data": [{"asset": c, "asset_class": "currency", "type": "trade", "amount": round(a, 10),
+                              "balance": round(self.desk.balances["kraken"][c], 10), "fee": 0,
+                              "timestamp": execution["timestamp"]} for c, a in amounts.items()],
+                }))
+
+    def attach(self, desk, loop):
+        """Take WebSocket orders on `desk` and push its order events onto `loop`."""
+        self.desk = desk
+        desk.listeners.append(
+            lambda exchange, order, exec_type: loop.call_soon_threadsafe(
+                self.push_execution, exchange, order, exec_type)
+        )
+
+    def emit(self):
+        exchange, market, old_bids, old_asks = self.sim.step()
+        self.updates += 1
+        if exchange == "binance":
+            update_id = self.sim.books["binance"][market].update_id
+            pending = self.binance_pending[market]
+            for _, interval in self.binance[market].values():
+                pending.setdefault(interval, (update_id, old_bids, old_asks))
+        else:
+            subscribers = self.kraken[market]
+            by_depth = {}
+            for connection, depth in subscribers.items():
+                by_depth.setdefault(depth, []).append(connection)
+            for depth, targets in by_depth.items():
+                broadcast(targets, self._kraken_message("update", market, depth, (old_bids, old_asks)))
+                self.sent += len(targets)
+
+    async def produce(self, tick=0.01):
+        """Emit --rate book updates per second, in batches every `tick` seconds."""
+        loop = asyncio.get_running_loop()
+        due = 0.0
+        next_tick = loop.time()
+        while True:
+            due += self.rate * tick
+            n, due = int(due), due - int(due)
+            for _ in range(n):
+                self.emit()
+            next_tick += tick
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+
+    def flush_binance(self, interval):
+        """Push the changes batched since the last flush to streams updating every `interval` ms."""
+        for market, pending in self.binance_pending.items():
+            if interval not in pending:
+                continue
+            first_id, old_bids, old_asks = pending.pop(interval)
+            subscribers = {c: d for c, (d, i) in self.binance[market].items() if i == interval}
+            messages = self._binance_messages(market, first_id, (old_bids, old_asks), subscribers.values())
+            for depth, message in messages.items():
+                targets = [c for c, d in subscribers.items() if d == depth]
+                broadcast(targets, message)
+                self.sent += len(targets)
+
+    async def flush(self):
+        ticks = itertools.count(1)
+        while True:
+            await asyncio.sleep(0.1)
+            tick = next(ticks)
+            self.flush_binance(100)
+            if tick % 10 == 0:
+                self.flush_binance(1000)
+
+    async def report(self, every=5.0):
+        while True:
+            updates, sent = self.updates, self.sent
+            await asyncio.sleep(every)
+            connections = len({c for subs in itertools.chain(self.binance.values(), self.kraken.values()) for c in subs})
+            logger.info(
+                "%.0f book updates/s, %.0f messages/s to %d connections",
+                (self.updates - updates) / every, (self.sent - sent) / every, connections,
+            )
+
+
+# --- REST ---
+
+class WINDOW_COUNTER:
+    """Usage in fixed windows, as Binance counts request weight and orders."""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.lock = threading.Lock()
+        self.window = None
+        self.used = 0
+
+    def add(self, n):
+        with self.lock:
+            window = int(time() // self.seconds)
+            if window != self.window:
+                self.window, self.used = window, 0
+            self.used += n
+            return self.used
+
+    def retry_after(self):
+        return int(self.seconds - time() % self.seconds) + 1
+
+
+class ORDER_DESK:
+    """Orders and balances for both exchanges."""
+
+    def __init__(self, sim, balance):
+        self.sim = sim
+        self.lock = threading.Lock()
+        self.balances = {ex: {c: balance for c in sim.prices} for ex in EXCHANGES}
+        self.orders = {ex: {} for ex in EXCHANGES}
+        self._ids = itertools.count(1)
+        # Called with (exchange, order copy, exec type) for every new, trade and cancel
+        self.listeners = []
+
+    def _notify(self, exchange, order, exec_type):
+        for listener in self.listeners:
+            listener(exchange, dict(order), exec_type)
+
+    def place(self, exchange, market, side, price, volume, immediate=False, userref=None):
+        """Create an order; it fills in full if it crosses the book. Returns the order dict.
+
+        An immediate (IOC/FOK) order that does not cross expires instead of resting.
+        """
+        order_id = ("sim%d" if exchange == "binance" else "OSIM%06d") % next(self._ids)
+        m = self.sim.markets[market]
+        with self.sim.lock:
+            book = self.sim.books[exchange][market]
+            best_bid = book.bids[0][0] / 10 ** PRICE_PRECISION if book.bids else 0
+            best_ask = book.asks[0][0] / 10 ** PRICE_PRECISION if book.asks else float("inf")
+        filled = price >= best_ask if side == "buy" else price <= best_bid
+        order = {"id": order_id, "market": market, "side": side, "price": price, "volume": volume,
+                 "executed": volume if filled else 0.0,
+                 "status": "filled" if filled else "expired" if immediate else "open",
+                 "userref": userref, "opened": time()}
+        with self.lock:
+            self.orders[exchange][order_id] = order
+            if filled:
+                sign = 1 if side == "buy" else -1
+                self.balances[exchange][m["trade"]] += sign * volume
+                self.balances[exchange][m["base"]] -= sign * volume * price
+            self._notify(exchange, dict(order, status="open", executed=0.0), "new")
+            if filled:
+                self._notify(exchange, order, "trade")
+            elif immediate:
+                self._notify(exchange, order, "expired")
+        return order
+
+    def cancel(self, exchange, order_id):
+        with self.lock:
+            order = self.orders[exchange].get(order_id)
+            if order is None or order["status"] != "open":
+                return None
+            order["status"] = "canceled"
+            self._notify(exchange, order, "canceled")
+            return order
+
+
+class SIM_HANDLER(BaseHTTPRequestHandler):
+    # Keep-alive, like the exchanges: clients reuse pooled connections
+    protocol_version = "HTTP/1.1"
+    sim = None
+    desk = None
+    binance_weight = WINDOW_COUNTER(60)
+    binance_orders = WINDOW_COUNTER(10)
+    # Kraken API key -> last nonce accepted; like Kraken, a lower or repeated nonce is rejected
+    kraken_nonces = {}
+    kraken_nonce_lock = threading.Lock()
+
+    def log_message(self, fmt_, *args):
+        logger.debug("REST " + fmt_, *args)
+
+    def _reply(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in dict(self.extra_headers, **(headers or {})).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _params(self):
+        url = urllib.parse.urlparse(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            params.update(urllib.parse.parse_qsl(self.rfile.read(length).decode("utf-8")))
+        return url.path, params
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def _dispatch(self, method):
+        # Headers every reply to this request carries (the connection is reused)
+        self.extra_headers = {}
+        path, params = self._params()
+        try:
+            if path.startswith("/api/v3/"):
+                self._binance(method, path[len("/api/v3/"):], params)
+            elif path.startswith("/0/"):
+                self._kraken(path[len("/0/"):], params)
+            else:
+                self._reply({"error": "not found"}, 404)
+        except Exception as e:
+            logger.exception("REST %s %s failed", method, path)
+            self._reply({"code": -1000, "msg": str(e)}, 500)
+
+    # Binance
+
+    def _binance(self, method, endpoint, params):
+        if endpoint == "depth":
+            limit = int(params.get("limit", 100))
+            weight = 5 if limit <= 100 else 25 if limit <= 500 else 50 if limit <= 1000 else 250
+        else:
+            weight = BINANCE_WEIGHTS.get((method, endpoint), 1)
+        used = self.binance_weight.add(weight)
+        headers = {"X-MBX-USED-WEIGHT-1M": used}
+        if method == "POST" and endpoint == "order":
+            headers["X-MBX-ORDER-COUNT-10S"] = orders = self.binance_orders.add(1)
+            if orders > BINANCE_ORDER_LIMIT:
+                return self._reply({"code": -1015, "msg": "Too many new orders."}, 429,
+                                   dict(headers, **{"Retry-After": self.binance_orders.retry_after()}))
+        if used > BINANCE_WEIGHT_LIMIT:
+            return self._reply({"code": -1003, "msg": "Too many requests."}, 429,
+                               dict(headers, **{"Retry-After": self.binance_weight.retry_after()}))
+        self.extra_headers = headers
+        self._binance_endpoint(method, endpoint, params)
+
+    def _binance_endpoint(self, method, endpoint, params):
+        sim, desk = self.sim, self.desk
+        if endpoint == "ping":
+            return self._reply({})
+        if endpoint == "time":
+            return self._reply({"serverTime": int(time() * 1000)})
+        if endpoint == "exchangeInfo":
+            tick = fmt(1, PRICE_PRECISION)
+            step = fmt(1, QTY_PRECISION)
+            return self._reply({"rateLimits": [
+                {"rateLimitType": "REQUEST_WEIGHT", "interval": "MINUTE", "intervalNum": 1,
+                 "limit": BINANCE_WEIGHT_LIMIT},
+                {"rateLimitType": "ORDERS", "interval": "SECOND", "intervalNum": 10, "limit": BINANCE_ORDER_LIMIT},
+            ], "symbols": [
+                {
+                    "symbol": market, "status": "TRADING",
+                    "baseAsset": m["trade"], "quoteAsset": m["base"],
+                    "filters": [
+                        {"filterType": "PRICE_FILTER", "tickSize": tick},
+                        {"filterType": "LOT_SIZE", "minQty": step, "stepSize": step},
+                        {"filterType": "NOTIONAL", "minNotional": "0.0001"},
+                    ],
+                }
+                for market, m in sim.markets.items()
+            ]})
+        if endpoint == "depth":
+            market = params.get("symbol", "")
+            if market not in sim.markets:
+                return self._reply({"code": -1121, "msg": "Invalid symbol."}, 400)
+            limit = int(params.get("limit", 100))
+            with sim.lock:
+                book = sim.books["binance"][market]
+                snapshot = {
+                    "lastUpdateId": book.update_id,
+                    "bids": [[fmt(p, PRICE_PRECISION), fmt(q, QTY_PRECISION)] for p, q in book.bids[:limit]],
+                    "asks": [[fmt(p, PRICE_PRECISION), fmt(q, QTY_PRECISION)] for p, q in book.asks[:limit]],
+                }
+            return self._reply(snapshot)
+        if endpoint == "account":
+            with desk.lock:
+                balances = [{"asset": c, "free": "%.8f" % v, "locked": "0.00000000"}
+                            for c, v in desk.balances["binance"].items()]
+            return self._reply({"balances": balances})
+        if endpoint == "order":
+            return self._binance_order(method, params)
+        self._reply({"code": -1000, "msg": "Unsupported endpoint %s" % endpoint}, 404)
+
+    def _binance_order(self, method, params):
+        desk = self.desk
+        if method == "POST":
+            market = params.get("symbol", "")
+            if market not in self.sim.markets:
+                return self._reply({"code": -1121, "msg": "Invalid symbol."}, 400)
+            time_in_force = params.get("timeInForce", "GTC")
+            order = desk.place("binance", market, params["side"].lower(),
+                               float(params["price"]), float(params["quantity"]), time_in_force != "GTC")
+            order["time_in_force"] = time_in_force
+            return self._reply(self._binance_order_view(order))
+        order_id = params.get("origClientOrderId", "")
+        if method == "DELETE":
+            order = desk.cancel("binance", order_id)
+        else:
+            order = desk.orders["binance"].get(order_id)
+        if order is None:
+            return self._reply({"code": -2011, "msg": "Unknown order sent."}, 400)
+        self._reply(self._binance_order_view(order))
+
+    @staticmethod
+    def _binance_order_view(order):
+        status = BINANCE_STATUS[order["status"]]
+        return {
+            "symbol": order["market"], "clientOrderId": order["id"], "status": status,
+            "price": "%.8f" % order["price"], "origQty": "%.8f" % order["volume"],
+            "executedQty": "%.8f" % order["executed"], "side": order["side"].upper(),
+            "type": "LIMIT", "timeInForce": order.get("time_in_force", "GTC"),
+        }
+
+    # Kraken
+
+    def _kraken(self, endpoint, params):
+        sim, desk = self.sim, self.desk
+        if endpoint == "public/Time":
+            now = time()
+            return self._reply({"error": [], "result": {"unixtime": int(now), "rfc1123": ""}})
+        if endpoint == "public/AssetPairs":
+            return self._reply({"error": [], "result": {
+                to_kraken_asset_code(m["trade"]) + to_kraken_asset_code(m["base"]): {
+                    "altname": market,
+                    "wsname": internal_to_ws_pair(market),
+                    "base": to_kraken_asset_code(m["trade"]),
+                    "quote": to_kraken_asset_code(m["base"]),
+                    "pair_decimals": PRICE_PRECISION,
+                    "lot_decimals": QTY_PRECISION,
+                    "ordermin": fmt(1, QTY_PRECISION),
+                }
+                for market, m in sim.markets.items()
+            }})
+        if endpoint.startswith("private/"):
+            key, nonce = self.headers.get("API-Key", ""), int(params.get("nonce") or 0)
+            with self.kraken_nonce_lock:
+                if nonce <= self.kraken_nonces.get(key, 0):
+                    return self._reply({"error": ["EAPI:Invalid nonce"]})
+                self.kraken_nonces[key] = nonce
+        if endpoint == "private/GetWebSocketsToken":
+            return self._reply({"error": [], "result": {"token": "simtoken", "expires": 900}})
+        if endpoint == "private/Balance":
+            with desk.lock:
+                result = {to_kraken_asset_code(c): "%.10f" % v for c, v in desk.balances["kraken"].items()}
+            return self._reply({"error": [], "result": result})
+        if endpoint == "private/AddOrder":
+            pairs = {to_kraken_asset_code(m["trade"]) + to_kraken_asset_code(m["base"]): market
+                     for market, m in sim.markets.items()}
+            market = pairs.get(params.get("pair"))
+            if market is None:
+                return self._reply({"error": ["EQuery:Unknown asset pair"]})
+            userref = params.get("userref")
+            order = desk.place("kraken", market, params["type"], float(params["price"]), float(params["volume"]),
+                               params.get("timeinforce", "GTC") != "GTC",
+                               userref=int(userref) if userref else None)
+            return self._reply({"error": [], "result": {
+                "descr": {"order": "%s %s %s @ limit %s" % (params["type"], params["volume"], params["pair"], params["price"])},
+                "txid": [order["id"]],
+            }})
+        if endpoint == "private/CancelOrder":
+            order = desk.cancel("kraken", params.get("txid", ""))
+            if order is None:
+                return self._reply({"error": ["EOrder:Unknown order"]})
+            return self._reply({"error": [], "result": {"count": 1}})
+        if endpoint == "private/QueryOrders":
+            result = {}
+            for txid in params.get("txid", "").split(","):
+                order = desk.orders["kraken"].get(txid)
+                if order:
+                    result[txid] = self._kraken_order_view(order)
+            return self._reply({"error": [], "result": result})
+        if endpoint in ("private/OpenOrders", "private/ClosedOrders"):
+            userref = int(params["userref"]) if params.get("userref") else None
+            start = float(params.get("start") or 0)
+            want_open = endpoint == "private/OpenOrders"
+            with desk.lock:
+                orders = {
+                    txid: self._kraken_order_view(order) for txid, order in desk.orders["kraken"].items()
+                    if (order["status"] == "open") == want_open
+                    and (userref is None or order["userref"] == userref) and order["opened"] >= start
+                }
+            if want_open:
+                return self._reply({"error": [], "result": {"open": orders}})
+            return self._reply({"error": [], "result": {"closed": orders, "count": len(orders)}})
+        self._reply({"error": ["EGeneral:Unknown method"]}, 404)
+
+    @staticmethod
+    def _kraken_order_view(order):
+        return {
+            "status": {"open": "open", "filled": "closed", "canceled": "canceled",
+                       "expired": "expired"}[order["status"]],
+            "userref": order["userref"],
+            "vol": "%.8f" % order["volume"], "vol_exec": "%.8f" % order["executed"],
+            "price": "%.8f" % (order["price"] if order["executed"] else 0),
+            "descr": {"pair": order["market"], "type": order["side"], "price": "%.8f" % order["price"]},
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulated Binance/Kraken endpoints for load testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--rest-port", type=int, default=8100)
+    parser.add_argument("--ws-port", type=int, default=8101)
+    parser.add_argument("--currencies", default="ETH,BTC,XLM,XRP,ADA",
+                        help="Comma-separated currencies; every one is listed against BTC and ETH")
+    parser.add_argument("--synthetic", type=int, default=0,
+                        help="Add this many synthetic trade currencies (T00, T01, ...)")
+    parser.add_argument("--rate", type=float, default=100.0, help="Book updates per second across all books")
+    parser.add_argument("--volatility", type=float, default=0.5, help="Price walk step, in bps")
+    parser.add_argument("--dislocation", type=float, default=30.0,
+                        help="Max offset of each exchange's price from the common one, in bps")
+    parser.add_argument("--balance", type=float, default=10.0, help="Starting balance of every currency")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--order-reply-delay", type=float, default=0.0,
+                        help="Hold Kraken WS add_order replies back this many seconds (to test timeouts)")
+    args = parser.parse_args()
+
+    currencies = [c.strip().upper() for c in args.currencies.split(",") if c.strip()]
+    currencies += ["T%02d" % i for i in range(args.synthetic)]
+    for base in BASES:
+        if base not in currencies:
+            currencies.append(base)
+
+    sim = MARKET_SIM(currencies, args.volatility, args.dislocation, seed=args.seed)
+    SIM_HANDLER.sim = sim
+    SIM_HANDLER.desk = ORDER_DESK(sim, args.balance)
+    rest = ThreadingHTTPServer((args.host, args.rest_port), SIM_HANDLER)
+    rest.daemon_threads = True
+    threading.Thread(target=rest.serve_forever, name="SIM_REST", daemon=True).start()
+
+    streams = STREAMS(sim, args.rate)
+    streams.order_reply_delay = args.order_reply_delay
+    logger.info(
+        "Simulating %d markets on both exchanges: REST http://%s:%d, WS ws://%s:%d (%.0f updates/s)",
+        len(sim.markets), args.host, args.rest_port, args.host, args.ws_port, args.rate,
+    )
+
+    async def run():
+        streams.attach(SIM_HANDLER.desk, asyncio.get_running_loop())
+        async with serve(streams.handler, args.host, args.ws_port, max_queue=None):
+            await asyncio.gather(streams.produce(), streams.flush(), streams.report())
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        rest.shutdown()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    main()
@@ -0,0 +1,59 @@
+import logging
+import threading
+from time import time, sleep
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+
+def pooled_session(pool_size=4, retries=2, backoff=0.2):
+    """Keep-alive requests.Session with a connection pool and retry policy.
+
+    Connection failures are retried for every method, since nothing reached
+    the exchange. Read errors and 502/503/504 responses are retried only
+    for GET and DELETE: a POST (an order) may have been executed.
+    """
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        status=retries,
+        backoff_factor=backoff,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET", "DELETE"}),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class KEEP_WARM(threading.Thread):
+    """Pings exchange clients that have been idle, so their pooled connection
+    (and its TLS session) is still open when the next order goes out.
+
+    Clients expose last_request (time of their last REST call) and ping().
+    """
+
+    def __init__(self, clients, interval=30):
+        threading.Thread.__init__(self)
+        self.name = "KEEP_WARM"
+        self.daemon = True
+        self.clients = clients
+        self.interval = interval
+
+    def run(self):
+        while True:
+            sleep(self.interval / 2)
+            for client in self.clients:
+                if time() - client.last_request < self.interval:
+                    continue
+                try:
+                    client.ping()
+                except Exception as e:
+                    logger.warning("Keep-warm ping to %s failed: %s", client.name, e)
@@ -24,7 +24,7 @@ CREATE TABLE IF NOT EXISTS order_details (
 CREATE TABLE IF NOT EXISTS opportunities (
     id          BIGINT AUTO_INCREMENT PRIMARY KEY,
     ts          TIMESTAMP(3) NOT NULL DEFAULT CURRENT_TIMESTAMP(3),
-    route_type  ENUM('direct', 'multi_leg') NOT NULL,
+    route_type  ENUM('direct', 'multi_leg', 'cross') NOT NULL,
     route_label VARCHAR(40) NOT NULL,
     buy_exchange  VARCHAR(20) NOT NULL,
     sell_exchange VARCHAR(20) NOT NULL,
@@ -40,3 +40,59 @@ CREATE TABLE IF NOT EXISTS opportunities (
     INDEX idx_route_label (route_label),
     INDEX idx_spread (spread_pct)
 );
+
+-- One row per opportunity episode: a route and direction staying above threshold
+-- over consecutive compare passes
+CREATE TABLE IF NOT EXISTS opportunity_episodes (
+    id              BIGINT AUTO_INCREMENT PRIMARY KEY,
+    started_at      TIMESTAMP(3) NOT NULL,
+    ended_at        TIMESTAMP(3) NOT NULL,
+    duration_s      DECIMAL(12, 3) NOT NULL,
+    route_type      ENUM('direct', 'multi_leg', 'cross') NOT NULL,
+    route_label     VARCHAR(40) NOT NULL,
+    buy_exchange    VARCHAR(20) NOT NULL,
+    sell_exchange   VARCHAR(20) NOT NULL,
+    ticks           INT NOT NULL,
+    peak_spread_pct DECIMAL(10, 6) NOT NULL,
+    avg_spread_pct  DECIMAL(10, 6) NOT NULL,
+    peak_buy_rate   DECIMAL(20, 8) NOT NULL,
+    peak_sell_rate  DECIMAL(20, 8) NOT NULL,
+    peak_qty_a      DECIMAL(20, 8) NOT NULL,
+    peak_qty_b      DECIMAL(20, 8) NOT NULL,
+    executed_ticks  INT NOT NULL DEFAULT 0,
+    dry_run         BOOLEAN NOT NULL DEFAULT FALSE,
+    INDEX idx_started_at (started_at),
+    INDEX idx_route_label (route_label)
+);
+
+-- Hourly opportunity ticks per route and direction, every tick whether sampled into
+-- opportunities or not (history from before the rollups: backfill.py)
+CREATE TABLE IF NOT EXISTS opportunity_rollup_hourly (
+    bucket              DATETIME NOT NULL,
+    route_label         VARCHAR(40) NOT NULL,
+    buy_exchange        VARCHAR(20) NOT NULL,
+    sell_exchange       VARCHAR(20) NOT NULL,
+    opportunities       INT NOT NULL,
+    spread_sum          DECIMAL(20, 6) NOT NULL,
+    spread_min          DECIMAL(10, 6) NOT NULL,
+    spread_max          DECIMAL(10, 6) NOT NULL,
+    executed            INT NOT NULL,
+    executed_spread_sum DECIMAL(20, 6) NOT NULL,
+    PRIMARY KEY (bucket, route_label, buy_exchange, sell_exchange)
+);
+
+-- Daily opportunity ticks per route and direction, every tick whether sampled into
+-- opportunities or not (history from before the rollups: backfill.py)
+CREATE TABLE IF NOT EXISTS opportunity_rollup_daily (
+    bucket              DATE NOT NULL,
+    route_label         VARCHAR(40) NOT NULL,
+    buy_exchange        VARCHAR(20) NOT NULL,
+    sell_exchange       VARCHAR(20) NOT NULL,
+    opportunities       INT NOT NULL,
+    spread_sum          DECIMAL(20, 6) NOT NULL,
+    spread_min          DECIMAL(10, 6) NOT NULL,
+    spread_max          DECIMAL(10, 6) NOT NULL,
+    executed            INT NOT NULL,
+    executed_spread_sum DECIMAL(20, 6) NOT NULL,
+    PRIMARY KEY (bucket, route_label, buy_exchange, sell_exchange)
+);
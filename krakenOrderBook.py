@@ -1,14 +1,23 @@
 import threading
 import json
+import zlib
 import logging
-from time import time, sleep
+from time import sleep, time, perf_counter
+from datetime import datetime
 from decimal import Decimal
 import websocket
 
+from orderBook import SORTED_BOOK, TICK_LEVELS, to_ticks, publish_book, clear_book
+from metrics import FEED_LAG, BOOK_APPLY
+
 logger = logging.getLogger(__name__)
 
 # Kraken WebSocket uses / separator and XBT for BTC
 KRAKEN_WS_PAIR_MAP = {}  # filled from order_book keys
+# Depths accepted by the v2 book channel
+KRAKEN_BOOK_DEPTHS = (10, 25, 100, 500, 1000)
+# The v2 checksum always covers the top 10 levels of each side
+CHECKSUM_DEPTH = 10
 
 
 def internal_to_ws_pair(market):
@@ -34,16 +43,53 @@ def ws_pair_to_internal(ws_pair):
     return trade + base
 
 
+def _checksum_field(value, precision):
+    """Format a price/qty for the checksum: fixed precision, no dot, no leading zeros."""
+    if isinstance(value, int):
+        return str(value)  # integer ticks are already in that form
+    return "{:.{}f}".format(value, precision).replace(".", "").lstrip("0")
+
+
+def kraken_checksum(bids, asks, price_precision, qty_precision):
+    """Compute the Kraken v2 book CRC32 over the top 10 asks then the top 10 bids."""
+    parts = []
+    for price, qty in asks[:CHECKSUM_DEPTH]:
+        parts.append(_checksum_field(price, price_precision))
+        parts.append(_checksum_field(qty, qty_precision))
+    for price, qty in bids[:CHECKSUM_DEPTH]:
+        parts.append(_checksum_field(price, price_precision))
+        parts.append(_checksum_field(qty, qty_precision))
+    return zlib.crc32("".join(parts).encode("ascii"))
+
+
 class KRAKEN_ORDER_BOOK(threading.Thread):
-    def __init__(self, threadId, name, order_book):
+    def __init__(self, threadId, name, order_book, on_update=None, depth=10, precisions=None, ticks=False,
+                 recorder=None, ws_url="wss://ws.kraken.com/v2", publish_depth=None):
         threading.Thread.__init__(self)
         self.threadId = threadId
         self.name = name
         self.order_book = order_book
+        # Called with (exchange, market) after a book changes
+        self.on_update = on_update
+        if depth not in KRAKEN_BOOK_DEPTHS:
+            raise ValueError("Kraken book depth must be one of %s" % (KRAKEN_BOOK_DEPTHS,))
+        self.depth = depth
+        # Levels published per side; deeper levels are only kept for the checksum and updates
+        self.publish_depth = min(publish_depth or depth, depth)
+        # market -> (price precision, qty precision); checksums are skipped without it
+        self.precisions = precisions or {}
+        # Store books as integer ticks (TICK_LEVELS) for markets with known precision
+        self.ticks = ticks
+        # Optional MARKET_RECORDER receiving every raw frame
+        self.recorder = recorder
+        self.books = {market: (SORTED_BOOK(descending=True), SORTED_BOOK()) for market in order_book}
+        self._resyncing = set()
         self.ws = None
-        self.ws_url = "wss://ws.kraken.com/v2"
+        self.ws_url = ws_url
         self._backoff = 1
         self._max_backoff = 60
+        self._feed_lag = FEED_LAG.labels("kraken")
+        self._book_apply = BOOK_APPLY.labels("kraken")
         # Build pair mapping
         self.pairs = {}
         for market in order_book:
@@ -74,19 +120,27 @@ class KRAKEN_ORDER_BOOK(threading.Thread):
         logger.info("Kraken WS connected")
         self._backoff = 1
         # Subscribe to book channel for all pairs
+        self._resyncing.clear()
+        self._subscribe(ws, "subscribe", list(self.pairs.keys()))
+
+    def _subscribe(self, ws, method, symbols):
         sub_msg = {
-            "method": "subscribe",
+            "method": method,
             "params": {
                 "channel": "book",
-                "depth": 10,
-                "symbol": list(self.pairs.keys()),
+                "depth": self.depth,
+                "symbol": symbols,
             },
         }
         ws.send(json.dumps(sub_msg))
 
     def _on_message(self, ws, message):
+        received = perf_counter()
+        if self.recorder:
+            self.recorder.record("kraken", message)
         try:
-            data = json.loads(message)
+            # Keep the exact price/qty text Kraken sent: Decimal, or raw str for tick parsing
+            data = json.loads(message, parse_float=str if self.ticks else Decimal)
         except json.JSONDecodeError:
             return
 
@@ -105,40 +159,90 @@ class KRAKEN_ORDER_BOOK(threading.Thread):
             market = self.pairs[symbol]
 
             if msg_type == "snapshot":
-                bids = [[Decimal(str(b["price"])), Decimal(str(b["qty"]))] for b in entry.get("bids", [])]
-                asks = [[Decimal(str(a["price"])), Decimal(str(a["qty"]))] for a in entry.get("asks", [])]
-                self.order_book[market]["buy"] = sorted(bids, key=lambda x: x[0], reverse=True)
-                self.order_book[market]["sell"] = sorted(asks, key=lambda x: x[0])
-                self.order_book[market]["lastUpdate"] = time()
-            elif msg_type == "update":
+                self._apply_snapshot(market, entry)
+            elif msg_type == "update" and market not in self._resyncing:
+                self._observe_lag(entry)
                 self._apply_update(market, entry)
+            else:
+                continue
+            self._book_apply.observe(perf_counter() - received)
+
+    def _observe_lag(self, entry):
+        # Updates carry the matching engine time, e.g. "2023-10-06T17:35:55.440295Z"
+        stamp = entry.get("timestamp")
+        if stamp:
+            try:
+                self._feed_lag.observe(max(0.0, time() - datetime.fromisoformat(stamp).timestamp()))
+            except ValueError:
+                pass
+
+    def _apply_snapshot(self, market, entry):
+        bids, asks = self.books[market]
+        bids.clear()
+        asks.clear()
+        self._resyncing.discard(market)
+        self._apply_levels(market, entry)
 
     def _apply_update(self, market, entry):
         # Apply incremental updates
-        for bid in entry.get("bids", []):
-            price = Decimal(str(bid["price"]))
-            qty = Decimal(str(bid["qty"]))
-            book = self.order_book[market].get("buy")
-            if book is None:
-                continue
-            # Remove existing level
-            book = [b for b in book if b[0] != price]
-            if qty > 0:
-                book.append([price, qty])
-            self.order_book[market]["buy"] = sorted(book, key=lambda x: x[0], reverse=True)[:10]
-
-        for ask in entry.get("asks", []):
-            price = Decimal(str(ask["price"]))
-            qty = Decimal(str(ask["qty"]))
-            book = self.order_book[market].get("sell")
-            if book is None:
-                continue
-            book = [a for a in book if a[0] != price]
-            if qty > 0:
-                book.append([price, qty])
-            self.order_book[market]["sell"] = sorted(book, key=lambda x: x[0])[:10]
+        self._apply_levels(market, entry)
+
+    def _apply_levels(self, market, entry):
+        bids, asks = self.books[market]
+        precision = self.precisions.get(market)
+        if self.ticks and precision:
+            pp, qp = precision
+            for bid in entry.get("bids", []):
+                bids.set(to_ticks(bid["price"], pp), to_ticks(bid["qty"], qp))
+            for ask in entry.get("asks", []):
+                asks.set(to_ticks(ask["price"], pp), to_ticks(ask["qty"], qp))
+        else:
+            for bid in entry.get("bids", []):
+                bids.set(Decimal(str(bid["price"])), Decimal(str(bid["qty"])))
+            for ask in entry.get("asks", []):
+                asks.set(Decimal(str(ask["price"])), Decimal(str(ask["qty"])))
+        # Levels pushed out of the subscribed depth are no longer maintained by Kraken
+        bids.truncate(self.depth)
+        asks.truncate(self.depth)
+
+        if not self._checksum_ok(market, entry, bids, asks):
+            self._resync(market)
+            return
 
-        self.order_book[market]["lastUpdate"] = time()
+        if self.ticks and precision:
+            buy = TICK_LEVELS(*bids.columns(self.publish_depth), *precision)
+            sell = TICK_LEVELS(*asks.columns(self.publish_depth), *precision)
+        else:
+            buy = bids.levels(self.publish_depth)
+            sell = asks.levels(self.publish_depth)
+        publish_book(self.order_book, market, buy, sell)
+        if self.on_update:
+            self.on_update("kraken", market)
+
+    def _checksum_ok(self, market, entry, bids, asks):
+        expected = entry.get("checksum")
+        precision = self.precisions.get(market)
+        if expected is None or precision is None:
+            return True
+        actual = kraken_checksum(bids.levels(CHECKSUM_DEPTH), asks.levels(CHECKSUM_DEPTH), *precision)
+        if actual != int(expected):
+            logger.warning("Kraken book checksum mismatch for %s (got %s, expected %s)", market, actual, expected)
+            return False
+        return True
+
+    def _resync(self, market):
+        """Drop the local book and resubscribe so Kraken sends a fresh snapshot."""
+        bids, asks = self.books[market]
+        bids.clear()
+        asks.clear()
+        clear_book(self.order_book, market)
+        self._resyncing.add(market)
+        ws_pair = next(p for p, m in self.pairs.items() if m == market)
+        try:
+            self._subscribe(self.ws, "unsubscribe", [ws_pair])
+            self._subscribe(self.ws, "subscribe", [ws_pair])
+        except Exception as e:
+            logger.error("Kraken resync failed for %s: %s", market, e)
 
     def _on_error(self, ws, error):
         logger.error("Kraken WS error: %s", error)
@@ -1,14 +1,44 @@
 import hmac
+import json
 import hashlib
 import base64
+import contextlib
 import urllib.parse
+import asyncio
 import logging
+import itertools
+import threading
+import concurrent.futures
 import requests
-from time import time, sleep
+import websocket
+from time import time, monotonic
 from decimal import Decimal
 
+from httpSession import pooled_session
+from krakenOrderBook import internal_to_ws_pair
+from rateLimit import TOKEN_BUCKET, PRIORITY_ORDER, PRIORITY_QUERY, PRIORITY_BACKGROUND
+
 logger = logging.getLogger(__name__)
 
+# Kraken's decaying counters per verification tier, as (maximum, decay per second): "api"
+# counts private REST calls, "trading" counts order adds and cancels per pair
+KRAKEN_TIERS = {
+    "starter": {"api": (15, 0.33), "trading": (60, 1.0)},
+    "intermediate": {"api": (20, 0.5), "trading": (125, 2.34)},
+    "pro": {"api": (20, 1.0), "trading": (180, 3.75)},
+}
+# API counter cost of private calls that do not cost 1
+API_COSTS = {"AddOrder": 0, "CancelOrder": 0, "Ledgers": 2, "QueryLedgers": 2, "TradesHistory": 2}
+# Trading counter cost of a cancel, by order age: (younger than seconds, cost)
+CANCEL_COSTS = ((5, 8), (10, 6), (15, 5), (45, 4), (90, 2), (300, 1))
+PRIVATE_PRIORITIES = {
+    "AddOrder": PRIORITY_ORDER, "CancelOrder": PRIORITY_ORDER, "QueryOrders": PRIORITY_QUERY,
+    "OpenOrders": PRIORITY_QUERY, "ClosedOrders": PRIORITY_QUERY,
+}
+# order() result when the order was sent but whether Kraken placed it could not be found out;
+# placing it again could double the position, so callers must not retry
+ORDER_UNKNOWN = "unknown"
+
 # Kraken uses XBT instead of BTC
 KRAKEN_ASSET_MAP = {"BTC": "XBT"}
 REVERSE_ASSET_MAP = {"XBT": "BTC"}
@@ -26,72 +56,235 @@ def from_kraken_asset(asset):
     return REVERSE_ASSET_MAP.get(stripped, stripped)
 
 
+def parse_asset_pairs(result):
+    """The AssetPairs fields the bot uses, without dark pool (.d) pairs."""
+    fields = ("base", "quote", "pair_decimals", "lot_decimals", "ordermin")
+    return {
+        pair_name: {k: pair_data[k] for k in fields if k in pair_data}
+        for pair_name, pair_data in result.items()
+        if not pair_name.endswith(".d")
+    }
+
+
+class KRAKEN_KEY:
+    """One API key of a KRAKEN client, with its own nonce sequence and API counter.
+
+    Kraken checks nonces and counts private calls per key; the per-pair
+    trading counters belong to the account and are shared by all its keys.
+    Kraken rejects a nonce lower than one it has seen, so a key carries one
+    call at a time, held from its nonce until the response (request()).
+    """
+
+    # Poll interval of request_async() callers waiting for the key
+    POLL = 0.005
+
+    def __init__(self, key, secret, name, api_limits):
+        self.key = key
+        self.secret = secret
+        self.api_limit = TOKEN_BUCKET(name, *api_limits)
+        # Private calls using the key right now, waiting on its counter included
+        self.in_flight = 0
+        self._nonce_lock = threading.Lock()
+        self._last_nonce = 0
+        self._request_lock = threading.Lock()
+
+    def nonce(self):
+        """Strictly increasing across threads; two calls in one millisecond would repeat a timestamp."""
+        with self._nonce_lock:
+            self._last_nonce = max(self._last_nonce + 1, int(time() * 1000))
+            return str(self._last_nonce)
+
+    @contextlib.contextmanager
+    def request(self):
+        """Hold the key for one call, nonce to response, so its nonces reach Kraken in order."""
+        with self._request_lock:
+            yield
+
+    @contextlib.asynccontextmanager
+    async def request_async(self):
+        """request() without blocking the event loop."""
+        while not self._request_lock.acquire(blocking=False):
+            await asyncio.sleep(self.POLL)
+        try:
+            yield
+        finally:
+            self._request_lock.release()
+
+    def sign(self, uri_path, data):
+        postdata = urllib.parse.urlencode(data)
+        encoded = (str(data["nonce"]) + postdata).encode("utf-8")
+        message = uri_path.encode("utf-8") + hashlib.sha256(encoded).digest()
+        mac = hmac.new(base64.b64decode(self.secret), message, hashlib.sha512)
+        return base64.b64encode(mac.digest()).decode()
+
+
 class KRAKEN:
+    PING_PATH = "/0/public/Time"
+
     @staticmethod
-    def discover_pairs():
+    def discover_pairs(base_url="https://api.kraken.com", session=None, cache=None):
         """Query Kraken AssetPairs and return set of (base, quote) in normalized names."""
-        res = requests.get("https://api.kraken.com/0/public/AssetPairs", timeout=15)
-        res.raise_for_status()
-        data = res.json()
+        def fetch():
+            res = (session or requests).get(base_url + "/0/public/AssetPairs", timeout=15)
+            res.raise_for_status()
+            return parse_asset_pairs(res.json().get("result", {}))
+
+        data = cache.get(cache.key("kraken-AssetPairs", base_url), fetch) if cache else fetch()
+        if data is None:
+            raise RuntimeError("Kraken AssetPairs unavailable")
         pairs = set()
-        for pair_name, pair_data in data.get("result", {}).items():
-            if pair_name.endswith(".d"):
-                continue
+        for pair_name, pair_data in data.items():
             base = from_kraken_asset(pair_data.get("base", ""))
             quote = from_kraken_asset(pair_data.get("quote", ""))
             if base and quote:
                 pairs.add((base, quote))
         return pairs
 
-    def __init__(self, api_details, currencies):
-        self.api_key = api_details["API_KEY"]
-        self.api_secret = api_details["API_SECRET"]
-        self.base_url = "https://api.kraken.com"
+    def __init__(self, api_details, currencies, pool_size=4, retries=2, tier="starter", cache=None):
+        if tier not in KRAKEN_TIERS:
+            raise ValueError("Kraken tier must be one of %s" % (tuple(KRAKEN_TIERS),))
+        self.base_url = api_details.get("API_BASE_URL", "https://api.kraken.com")
         self.currencies = currencies
         self.name = "kraken"
+        # METADATA_CACHE for AssetPairs; None fetches them on every call
+        self.cache = cache
         self.pair_map = {}  # internal name -> kraken name (e.g. ETHBTC -> ETHXBT)
-        self._last_private_call = 0
+        # Keep-alive connection pool shared by every REST call
+        self.session = pooled_session(pool_size, retries)
+        self.last_request = 0
+        self.tier = KRAKEN_TIERS[tier]
+        # API_KEY first, then any extra (key, secret) pairs of the same account in API_KEYS;
+        # every private call goes out on the least loaded one
+        credentials = [(api_details["API_KEY"], api_details["API_SECRET"])] + list(api_details.get("API_KEYS", ()))
+        self.keys = [
+            KRAKEN_KEY(key, secret, "kraken api" if n == 0 else "kraken api %d" % (n + 1), self.tier["api"])
+            for n, (key, secret) in enumerate(credentials)
+        ]
+        self._keys_lock = threading.Lock()
+        # Kraken pair -> trading counter bucket
+        self.trading_limits = {}
+        # Order id -> (Kraken pair, monotonic placement time), for the cost of cancelling it
+        self._placed = {}
 
-    def _sign(self, uri_path, data):
-        postdata = urllib.parse.urlencode(data)
-        encoded = (str(data["nonce"]) + postdata).encode("utf-8")
-        message = uri_path.encode("utf-8") + hashlib.sha256(encoded).digest()
-        mac = hmac.new(base64.b64decode(self.api_secret), message, hashlib.sha512)
-        return base64.b64encode(mac.digest()).decode()
+    def ping(self):
+        """Public request that keeps a pooled connection open."""
+        self.last_request = time()
+        self.session.get(self.base_url + self.PING_PATH, timeout=10)
 
-    def _rate_limit(self):
-        elapsed = time() - self._last_private_call
-        if elapsed < 1.0:
-            sleep(1.0 - elapsed)
-        self._last_private_call = time()
+    async def pingAsync(self, session):
+        async with session.get(self.base_url + self.PING_PATH) as res:
+            await res.read()
 
-    def _private_request(self, endpoint, data=None):
-        self._rate_limit()
-        if data is None:
-            data = {}
+    @contextlib.contextmanager
+    def _leased_key(self):
+        """The key with the fewest private calls in flight (then the fullest counter), busy until the block exits."""
+        with self._keys_lock:
+            key = min(self.keys, key=lambda k: (k.in_flight, -k.api_limit.level()))
+            key.in_flight += 1
+        try:
+            yield key
+        finally:
+            with self._keys_lock:
+                key.in_flight -= 1
+
+    def _trading_limit(self, pair):
+        bucket = self.trading_limits.get(pair)
+        if bucket is None:
+            bucket = self.trading_limits.setdefault(pair, TOKEN_BUCKET("kraken trading " + pair, *self.tier["trading"]))
+        return bucket
+
+    def _cancel_limits(self, order_id):
+        """[(bucket, cost)] for cancelling an order: young orders cost more to cancel."""
+        placed = self._placed.pop(order_id, None)
+        if placed is None:
+            return []
+        pair, at = placed
+        age = monotonic() - at
+        cost = next((c for younger_than, c in CANCEL_COSTS if age < younger_than), 0)
+        return [(self._trading_limit(pair), cost)] if cost else []
+
+    def _limits(self, key, endpoint, data):
+        """[(bucket, cost)] for a private call on key, and its queue priority."""
+        limits = []
+        cost = API_COSTS.get(endpoint, 1)
+        if cost:
+            limits.append((key.api_limit, cost))
+        if endpoint == "AddOrder":
+            limits.append((self._trading_limit(data["pair"]), 1))
+        elif endpoint == "CancelOrder":
+            limits.extend(self._cancel_limits(data["txid"]))
+        return limits, PRIVATE_PRIORITIES.get(endpoint, PRIORITY_BACKGROUND)
+
+    def _track_order(self, order_id, pair):
+        now = monotonic()
+        if len(self._placed) > 1000:
+            # Orders that filled are never cancelled; past the last cancel cost they are free
+            for stale in [i for i, (_, at) in self._placed.items() if now - at > CANCEL_COSTS[-1][0]]:
+                self._placed.pop(stale, None)
+        self._placed[order_id] = (pair, now)
+
+    def _signed(self, key, endpoint, data):
+        """Return (uri_path, headers) for a private call on key; adds the nonce to data."""
         uri_path = "/0/private/" + endpoint
-        data["nonce"] = str(int(time() * 1000))
+        data["nonce"] = key.nonce()
         headers = {
-            "API-Key": self.api_key,
-            "API-Sign": self._sign(uri_path, data),
+            "API-Key": key.key,
+            "API-Sign": key.sign(uri_path, data),
         }
-        try:
-            res = requests.post(self.base_url + uri_path, headers=headers, data=data, timeout=10)
-            logger.debug("Kraken %s response status: %d", endpoint, res.status_code)
-            r = res.json()
-            if r.get("error") and len(r["error"]) > 0:
-                logger.error("Kraken API error (%s): %s", endpoint, r["error"])
-                return None
-            logger.debug("Kraken %s result keys: %s", endpoint, list(r.get("result", {}).keys()) if isinstance(r.get("result"), dict) else type(r.get("result")))
-            return r.get("result")
-        except Exception as e:
-            logger.error("Kraken request failed (%s): %s", endpoint, e)
+        return uri_path, headers
+
+    def _private_result(self, endpoint, r, limits=()):
+        if r.get("error") and len(r["error"]) > 0:
+            logger.error("Kraken API error (%s): %s", endpoint, r["error"])
+            if any("Rate limit exceeded" in e for e in r["error"]):
+                # Our counter ran ahead of Kraken's: start it from full again
+                for bucket, _ in limits:
+                    bucket.hold(0)
             return None
+        logger.debug("Kraken %s result keys: %s", endpoint, list(r.get("result", {}).keys()) if isinstance(r.get("result"), dict) else type(r.get("result")))
+        return r.get("result")
+
+    def _private_request(self, endpoint, data=None):
+        if data is None:
+            data = {}
+        with self._leased_key() as key:
+            limits, priority = self._limits(key, endpoint, data)
+            for bucket, cost in limits:
+                bucket.acquire(cost, priority)
+            with key.request():
+                uri_path, headers = self._signed(key, endpoint, data)
+                self.last_request = time()
+                try:
+                    res = self.session.post(self.base_url + uri_path, headers=headers, data=data, timeout=10)
+                    logger.debug("Kraken %s response status: %d", endpoint, res.status_code)
+                    return self._private_result(endpoint, res.json(), limits)
+                except Exception as e:
+                    logger.error("Kraken request failed (%s): %s", endpoint, e)
+                    return None
+
+    async def _private_request_async(self, session, endpoint, data=None):
+        """_private_request() over an aiohttp session, rate limited without blocking the loop."""
+        if data is None:
+            data = {}
+        with self._leased_key() as key:
+            limits, priority = self._limits(key, endpoint, data)
+            for bucket, cost in limits:
+                await bucket.acquire_async(cost, priority)
+            async with key.request_async():
+                uri_path, headers = self._signed(key, endpoint, data)
+                try:
+                    async with session.post(self.base_url + uri_path, headers=headers, data=data) as res:
+                        logger.debug("Kraken %s response status: %d", endpoint, res.status)
+                        return self._private_result(endpoint, await res.json(content_type=None), limits)
+                except Exception as e:
+                    logger.error("Kraken request failed (%s): %s", endpoint, e)
+                    return None
 
     def _public_request(self, endpoint, params=None):
         uri_path = "/0/public/" + endpoint
+        self.last_request = time()
         try:
-            res = requests.get(self.base_url + uri_path, params=params, timeout=10)
+            res = self.session.get(self.base_url + uri_path, params=params, timeout=10)
             r = res.json()
             if r.get("error") and len(r["error"]) > 0:
                 logger.error("Kraken public API error (%s): %s", endpoint, r["error"])
@@ -113,10 +306,19 @@ class KRAKEN:
         internal = trade + base
         return self.pair_map.get(internal)
 
-    def getMarketInfo(self, markets):
+    def _asset_pairs(self):
         result = self._public_request("AssetPairs")
         if result is None:
             return None
+        return parse_asset_pairs(result)
+
+    def getMarketInfo(self, markets):
+        if self.cache:
+            result = self.cache.get(self.cache.key("kraken-AssetPairs", self.base_url), self._asset_pairs)
+        else:
+            result = self._asset_pairs()
+        if result is None:
+            return None
 
         market_info = {}
         for market, info in markets.items():
@@ -125,9 +327,6 @@ class KRAKEN:
             want_base = info["base"]
 
             for pair_name, pair_data in result.items():
-                # Skip .d (dark pool) pairs
-                if pair_name.endswith(".d"):
-                    continue
                 p_base = pair_data.get("base", "")
                 p_quote = pair_data.get("quote", "")
                 # Convert Kraken prefixed names to internal names
@@ -149,11 +348,11 @@ class KRAKEN:
 
         return market_info
 
-    def order(self, currency, base_currency, rate, volume, side):
+    def _order_request(self, currency, base_currency, rate, volume, side, time_in_force):
         pair = self._kraken_pair(currency, base_currency)
         if not pair:
             logger.error("Unknown pair: %s%s", currency, base_currency)
-            return False
+            return None
 
         data = {
             "pair": pair,
@@ -162,23 +361,62 @@ class KRAKEN:
             "price": str(rate),
             "volume": str(volume),
         }
-        result = self._private_request("AddOrder", data)
+        if time_in_force != "GTC":
+            # Kraken has no fill-or-kill for spot; FOK orders go out as IOC
+            data["timeinforce"] = "IOC"
+        return data
+
+    def placedOrderData(self, order_id):
+        """Kraken's order responses carry no fill state: always None."""
+        return None
+
+    def _order_placed(self, result, currency, base_currency, rate, volume, side):
         if result and "txid" in result and len(result["txid"]) > 0:
             txid = result["txid"][0]
+            self._track_order(txid, self._kraken_pair(currency, base_currency))
             logger.info("Order placed: %s %s %s @ %s vol %s -> %s", side, currency, base_currency, rate, volume, txid)
             return txid
         return False
 
-    def closeOrder(self, order_id, currency, base_currency):
-        result = self._private_request("CancelOrder", {"txid": order_id})
+    def order(self, currency, base_currency, rate, volume, side, time_in_force="GTC"):
+        data = self._order_request(currency, base_currency, rate, volume, side, time_in_force)
+        if data is None:
+            return False
+        result = self._private_request("AddOrder", data)
+        return self._order_placed(result, currency, base_currency, rate, volume, side)
+
+    async def orderAsync(self, session, currency, base_currency, rate, volume, side, time_in_force="GTC"):
+        data = self._order_request(currency, base_currency, rate, volume, side, time_in_force)
+        if data is None:
+            return False
+        result = await self._private_request_async(session, "AddOrder", data)
+        return self._order_placed(result, currency, base_currency, rate, volume, side)
+
+    def getWebSocketsToken(self):
+        """Token for the authenticated WebSocket (valid 15 minutes until used to subscribe)."""
+        result = self._private_request("GetWebSocketsToken")
+        return result["token"] if result else None
+
+    def _order_closed(self, result, order_id):
         if result and result.get("count", 0) > 0:
             logger.info("Order cancelled: %s", order_id)
             return True
         logger.warning("Failed to cancel order: %s", order_id)
         return False
 
+    def closeOrder(self, order_id, currency, base_currency):
+        return self._order_closed(self._private_request("CancelOrder", {"txid": order_id}), order_id)
+
+    async def closeOrderAsync(self, session, order_id, currency, base_currency):
+        return self._order_closed(await self._private_request_async(session, "CancelOrder", {"txid": order_id}), order_id)
+
     def getOrderData(self, order_id, currency, base_currency):
-        result = self._private_request("QueryOrders", {"txid": order_id})
+        return self._order_data(self._private_request("QueryOrders", {"txid": order_id}), order_id)
+
+    async def getOrderDataAsync(self, session, order_id, currency, base_currency):
+        return self._order_data(await self._private_request_async(session, "QueryOrders", {"txid": order_id}), order_id)
+
+    def _order_data(self, result, order_id):
         if result and order_id in result:
             order = result[order_id]
             vol = Decimal(order["vol"])
@@ -215,3 +453,238 @@ class KRAKEN:
                 list(result.keys()), list(self.currencies.keys()),
             )
         return balances if balances else None
+
+
+class KRAKEN_WS(KRAKEN):
+    """KRAKEN placing and cancelling orders over the authenticated v2 WebSocket.
+
+    add_order / cancel_order answer in tens of milliseconds and carry no
+    nonce, so they do not wait for a key like private REST calls. Queries and balances
+    stay on REST. While the socket cannot be (re)connected, orders and
+    cancels fall back to REST. Every order carries a fresh order_userref:
+    when add_order gets no answer (timeout, disconnect) the order is looked
+    up by it over REST, and order() returns its id if Kraken has it. If not,
+    it may still be on its way, so unless the reply has come in meanwhile
+    order() returns ORDER_UNKNOWN, never False.
+    """
+
+    WS_TIMEOUT = 5.0
+    # Seconds to stay on REST after a failed connect
+    RECONNECT_DELAY = 10.0
+
+    def __init__(self, api_details, currencies, pool_size=4, retries=2, tier="starter", cache=None):
+        super().__init__(api_details, currencies, pool_size, retries, tier, cache)
+        self.ws_url = api_details.get("WS_AUTH_URL", "wss://ws-auth.kraken.com/v2")
+        self.ws = None
+        self._token = None
+        self._connect_lock = threading.Lock()
+        self._connected = threading.Event()
+        # req_id -> concurrent.futures.Future resolved with the result dict (None on error)
+        self._pending = {}
+        self._req_ids = itertools.count(1)
+        # order_userref values, unique within a process and unlikely to repeat one from a restart
+        self._userrefs = itertools.count(int(time() * 10) % 2 ** 30)
+        self._next_connect = 0
+
+    def connect(self):
+        """Open the socket if it is not open; False when it cannot be."""
+        with self._connect_lock:
+            if self.ws is not None and self._connected.is_set():
+                return True
+            if time() < self._next_connect:
+                return False
+            self._next_connect = time() + self.RECONNECT_DELAY
+            token = self.getWebSocketsToken()
+            if not token:
+                logger.error("Kraken WS orders: no WebSocket token")
+                return False
+            self._token = token
+            self._connected.clear()
+            self.ws = websocket.WebSocketApp(
+                self.ws_url,
+                on_open=lambda ws: self._connected.set(),
+                on_message=self._on_ws_message,
+                on_error=lambda ws, error: logger.error("Kraken WS orders error: %s", error),
+                on_close=self._on_ws_close,
+            )
+            threading.Thread(
+                target=self.ws.run_forever, kwargs={"ping_interval": 30, "ping_timeout": 10},
+                name="KRAKEN_WS_ORDERS", daemon=True,
+            ).start()
+            if not self._connected.wait(self.WS_TIMEOUT):
+                logger.error("Kraken WS orders: could not connect to %s", self.ws_url)
+                self.ws.close()
+                self.ws = None
+                return False
+            logger.info("Kraken WS orders connected")
+            self._next_connect = 0
+            return True
+
+    def _on_ws_close(self, ws, status=None, reason=None):
+        self._connected.clear()
+        logger.warning("Kraken WS orders disconnected (%s %s)", status, reason)
+        for req_id in list(self._pending):
+            future = self._pending.pop(req_id, None)
+            if future is not None and not future.done():
+                future.set_exception(ConnectionError("Kraken WS orders disconnected"))
+
+    def _on_ws_message(self, ws, message):
+        msg = json.loads(message)
+        future = self._pending.pop(msg.get("req_id"), None)
+        if future is None or future.done():
+            return
+        if msg.get("success"):
+            future.set_result(msg.get("result") or {})
+        else:
+            logger.error("Kraken WS %s failed: %s", msg.get("method"), msg.get("error"))
+            future.set_result(None)
+
+    def _send(self, method, params):
+        """Send a request; a Future of its result, or None when the socket is unavailable."""
+        if not self._connected.is_set() and not self.connect():
+            return None
+        req_id = next(self._req_ids)
+        future = concurrent.futures.Future()
+        self._pending[req_id] = future
+        params["token"] = self._token
+        try:
+            self.ws.send(json.dumps({"method": method, "params": params, "req_id": req_id}))
+        except Exception as e:
+            self._pending.pop(req_id, None)
+            logger.error("Kraken WS %s send failed: %s", method, e)
+            return None
+        return future
+
+    def _request(self, method, params, limits=None):
+        """(sent, answered, result): sent is False when the request never left, answered False when
+        it left but no reply came (timeout or disconnect). result is None on an error reply; with
+        no answer it is the request's Future, which a late reply may still resolve. limits() gives
+        the [(bucket, cost)] to charge, called only once the socket is up: a request that falls
+        back to REST is charged there instead."""
+        if not self._connected.is_set() and not self.connect():
+            return False, False, None
+        for bucket, cost in limits() if limits else ():
+            bucket.acquire(cost, PRIORITY_ORDER)
+        future = self._send(method, params)
+        if future is None:
+            return False, False, None
+        try:
+            return True, True, future.result(self.WS_TIMEOUT)
+        except (concurrent.futures.TimeoutError, ConnectionError) as e:
+            logger.error("Kraken WS %s got no answer: %s", method, str(e) or "timed out")
+            return True, False, future
+
+    async def _request_async(self, method, params, limits=None):
+        # Connecting fetches a token over REST; keep it off the loop
+        if not self._connected.is_set() and not await asyncio.to_thread(self.connect):
+            return False, False, None
+        for bucket, cost in limits() if limits else ():
+            await bucket.acquire_async(cost, PRIORITY_ORDER)
+        future = self._send(method, params)
+        if future is None:
+            return False, False, None
+        try:
+            # Shielded: the timeout must not cancel the Future a late reply resolves
+            return True, True, await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(future)), self.WS_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logger.error("Kraken WS %s got no answer: %s", method, str(e) or "timed out")
+            return True, False, future
+
+    def _ws_order_params(self, currency, base_currency, rate, volume, side, time_in_force):
+        if not self._kraken_pair(currency, base_currency):
+            logger.error("Unknown pair: %s%s", currency, base_currency)
+            return None
+        params = {
+            "order_type": "limit",
+            "side": side.lower(),
+            "symbol": internal_to_ws_pair(currency + base_currency),
+            "limit_price": float(rate),
+            "order_qty": float(volume),
+            "order_userref": next(self._userrefs),
+        }
+        if time_in_force != "GTC":
+            params["time_in_force"] = "ioc"
+        return params
+
+    def _ws_order_placed(self, result, currency, base_currency, rate, volume, side):
+        if result and result.get("order_id"):
+            return self._order_placed({"txid": [result["order_id"]]}, currency, base_currency, rate, volume, side)
+        return False
+
+    @staticmethod
+    def _lookup_args(params):
+        # Open orders have no time filter; closed ones since a little before the order went out
+        userref = params["order_userref"]
+        return {"userref": userref}, {"userref": userref, "start": int(time()) - 60}
+
+    def _looked_up(self, open_result, closed_result, late, params, currency, base_currency, rate, volume, side):
+        """order() result of an unanswered add_order, from its OpenOrders / ClosedOrders lookup
+        and its request's Future (late)."""
+        userref = params["order_userref"]
+        found = []
+        if open_result is not None and closed_result is not None:
+            found = list(open_result.get("open", {})) + list(closed_result.get("closed", {}))
+        if found:
+            logger.info("Kraken order %s: no answer, found as %s", userref, found[0])
+            return self._order_placed({"txid": found[:1]}, currency, base_currency, rate, volume, side)
+        if late.done() and not late.cancelled() and late.exception() is None:
+            # The reply came in during the lookup
+            return self._ws_order_placed(late.result(), currency, base_currency, rate, volume, side)
+        logger.error("Kraken order %s: no answer and not found, it may still be placed; not retrying", userref)
+        return ORDER_UNKNOWN
+
+    def _resolve_order(self, late, params, currency, base_currency, rate, volume, side):
+        open_args, closed_args = self._lookup_args(params)
+        return self._looked_up(
+            self._private_request("OpenOrders", open_args), self._private_request("ClosedOrders", closed_args),
+            late, params, currency, base_currency, rate, volume, side,
+        )
+
+    async def _resolve_order_async(self, session, late, params, currency, base_currency, rate, volume, side):
+        open_args, closed_args = self._lookup_args(params)
+        return self._looked_up(
+            await self._private_request_async(session, "OpenOrders", open_args),
+            await self._private_request_async(session, "ClosedOrders", closed_args),
+            late, params, currency, base_currency, rate, volume, side,
+        )
+
+    def order(self, currency, base_currency, rate, volume, side, time_in_force="GTC"):
+        params = self._ws_order_params(currency, base_currency, rate, volume, side, time_in_force)
+        if params is None:
+            return False
+        # WebSocket orders skip the API counter but not the trading counter
+        pair = self._kraken_pair(currency, base_currency)
+        sent, answered, result = self._request("add_order", params, lambda: [(self._trading_limit(pair), 1)])
+        if not sent:
+            return super().order(currency, base_currency, rate, volume, side, time_in_force)
+        if not answered:
+            return self._resolve_order(result, params, currency, base_currency, rate, volume, side)
+        return self._ws_order_placed(result, currency, base_currency, rate, volume, side)
+
+    async def orderAsync(self, session, currency, base_currency, rate, volume, side, time_in_force="GTC"):
+        params = self._ws_order_params(currency, base_currency, rate, volume, side, time_in_force)
+        if params is None:
+            return False
+        pair = self._kraken_pair(currency, base_currency)
+        sent, answered, result = await self._request_async("add_order", params, lambda: [(self._trading_limit(pair), 1)])
+        if not sent:
+            return await super().orderAsync(session, currency, base_currency, rate, volume, side, time_in_force)
+        if not answered:
+            return await self._resolve_order_async(session, result, params, currency, base_currency, rate, volume, side)
+        return self._ws_order_placed(result, currency, base_currency, rate, volume, side)
+
+    def closeOrder(self, order_id, currency, base_currency):
+        sent, answered, result = self._request(
+            "cancel_order", {"order_id": [order_id]}, lambda: self._cancel_limits(order_id),
+        )
+        if not sent:
+            return super().closeOrder(order_id, currency, base_currency)
+        return self._order_closed({"count": 1} if answered and result is not None else None, order_id)
+
+    async def closeOrderAsync(self, session, order_id, currency, base_currency):
+        sent, answered, result = await self._request_async(
+            "cancel_order", {"order_id": [order_id]}, lambda: self._cancel_limits(order_id),
+        )
+        if not sent:
+            return await super().closeOrderAsync(session, order_id, currency, base_currency)
+        return self._order_closed({"count": 1} if answered and result is not None else None, order_id)
@@ -0,0 +1,142 @@
+import os
+import json
+import gzip
+import queue
+import logging
+import threading
+from time import time, strftime, gmtime
+from decimal import Decimal
+
+from metrics import DROPPED
+
+logger = logging.getLogger(__name__)
+
+RECORDING_PREFIX = "market-"
+RECORDING_SUFFIX = ".jsonl.gz"
+# Frames queued before new ones are dropped; feed threads never wait on the disk
+RECORDER_QUEUE_SIZE = 100000
+
+
+def _json_default(value):
+    # Decimals (market info, wallets) are written as strings to keep full precision
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError("Cannot serialize %r" % (value,))
+
+
+class MARKET_RECORDER(threading.Thread):
+    """Append-only, gzip-compressed JSON-lines log of raw market-data frames.
+
+    Feed threads call record() with each frame as received; the frame is
+    timestamped and queued, and this thread does the encoding, compression
+    and file rotation. Every file starts with the same meta line so it can be
+    replayed on its own.
+
+    Line format: {"t": receive time, "x": exchange, "k": "msg" | "snapshot",
+    "s": symbol or null, "d": frame}. Kraken frames are the raw text, Binance
+    frames the decoded dicts handed to the stream callbacks and REST depth
+    snapshots.
+
+    A file is rotated once its compressed size reaches rotate_bytes. When
+    the disk falls behind, frames past RECORDER_QUEUE_SIZE are dropped and
+    counted in `dropped` (and arby_dropped_total{queue="recorder"}).
+    """
+
+    def __init__(self, directory, meta, rotate_bytes=256 * 1024 * 1024, rotate_seconds=3600):
+        threading.Thread.__init__(self)
+        self.name = "MARKET_RECORDER"
+        self.daemon = True
+        self.directory = directory
+        self.meta = meta
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self._queue = queue.Queue(RECORDER_QUEUE_SIZE)
+        self._file = None
+        self._start = 0
+        self._opened_at = 0
+        self.dropped = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, exchange, data, symbol=None, kind="msg"):
+        """Queue one frame; safe to call from any feed thread."""
+        try:
+            self._queue.put_nowait((time(), exchange, kind, symbol, data))
+        except queue.Full:
+            self._drop()
+            if self.dropped % 1000 == 1:
+                logger.warning("Market recorder queue full: %d frames dropped", self.dropped)
+
+    def _drop(self):
+        self.dropped += 1
+        DROPPED.inc("recorder")
+
+    def stop(self):
+        """Flush queued frames and close the current file."""
+        self._queue.put(None)
+        self.join(timeout=10)
+
+    def run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            t, exchange, kind, symbol, data = item
+            try:
+                line = json.dumps(
+                    {"t": t, "x": exchange, "k": kind, "s": symbol, "d": data},
+                    separators=(",", ":"), default=_json_default,
+                )
+                self._write(line, t)
+            except Exception as e:
+                self._drop()
+                logger.error("Market recorder failed to write frame: %s", e)
+        self._close()
+
+    def _write(self, line, t):
+        # fileobj is the file on disk: its position is the compressed size so far
+        if (self._file is None or self._file.fileobj.tell() - self._start >= self.rotate_bytes
+                or t - self._opened_at >= self.rotate_seconds):
+            self._open(t)
+        self._file.write((line + "\n").encode("utf-8"))
+
+    def _open(self, t):
+        self._close()
+        name = RECORDING_PREFIX + strftime("%Y%m%d-%H%M%S", gmtime(t)) + RECORDING_SUFFIX
+        path = os.path.join(self.directory, name)
+        # mode "ab": a restart within the same second appends a new gzip member
+        self._file = gzip.open(path, "ab", compresslevel=5)
+        self._start = self._file.fileobj.tell()
+        self._opened_at = t
+        meta = json.dumps({"t": t, "k": "meta", "d": self.meta}, separators=(",", ":"), default=_json_default)
+        self._file.write((meta + "\n").encode("utf-8"))
+        logger.info("Recording market data to %s", path)
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def recording_files(paths):
+    """Expand files/directories into recording files in chronological order."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, name) for name in os.listdir(path)
+                if name.startswith(RECORDING_PREFIX) and name.endswith(RECORDING_SUFFIX)
+            )
+        else:
+            files.append(path)
+    return sorted(files, key=os.path.basename)
+
+
+def read_recording(path):
+    """Yield decoded lines from one recording; a truncated tail (e.g. after a crash) ends the file."""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        try:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        except (EOFError, OSError, ValueError) as e:
+            logger.warning("Recording %s ends early: %s", path, e)
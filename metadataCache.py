@@ -0,0 +1,115 @@
+"""Exchange metadata (Binance exchangeInfo, Kraken AssetPairs) cached in memory and on disk."""
+import os
+import re
+import json
+import logging
+import threading
+from time import time
+
+logger = logging.getLogger(__name__)
+
+
+class METADATA_CACHE:
+    """Parsed exchange metadata kept for `ttl` seconds, shared by every caller.
+
+    get(key, fetch) returns the cached value while it is fresh. A stale
+    value in memory is still returned, and one background thread fetches
+    the new one. With nothing cached, or only a stale file on disk (a cold
+    start, where the caller builds market_info from it once), the caller
+    blocks on the fetch, and the stale file is served only if that fails.
+    Concurrent callers for the same key wait on that one fetch instead of
+    each starting their own. Values must be JSON serializable.
+    """
+
+    def __init__(self, directory=".cache", ttl=3600):
+        self.directory = directory
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (fetched at, value)
+        self._entries = {}
+        # key -> threading.Event set when the fetch in flight finishes
+        self._flights = {}
+
+    @staticmethod
+    def key(name, url):
+        """Cache key for a metadata endpoint; the host is part of it, so a simulator has its own."""
+        return re.sub(r"[^A-Za-z0-9_.-]", "_", "%s-%s" % (name, url.split("://")[-1].strip("/")))
+
+    def get(self, key, fetch):
+        """Cached value for key; fetch() returns a fresh one, or None on failure."""
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._load(key)
+            if entry is not None and time() - entry[0] > self.ttl:
+                value = self._refresh(key, fetch, background=False)
+                if value is None:
+                    logger.warning("Using %s from disk, %.0fs old", key, time() - entry[0])
+                    return entry[1]
+                return value
+        if entry is None:
+            return self._refresh(key, fetch, background=False)
+        if time() - entry[0] > self.ttl:
+            self._refresh(key, fetch, background=True)
+        return entry[1]
+
+    def _refresh(self, key, fetch, background):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = threading.Event()
+        if not leader:
+            if background:
+                return None
+            flight.wait()
+            entry = self._entries.get(key)
+            return entry[1] if entry else None
+        if background:
+            threading.Thread(
+                target=self._fetch, args=(key, fetch, flight), name="METADATA_REFRESH", daemon=True,
+            ).start()
+            return None
+        return self._fetch(key, fetch, flight)
+
+    def _fetch(self, key, fetch, flight):
+        try:
+            value = fetch()
+            if value is not None:
+                entry = (time(), value)
+                self._entries[key] = entry
+                self._save(key, entry)
+            return value
+        except Exception as e:
+            logger.warning("Refreshing %s failed: %s", key, e)
+            # Raise to the caller blocked on it; a background refresh keeps the stale value
+            if key not in self._entries:
+                raise
+            return None
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.set()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def _load(self, key):
+        try:
+            with open(self._path(key)) as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return None
+        entry = (stored["fetched_at"], stored["value"])
+        self._entries[key] = entry
+        return entry
+
+    def _save(self, key, entry):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(key)
+            # Write then rename, so a reader never sees half a file
+            with open(path + ".tmp", "w") as f:
+                json.dump({"fetched_at": entry[0], "value": entry[1]}, f)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logger.warning("Could not write %s: %s", self._path(key), e)
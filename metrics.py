@@ -0,0 +1,195 @@
+"""Latency histograms for the market-data and order pipeline, in Prometheus text format."""
+import bisect
+import threading
+
+# Bucket upper bounds in seconds, 100us to 30s
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0,
+)
+
+_registry = []
+
+
+class _SERIES:
+    """One label combination of a histogram."""
+
+    __slots__ = ("buckets", "counts", "sum", "count", "lock")
+
+    def __init__(self, buckets, lock):
+        self.buckets = buckets
+        # Per-bucket counts plus one for +Inf; made cumulative when rendered
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = lock
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+
+class HISTOGRAM:
+    """Fixed-bucket histogram; observe() is cheap enough for the feed threads.
+
+    Resolve labels once with labels() and keep the series on hot paths.
+    """
+
+    def __init__(self, name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def labels(self, *values):
+        if len(values) != len(self.label_names):
+            raise ValueError("%s takes labels %s" % (self.name, self.label_names))
+        series = self._series.get(values)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(values, _SERIES(self.buckets, self._lock))
+        return series
+
+    def observe(self, value, *label_values):
+        self.labels(*label_values).observe(value)
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help_text),
+            "# TYPE %s histogram" % self.name,
+        ]
+        with self._lock:
+            series = [(values, list(s.counts), s.sum, s.count) for values, s in sorted(self._series.items())]
+        for values, counts, total, count in series:
+            labels = ",".join('%s="%s"' % (k, _escape(v)) for k, v in zip(self.label_names, values))
+            prefix = labels + "," if labels else ""
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append('%s_bucket{%sle="%s"} %d' % (self.name, prefix, _format_bound(bound), cumulative))
+            lines.append('%s_bucket{%sle="+Inf"} %d' % (self.name, prefix, count))
+            suffix = "{%s}" % labels if labels else ""
+            lines.append("%s_sum%s %r" % (self.name, suffix, total))
+            lines.append("%s_count%s %d" % (self.name, suffix, count))
+        return lines
+
+
+class COUNTER:
+    """Monotonic count, e.g. of items a queue dropped; inc() is cheap enough for the feed threads."""
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        if len(label_values) != len(self.label_names):
+            raise ValueError("%s takes labels %s" % (self.name, self.label_names))
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help_text),
+            "# TYPE %s counter" % self.name,
+        ]
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            labels = ",".join('%s="%s"' % (k, _escape(v)) for k, v in zip(self.label_names, label_values))
+            lines.append("%s%s %d" % (self.name, "{%s}" % labels if labels else "", value))
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_bound(bound):
+    return repr(float(bound))
+
+
+def histogram(name, help_text, label_names=(), buckets=DEFAULT_BUCKETS):
+    """Create and register a histogram for render()."""
+    h = HISTOGRAM(name, help_text, label_names, buckets)
+    _registry.append(h)
+    return h
+
+
+def counter(name, help_text, label_names=()):
+    """Create and register a counter for render()."""
+    c = COUNTER(name, help_text, label_names)
+    _registry.append(c)
+    return c
+
+
+def render():
+    """All registered histograms and counters in the Prometheus text exposition format."""
+    lines = []
+    for h in _registry:
+        lines.extend(h.render())
+    return "\n".join(lines) + "\n"
+
+
+# --- Pipeline stages, in the order a trade passes through them ---
+
+FEED_LAG = histogram(
+    "arby_feed_lag_seconds",
+    "Exchange event time to WS frame receipt (frames that carry an event time)",
+    ("exchange",),
+)
+BOOK_APPLY = histogram(
+    "arby_book_apply_seconds",
+    "WS frame receipt to order book snapshot published",
+    ("exchange",),
+)
+COMPARE_WAIT = histogram(
+    "arby_compare_wait_seconds",
+    "Order book snapshot published to the compare loop picking it up",
+    ("exchange",),
+)
+COMPARE = histogram(
+    "arby_compare_seconds",
+    "Duration of one compare loop pass",
+    ("engine", "pass"),
+)
+DECISION = histogram(
+    "arby_decision_seconds",
+    "Newest leg book update to trade opportunity decided",
+    ("route_type",),
+)
+ORDER_ACK = histogram(
+    "arby_order_ack_seconds",
+    "Order sent to exchange acknowledgement (exchange.order round trip)",
+    ("exchange",),
+)
+ORDER_QUERY = histogram(
+    "arby_order_query_seconds",
+    "getOrderData round trip",
+    ("exchange",),
+)
+FILL_CONFIRM = histogram(
+    "arby_fill_confirm_seconds",
+    "Order sent to final state confirmed (user stream event or getOrderData)",
+    ("exchange",),
+)
+DB_SAVE = histogram(
+    "arby_db_save_seconds",
+    "One DB transaction: a trade and its legs, or a batch of the DB writer",
+    ("record",),
+)
+
+# --- Items dropped instead of blocking the pipeline ---
+
+DROPPED = counter(
+    "arby_dropped_total",
+    "Items dropped because a background writer's queue was full or the write failed",
+    ("queue",),
+)
@@ -0,0 +1,69 @@
+"""Coalesces consecutive opportunity ticks of a route into episodes."""
+import threading
+
+
+class EPISODE_TRACKER:
+    """Open opportunity episodes, keyed by route label and direction.
+
+    While a spread stays above threshold the compare loop reports it on
+    every pass. tick() opens an episode on the first report and folds the
+    following ones into it (tick count, spread sum and peak, executed
+    ticks). An episode closes once no tick has come for `gap` seconds;
+    expire() hands closed episodes to on_close, one dict each.
+    """
+
+    def __init__(self, gap, on_close):
+        self.gap = gap
+        self.on_close = on_close
+        self._lock = threading.Lock()
+        # (route label, sell exchange, buy exchange) -> episode dict
+        self._open = {}
+
+    def tick(self, route_type, label, sell_exchange, buy_exchange, spread_pct,
+             buy_rate, sell_rate, qty_a, qty_b, executed, now):
+        """Record one report of an opportunity; returns its tick number in the episode (1 opened it)."""
+        key = (label, sell_exchange, buy_exchange)
+        with self._lock:
+            episode = self._open.get(key)
+            if episode is not None and now - episode["ended_at"] > self.gap:
+                # Missed by expire(): the last one closed before this tick
+                self._close(key)
+                episode = None
+            if episode is None:
+                episode = self._open[key] = {
+                    "route_type": route_type, "route_label": label,
+                    "sell_exchange": sell_exchange, "buy_exchange": buy_exchange,
+                    "started_at": now, "ticks": 0, "spread_sum": 0, "peak_spread_pct": spread_pct,
+                    "executed_ticks": 0,
+                }
+            episode["ended_at"] = now
+            episode["ticks"] += 1
+            episode["spread_sum"] += spread_pct
+            if executed:
+                episode["executed_ticks"] += 1
+            if episode["ticks"] == 1 or spread_pct > episode["peak_spread_pct"]:
+                episode.update(
+                    peak_spread_pct=spread_pct, peak_buy_rate=buy_rate, peak_sell_rate=sell_rate,
+                    peak_qty_a=qty_a, peak_qty_b=qty_b,
+                )
+            return episode["ticks"]
+
+    def expire(self, now):
+        """Close the episodes with no tick for `gap` seconds."""
+        if not self._open:
+            return
+        with self._lock:
+            for key in [k for k, e in self._open.items() if now - e["ended_at"] > self.gap]:
+                self._close(key)
+
+    def close_all(self):
+        """Close every open episode, e.g. at shutdown."""
+        with self._lock:
+            for key in list(self._open):
+                self._close(key)
+
+    def _close(self, key):
+        episode = self._open.pop(key)
+        episode["avg_spread_pct"] = episode.pop("spread_sum") / episode["ticks"]
+        episode["duration"] = episode["ended_at"] - episode["started_at"]
+        self.on_close(episode)
@@ -0,0 +1,161 @@
+from array import array
+from bisect import bisect_left, insort
+from decimal import Decimal
+from time import time
+
+
+def to_ticks(value, precision):
+    """Scale a decimal string/number to an integer count of 10**-precision units, truncating."""
+    text = value if isinstance(value, str) else "{:f}".format(value)
+    if "e" in text or "E" in text:
+        # JSON numbers may arrive in exponent form, e.g. 4.995e-06
+        text = "{:f}".format(Decimal(text))
+    whole, _, frac = text.partition(".")
+    return int(whole + frac[:precision].ljust(precision, "0"))
+
+
+class SORTED_BOOK:
+    """One side of an order book, with price levels kept sorted via bisect.
+
+    Finding a level is O(log n), but inserting or deleting one shifts the
+    rest of the Python list, so updates are O(n). n is capped by the
+    subscribed depth (at most 1000 levels, usually 10-100), where that shift
+    is a short memmove and cheaper than a tree-based sorted container. The
+    best price is always at index 0 (highest for bids, lowest for asks).
+    """
+
+    def __init__(self, descending=False):
+        self.descending = descending
+        self._keys = []  # sort keys: prices, negated on the descending (bid) side
+        self._qty = {}   # price -> quantity
+
+    def __len__(self):
+        return len(self._keys)
+
+    def _key(self, price):
+        return -price if self.descending else price
+
+    def set(self, price, qty):
+        """Insert or replace a level; a zero quantity deletes it."""
+        if qty > 0:
+            if price not in self._qty:
+                insort(self._keys, self._key(price))
+            self._qty[price] = qty
+        elif price in self._qty:
+            del self._qty[price]
+            del self._keys[bisect_left(self._keys, self._key(price))]
+
+    def clear(self):
+        self._keys = []
+        self._qty = {}
+
+    def truncate(self, depth):
+        """Drop every level beyond the best `depth`."""
+        if len(self._keys) > depth:
+            for key in self._keys[depth:]:
+                del self._qty[self._key(key)]
+            del self._keys[depth:]
+
+    def columns(self, depth=None):
+        """Return the best `depth` levels as parallel (prices, qtys) lists, best first."""
+        keys = self._keys if depth is None else self._keys[:depth]
+        prices = [-k for k in keys] if self.descending else list(keys)
+        return prices, [self._qty[p] for p in prices]
+
+    def levels(self, depth=None):
+        """Return the best `depth` levels as [[price, qty], ...], best first."""
+        keys = self._keys if depth is None else self._keys[:depth]
+        if self.descending:
+            return [[-k, self._qty[-k]] for k in keys]
+        return [[k, self._qty[k]] for k in keys]
+
+
+class TICK_LEVELS:
+    """Immutable book side stored as scaled integers in array('q').
+
+    Indexing behaves like the [[Decimal, Decimal], ...] lists published in
+    decimal mode, materializing Decimal only for the levels actually read;
+    `top` holds the best price as a float for cheap route screening.
+    """
+
+    __slots__ = ("prices", "qtys", "price_precision", "qty_precision", "top")
+
+    def __init__(self, prices, qtys, price_precision, qty_precision):
+        self.prices = array("q", prices)
+        self.qtys = array("q", qtys)
+        self.price_precision = price_precision
+        self.qty_precision = qty_precision
+        self.top = self.prices[0] / 10 ** price_precision if self.prices else None
+
+    def __len__(self):
+        return len(self.prices)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self.prices)))]
+        return [
+            Decimal(self.prices[i]).scaleb(-self.price_precision),
+            Decimal(self.qtys[i]).scaleb(-self.qty_precision),
+        ]
+
+    def __iter__(self):
+        for i in range(len(self.prices)):
+            yield self[i]
+
+
+def top_price(levels):
+    """Best price of a published book side: a float screen value for tick books, else exact."""
+    if levels.__class__ is TICK_LEVELS:
+        return levels.top
+    return levels[0][0]
+
+
+# --- Published book snapshots ---
+#
+# Each market's entry in a feed's order_book dict is an immutable snapshot
+# {"buy", "sell", "lastUpdate", "version"}. The feed thread builds a new one
+# and swaps it in with a single dict assignment, so readers take a reference
+# once and see a consistent book without locking. Only the owning feed thread
+# publishes a given market, which keeps versions strictly increasing.
+
+class CLOCK:
+    """Time source for book timestamps and for the engine's book ages.
+
+    Wall time, unless `now` is set: replay.py sets it to each record's
+    time, so books age as they did in the recording, however fast it runs.
+    """
+
+    def __init__(self):
+        self.now = None
+
+    def __call__(self):
+        return time() if self.now is None else self.now
+
+
+clock = CLOCK()
+
+
+def empty_book():
+    """Snapshot for a market that has not received any data yet."""
+    return {"sell": None, "buy": None, "lastUpdate": None, "version": 0}
+
+
+def publish_book(order_book, market, buy, sell):
+    """Swap in a new snapshot for `market` with the next version number."""
+    order_book[market] = {
+        "buy": buy,
+        "sell": sell,
+        "lastUpdate": clock(),
+        "version": order_book[market]["version"] + 1,
+    }
+
+
+def clear_book(order_book, market):
+    """Publish an empty snapshot for `market` (e.g. while it resyncs), keeping lastUpdate."""
+    previous = order_book[market]
+    order_book[market] = {
+        "buy": None,
+        "sell": None,
+        "lastUpdate": previous["lastUpdate"],
+        "version": previous["version"] + 1,
+    }
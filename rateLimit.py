@@ -0,0 +1,129 @@
+"""Token buckets for exchange rate limits, shared by every thread and coroutine using a client."""
+import heapq
+import asyncio
+import itertools
+import threading
+from time import monotonic
+
+# Request priorities, lowest served first
+PRIORITY_ORDER = 0       # placing and cancelling orders
+PRIORITY_QUERY = 1       # order status while a trade runs
+PRIORITY_BACKGROUND = 2  # balances, market info, keep-alive pings
+
+
+class TOKEN_BUCKET:
+    """Thread-safe token bucket with priority queueing.
+
+    Holds up to `capacity` tokens, refilled at `rate` per second; a request
+    of weight w waits until w tokens are free. Waiters are served by
+    priority, then arrival, so an order never waits behind a balance poll
+    that came first. sync() lowers the level to what the exchange reports
+    as used, and hold() stops every request, e.g. for a Retry-After.
+    """
+
+    # Poll interval of acquire_async() callers that are not first in line
+    POLL = 0.01
+
+    def __init__(self, name, capacity, rate):
+        self.name = name
+        self.capacity = float(capacity)
+        self.rate = float(rate)
+        self._tokens = self.capacity
+        self._updated = monotonic()
+        self._held_until = 0.0
+        self._cond = threading.Condition()
+        # Heap of (priority, arrival) tickets; the smallest may take tokens
+        self._queue = []
+        self._arrivals = itertools.count()
+
+    def configure(self, capacity, rate):
+        """Change the limit, e.g. from limits the exchange publishes."""
+        with self._cond:
+            self._refill(monotonic())
+            self.capacity = float(capacity)
+            self.rate = float(rate)
+            self._tokens = min(self._tokens, self.capacity)
+            self._cond.notify_all()
+
+    def sync(self, used):
+        """The exchange reports `used` of the capacity spent; never hold more than the rest."""
+        with self._cond:
+            self._refill(monotonic())
+            self._tokens = min(self._tokens, self.capacity - used)
+
+    def hold(self, seconds):
+        """Empty the bucket and serve nothing for `seconds`."""
+        with self._cond:
+            now = monotonic()
+            self._refill(now)
+            self._tokens = 0.0
+            self._held_until = max(self._held_until, now + seconds)
+
+    def level(self):
+        """Tokens free now."""
+        with self._cond:
+            self._refill(monotonic())
+            return self._tokens
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _enqueue(self, priority):
+        ticket = (priority, next(self._arrivals))
+        heapq.heappush(self._queue, ticket)
+        # A more urgent ticket takes over: the current head must re-check
+        self._cond.notify_all()
+        return ticket
+
+    def _dequeue(self, ticket):
+        if ticket in self._queue:
+            self._queue.remove(ticket)
+            heapq.heapify(self._queue)
+            self._cond.notify_all()
+
+    def _try_take(self, ticket, cost):
+        """Take the tokens if ticket is first in line: 0, seconds to wait, or None (wait for a turn)."""
+        now = monotonic()
+        self._refill(now)
+        if now < self._held_until:
+            return self._held_until - now
+        if self._queue[0] != ticket:
+            return None
+        cost = min(cost, self.capacity)
+        if self._tokens >= cost:
+            self._tokens -= cost
+            heapq.heappop(self._queue)
+            self._cond.notify_all()
+            return 0
+        return (cost - self._tokens) / self.rate
+
+    def acquire(self, cost=1, priority=PRIORITY_BACKGROUND):
+        """Block until `cost` tokens are taken."""
+        with self._cond:
+            ticket = self._enqueue(priority)
+            try:
+                while True:
+                    wait = self._try_take(ticket, cost)
+                    if wait == 0:
+                        return
+                    self._cond.wait(wait)
+            except BaseException:
+                self._dequeue(ticket)
+                raise
+
+    async def acquire_async(self, cost=1, priority=PRIORITY_BACKGROUND):
+        """acquire() without blocking the event loop."""
+        with self._cond:
+            ticket = self._enqueue(priority)
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_take(ticket, cost)
+                if wait == 0:
+                    return
+                await asyncio.sleep(self.POLL if wait is None else wait)
+        except BaseException:
+            with self._cond:
+                self._dequeue(ticket)
+            raise
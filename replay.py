@@ -0,0 +1,168 @@
+"""Replay recorded market data through the order-book feeds and MAIN2, as fast as the CPU allows.
+
+    python replay.py recordings/ [--limit N] [--json]
+
+Recordings come from ARBY_RECORD_DIR (see marketRecorder.py). Currencies,
+pairs, market info and wallets are restored from the recording's meta line;
+engine settings (ARBY_COMPARE_ENGINE, ARBY_BOOK_REPR, ARBY_MIN_PROFIT, ...)
+come from the environment, so the same day can be replayed against engine
+changes. Replay is always dry-run and never touches the network or the DB.
+"""
+import os
+import sys
+import json
+import argparse
+import logging
+from time import perf_counter
+from decimal import Decimal
+
+from marketRecorder import recording_files, read_recording
+from orderBook import clock
+
+
+def _decimals(value):
+    """Undo the recorder's Decimal-as-string encoding in market info and wallets."""
+    if isinstance(value, dict):
+        return {k: _decimals(v) for k, v in value.items()}
+    if isinstance(value, str):
+        return Decimal(value)
+    return value
+
+
+def load_meta(files):
+    for record in read_recording(files[0]):
+        if record.get("k") == "meta":
+            return record["d"]
+        break
+    raise ValueError("%s does not start with a meta line" % files[0])
+
+
+def setup_engine(meta):
+    """Configure and import arby for a recorded session.
+
+    Returns (arby module, MAIN2, {exchange: feed}, changed) where changed is
+    the set the feeds add (exchange, market) to on every book update.
+    """
+    os.environ.update({
+        "ARBY_CURRENCIES": ",".join(meta["currencies"]),
+        "ARBY_PAIRS": ",".join(meta["pairs"]),
+        "ARBY_CURRENCY_BASES": meta["currency_bases"],
+        "ARBY_BINANCE_BOOK_MODE": meta["binance_book_mode"],
+        "ARBY_BINANCE_BOOK_DEPTH": str(meta["binance_book_depth"]),
+        "ARBY_KRAKEN_BOOK_DEPTH": str(meta["kraken_book_depth"]),
+        "ARBY_DRY_RUN": "true",
+    })
+    import arby
+
+    arby.market_info.update(_decimals(meta["market_info"]))
+    arby.wallets.update(_decimals(meta["wallets"]))
+
+    changed = set()
+
+    def on_update(exchange, market):
+        changed.add((exchange, market))
+
+    feeds = {
+        "binance": arby.BINANCE_ORDER_BOOK(
+            1, "BINANCE_ORDER_BOOK", arby.order_books["binance"], arby.binance_api_details,
+            on_update=on_update, mode=arby.BINANCE_BOOK_MODE, depth=arby.BINANCE_BOOK_DEPTH,
+            precisions=arby.book_precisions("binance"), ticks=arby.TICK_BOOKS, auto_snapshot=False,
+        ),
+        "kraken": arby.KRAKEN_ORDER_BOOK(
+            2, "KRAKEN_ORDER_BOOK", arby.order_books["kraken"], on_update=on_update,
+            depth=arby.KRAKEN_BOOK_DEPTH, precisions=arby.book_precisions("kraken"), ticks=arby.TICK_BOOKS,
+            publish_depth=arby.KRAKEN_PUBLISH_DEPTH,
+        ),
+    }
+    main = arby.MAIN2(3, "MAIN_LOOP")
+    return arby, main, feeds, changed
+
+
+def run_replay(paths, limit=None):
+    """Replay recordings and return throughput statistics."""
+    files = recording_files(paths)
+    if not files:
+        raise ValueError("No recordings found in %s" % (paths,))
+    arby, main, feeds, changed = setup_engine(load_meta(files))
+
+    opportunities = []
+    # Opportunities are counted instead of written to the DB; every tick, not a sample
+    arby.save_opportunity = lambda **kwargs: opportunities.append(kwargs)
+    arby.OPPORTUNITY_SAMPLE_EVERY = 1
+    arby.save_episode = lambda episode, dry_run: None
+    arby.rollups.add = lambda *args: None
+
+    messages = 0
+    first_t = last_t = None
+    last_sweep = None
+    started = perf_counter()
+    for path in files:
+        for record in read_recording(path):
+            kind = record["k"]
+            if kind == "meta":
+                continue
+            t = record["t"]
+            if first_t is None:
+                first_t = last_sweep = t
+            last_t = t
+            # Book timestamps and ages follow recorded time too
+            clock.now = t
+
+            if record["x"] == "kraken":
+                feeds["kraken"]._on_message(None, record["d"])
+            elif kind == "snapshot":
+                feeds["binance"]._apply_snapshot(record["s"], record["d"])
+            else:
+                feeds["binance"]._process_message(record["d"], record["s"])
+            messages += 1
+
+            # Sweeps follow recorded time, so results do not depend on replay speed
+            sweep = t - last_sweep >= arby.COMPARE_SWEEP_INTERVAL
+            if changed or sweep:
+                main.step(set(changed), sweep)
+                changed.clear()
+                if sweep:
+                    last_sweep = t
+            if limit and messages >= limit:
+                break
+        if limit and messages >= limit:
+            break
+    wall = perf_counter() - started
+    clock.now = None
+
+    span = (last_t - first_t) if messages else 0.0
+    return {
+        "files": len(files),
+        "messages": messages,
+        "recorded_seconds": round(span, 3),
+        "wall_seconds": round(wall, 3),
+        "messages_per_second": round(messages / wall, 1) if wall else 0.0,
+        "routes_evaluated": main.routes_evaluated,
+        "routes_per_second": round(main.routes_evaluated / wall, 1) if wall else 0.0,
+        "speedup": round(span / wall, 1) if wall else 0.0,
+        "opportunities": len(opportunities),
+        "engine": arby.COMPARE_ENGINE,
+        "book_repr": arby.BOOK_REPR,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded market data through the arbitrage engine")
+    parser.add_argument("paths", nargs="+", help="Recording files or directories")
+    parser.add_argument("--limit", type=int, default=None, help="Stop after this many messages")
+    parser.add_argument("--json", action="store_true", help="Print the statistics as JSON")
+    args = parser.parse_args()
+    # arby parses sys.argv on import
+    sys.argv = sys.argv[:1]
+
+    stats = run_replay(args.paths, limit=args.limit)
+    if args.json:
+        print(json.dumps(stats, indent=2))
+        return
+    for key, value in stats.items():
+        print("%-20s %s" % (key, value))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s [%(levelname)s] %(name)s: %(message)s")
+    main()
@@ -0,0 +1,62 @@
+"""Wallet balances and markets earmarked by trades in flight."""
+import itertools
+import threading
+from decimal import Decimal
+
+
+class RESERVATION_LEDGER:
+    """In-memory ledger of what every in-flight trade may still spend.
+
+    A trade reserves the (exchange, currency) amounts its legs draw from the
+    wallets and the (exchange, market) books it trades on. Route sizing
+    subtracts reserved amounts from the wallet balances, and a market is
+    traded by one route at a time, so routes with disjoint markets can run
+    in parallel without spending the same funds twice.
+
+    `amounts` is replaced, never modified, so sizing reads it without the
+    lock: one dict lookup per wallet on the hot path.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (exchange, currency) -> Decimal reserved; only currencies with something reserved
+        self.amounts = {}
+        # (exchange, market) of trades in flight
+        self._markets = set()
+        # reservation id -> (amounts, markets)
+        self._trades = {}
+        self._ids = itertools.count(1)
+
+    def reserve(self, amounts, trade_markets):
+        """Earmark amounts and markets; the reservation id, or None if a market is already in flight."""
+        trade_markets = set(trade_markets)
+        with self._lock:
+            if self._markets & trade_markets:
+                return None
+            reservation_id = next(self._ids)
+            self._trades[reservation_id] = (dict(amounts), trade_markets)
+            self._markets |= trade_markets
+            reserved = dict(self.amounts)
+            for key, amount in amounts.items():
+                reserved[key] = reserved.get(key, Decimal("0")) + amount
+            self.amounts = reserved
+            return reservation_id
+
+    def release(self, reservation_id):
+        with self._lock:
+            amounts, trade_markets = self._trades.pop(reservation_id, ({}, set()))
+            self._markets -= trade_markets
+            reserved = dict(self.amounts)
+            for key, amount in amounts.items():
+                left = reserved.get(key, Decimal("0")) - amount
+                if left > 0:
+                    reserved[key] = left
+                else:
+                    reserved.pop(key, None)
+            self.amounts = reserved
+
+    def reserved(self, exchange, currency):
+        return self.amounts.get((exchange, currency), Decimal("0"))
+
+    def in_flight(self):
+        return len(self._trades)
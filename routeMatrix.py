@@ -0,0 +1,138 @@
+import numpy as np
+
+from orderBook import top_price
+
+# Fields of the top-of-book matrix
+BID, ASK, TS = 0, 1, 2
+
+# Legs per route type as (side, field, route key): side 0 reads exchange A
+# (sell side of the pair), side 1 reads exchange B. Numerator legs come first.
+ROUTE_LEGS = {
+    "direct": ((0, BID, "market"), (1, ASK, "market")),
+    "multi_leg": ((0, BID, "buy_market"), (1, ASK, "sell_market"), (1, ASK, "cross_pair")),
+    "cross": ((0, BID, "market_x"), (1, BID, "market_y"), (0, ASK, "market_y"), (1, ASK, "market_x")),
+}
+# How many of the legs above are multiplied into the numerator
+NUMERATOR_LEGS = {"direct": 1, "multi_leg": 1, "cross": 2}
+
+
+class ROUTE_MATRIX:
+    """Top-of-book matrix (exchange x market x {bid, ask, ts}) for batch route evaluation.
+
+    Every route of a type is evaluated for every exchange pair at once; the
+    per-pair fee thresholds are precomputed, so only routes whose best pair
+    clears its threshold need the exact per-route path.
+    """
+
+    def __init__(self, exchanges, markets, routes, threshold_of, max_age):
+        self.exchanges = list(exchanges)
+        self.markets = sorted(markets)
+        self.ex_index = {e: i for i, e in enumerate(self.exchanges)}
+        self.market_index = {m: i for i, m in enumerate(self.markets)}
+        self.max_age = max_age
+        self.tob = np.full((len(self.exchanges), len(self.markets), 3), np.nan)
+        # Snapshot version last copied per (exchange, market); unchanged books are skipped
+        self.versions = {}
+        # Same order as the per-route comprehensions: for B ... for A ... if A != B
+        self.pairs = [(A, B) for B in self.exchanges for A in self.exchanges if A != B]
+        pair_a = np.array([self.ex_index[A] for A, _ in self.pairs], dtype=np.intp)
+        pair_b = np.array([self.ex_index[B] for _, B in self.pairs], dtype=np.intp)
+        self.pair_sides = (pair_a, pair_b)
+
+        self.groups = {}
+        for route_type, legs in ROUTE_LEGS.items():
+            typed = [r for r in routes if r["type"] == route_type]
+            if not typed:
+                continue
+            leg_markets = np.array(
+                [[self.market_index[r[key]] for _, _, key in legs] for r in typed], dtype=np.intp,
+            ).reshape(len(typed), len(legs))
+            thresholds = np.array(
+                [[float(threshold_of(r, A, B)) for A, B in self.pairs] for r in typed], dtype=float,
+            ).reshape(len(typed), len(self.pairs))
+            touches = np.zeros((len(typed), len(self.markets)), dtype=bool)
+            for i in range(len(legs)):
+                touches[np.arange(len(typed)), leg_markets[:, i]] = True
+            self.groups[route_type] = {
+                "routes": typed,
+                "legs": leg_markets,
+                "thresholds": thresholds,
+                "touches": touches,
+            }
+
+    def update(self, exchange, market, book):
+        """Copy one market's snapshot (best bid/ask, update time) into the matrix."""
+        e = self.ex_index.get(exchange)
+        m = self.market_index.get(market)
+        if e is None or m is None or self.versions.get((e, m)) == book["version"]:
+            return
+        self.versions[(e, m)] = book["version"]
+        row = self.tob[e, m]
+        row[BID] = float(top_price(book["buy"])) if book["buy"] else np.nan
+        row[ASK] = float(top_price(book["sell"])) if book["sell"] else np.nan
+        row[TS] = book["lastUpdate"] if book["lastUpdate"] is not None else np.nan
+
+    def refresh(self, order_books):
+        """Reload the whole matrix from {exchange: {market: book}}."""
+        for exchange, books in order_books.items():
+            for market in self.markets:
+                if market in books:
+                    self.update(exchange, market, books[market])
+
+    def evaluate(self, now, changed_markets=None):
+        """Compute every route's spread for every exchange pair.
+
+        Returns {route_type: result} where result holds, per route, the best
+        pair index, its arbitrage, the leg prices at that pair, the routes
+        touched by changed_markets (all when None) and the touched routes
+        whose best arbitrage clears the threshold. Missing, non-positive or
+        stale legs give an arbitrage of 0, as in the per-route path.
+        """
+        bid, ask, ts = self.tob[:, :, BID], self.tob[:, :, ASK], self.tob[:, :, TS]
+        with np.errstate(invalid="ignore"):
+            stale = (now - ts) > self.max_age
+        changed_idx = None
+        if changed_markets is not None:
+            changed_idx = [self.market_index[m] for m in changed_markets if m in self.market_index]
+
+        results = {}
+        for route_type, group in self.groups.items():
+            legs = group["legs"]
+            n_routes = len(group["routes"])
+            if changed_idx is None:
+                touched = np.ones(n_routes, dtype=bool)
+            else:
+                touched = group["touches"][:, changed_idx].any(axis=1)
+
+            prices = []
+            valid = np.ones((n_routes, len(self.pairs)), dtype=bool)
+            for i, (side, field, _) in enumerate(ROUTE_LEGS[route_type]):
+                ex = self.pair_sides[side][None, :]
+                m = legs[:, i][:, None]
+                leg = (bid if field == BID else ask)[ex, m]
+                valid &= (leg > 0) & ~stale[ex, m]
+                prices.append(leg)
+
+            split = NUMERATOR_LEGS[route_type]
+            with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+                arb = np.prod(prices[:split], axis=0) / np.prod(prices[split:], axis=0) - 1
+            arb = np.where(valid & np.isfinite(arb), arb, 0.0)
+
+            rows = np.arange(n_routes)
+            best_pair = arb.argmax(axis=1)
+            best_arb = arb[rows, best_pair]
+            best_prices = np.stack([np.nan_to_num(p[rows, best_pair]) for p in prices], axis=1)
+            best_prices[best_arb == 0] = 0.0
+            # Small tolerance so float rounding never hides a route the exact path would take
+            threshold = group["thresholds"][rows, best_pair]
+            candidates = touched & (best_arb >= threshold - 1e-12)
+
+            results[route_type] = {
+                "routes": group["routes"],
+                "best_pair": best_pair,
+                "best_arb": best_arb,
+                "prices": best_prices,
+                "touched": touched,
+                "candidates": candidates,
+            }
+        return results
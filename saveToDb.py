@@ -1,7 +1,15 @@
 import os
+import queue
 import logging
+import threading
+import contextlib
+from time import monotonic, perf_counter, sleep
+from decimal import Decimal, ROUND_HALF_UP
+from datetime import datetime, timedelta
 import pymysql
 
+from metrics import DB_SAVE, DROPPED
+
 logger = logging.getLogger(__name__)
 
 DB_HOST = os.environ.get("DB_HOST", "localhost")
@@ -9,66 +17,426 @@ DB_PORT = int(os.environ.get("DB_PORT", "3306"))
 DB_USER = os.environ.get("DB_USER", "")
 DB_PASSWORD = os.environ.get("DB_PASSWORD", "")
 DB_NAME = os.environ.get("DB_NAME", "")
+# Open connections kept for reuse, shared by queries and the batched writer
+DB_POOL_SIZE = int(os.environ.get("ARBY_DB_POOL_SIZE", "2"))
+# The writer commits queued rows once this many are waiting or after this many seconds
+DB_BATCH_SIZE = int(os.environ.get("ARBY_DB_BATCH_SIZE", "500"))
+DB_FLUSH_INTERVAL = float(os.environ.get("ARBY_DB_FLUSH_INTERVAL", "1.0"))
+# Rows the writer holds before new ones are dropped; callers never wait on the DB
+DB_QUEUE_SIZE = 100000
+# A connection idle this many seconds is pinged (and reconnected) before reuse
+DB_IDLE_PING = 60
+# While MySQL is unreachable the writer retries its batch, waiting up to this many seconds between tries
+DB_RETRY_MAX_WAIT = 30
+# MySQL errors that say nothing about the rows (server gone, too many connections, shutdown,
+# lock wait timeout, deadlock, connection killed); client errors (2000-2999) are retried too
+DB_RETRY_ERRNOS = {1040, 1053, 1205, 1213, 1927}
+# Rollup spread columns' scale
+SPREAD_SCALE = Decimal("0.000001")
+ROLLUP_COLUMNS = (
+    "bucket, route_label, buy_exchange, sell_exchange, "
+    "opportunities, spread_sum, spread_min, spread_max, executed, executed_spread_sum"
+)
+
+
+def _rollup_upsert(table):
+    """Add an aggregate of opportunities to its bucket; executemany sends a batch as one multi-row upsert."""
+    return (
+        "INSERT INTO " + table + " (" + ROLLUP_COLUMNS + ") "
+        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s) "
+        "ON DUPLICATE KEY UPDATE opportunities = opportunities + VALUES(opportunities), "
+        "spread_sum = spread_sum + VALUES(spread_sum), "
+        "spread_min = LEAST(spread_min, VALUES(spread_min)), "
+        "spread_max = GREATEST(spread_max, VALUES(spread_max)), "
+        "executed = executed + VALUES(executed), "
+        "executed_spread_sum = executed_spread_sum + VALUES(executed_spread_sum)"
+    )
+
+
+ROLLUP_HOURLY = _rollup_upsert("opportunity_rollup_hourly")
+ROLLUP_DAILY = _rollup_upsert("opportunity_rollup_daily")
 
 
 def conn_connect():
     return pymysql.connect(host=DB_HOST, port=DB_PORT, user=DB_USER, passwd=DB_PASSWORD, db=DB_NAME)
 
 
+class CONNECTION_POOL:
+    """Up to `size` open connections, reused instead of a connect per query."""
+
+    def __init__(self, size=DB_POOL_SIZE):
+        self._slots = threading.BoundedSemaphore(size)
+        # (connection, monotonic time it was returned), most recent last
+        self._idle = queue.LifoQueue()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """A connection for the block; one the block raised on is closed, not reused."""
+        with self._slots:
+            try:
+                conn, returned = self._idle.get_nowait()
+                if not conn.open or monotonic() - returned > DB_IDLE_PING:
+                    conn.ping(reconnect=True)
+            except queue.Empty:
+                conn = conn_connect()
+            try:
+                yield conn
+            except BaseException:
+                if conn.open:
+                    conn.close()
+                raise
+            self._idle.put((conn, monotonic()))
+
+
+pool = CONNECTION_POOL()
+
+
+@contextlib.contextmanager
+def transaction():
+    """A cursor on a pooled connection, committed after the block; rolled back if it raises."""
+    with pool.connection() as conn:
+        try:
+            with conn.cursor() as cur:
+                yield cur
+            conn.commit()
+        except BaseException:
+            if conn.open:
+                conn.rollback()
+            raise
+
+
 def mysql_query(query, params=None):
     response = None
-    conn = conn_connect()
-    cur = conn.cursor()
-    try:
-        cur.execute(query, params)
-        response = cur.fetchall()
-    except Exception as e:
-        logger.error("DB error executing query: %s | %s", query.split(" ")[:3], e)
-
-    conn.commit()
-    conn.close()
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(query, params)
+            response = cur.fetchall()
+        except Exception as e:
+            logger.error("DB error executing query: %s | %s", query.split(" ")[:3], e)
+            # The pool reconnects it on next use
+            if conn.open:
+                conn.close()
+            return None
+        conn.commit()
     return response
 
 
+def _retryable(e):
+    """True for errors after which the same rows may well succeed: connection loss and the like."""
+    if isinstance(e, pymysql.InterfaceError):
+        return True
+    if isinstance(e, pymysql.OperationalError):
+        errno = e.args[0] if e.args and isinstance(e.args[0], int) else 0
+        return errno in DB_RETRY_ERRNOS or 2000 <= errno < 3000
+    return False
+
+
+class DB_WRITER(threading.Thread):
+    """Writes queued INSERT rows in batches on its own thread.
+
+    write() only enqueues, so the compare loop and trade workers never wait
+    on MySQL. Rows are committed with one executemany per statement, once
+    DB_BATCH_SIZE rows are waiting or DB_FLUSH_INTERVAL seconds after the
+    first. A full queue drops rows (and logs how many) rather than block.
+    When MySQL is unreachable the batch is kept and retried with backoff
+    until it is back; rows queue up meanwhile. A batch MySQL rejects is
+    retried row by row, so only bad rows are lost; statements written
+    together with a row are retried and lost with it. Drops are counted in
+    `dropped` and arby_dropped_total{queue="db"}. Rows carry their own
+    timestamps, since they reach MySQL later.
+    """
+
+    def __init__(self, name="DB_WRITER", queue_size=DB_QUEUE_SIZE):
+        threading.Thread.__init__(self)
+        self.name = name
+        self.daemon = True
+        self.rows = queue.Queue(queue_size)
+        self.dropped = 0
+        # Rows of a batch that failed on a connection error, written before anything newer
+        self._retry = []
+        # Held while a batch is written, so flush() returns once queued rows are in the DB
+        self._write_lock = threading.Lock()
+
+    def write(self, query, params, also=()):
+        """Queue a row; also holds more (query, params) that must be written in the same transaction."""
+        try:
+            self.rows.put_nowait(((query, params),) + tuple(also))
+        except queue.Full:
+            self._drop(1)
+            if self.dropped % 1000 == 1:
+                logger.warning("DB writer queue full: %d rows dropped", self.dropped)
+
+    def _drop(self, count):
+        self.dropped += count
+        DROPPED.inc("db", amount=count)
+
+    def run(self):
+        wait = 1
+        while True:
+            if self._retry:
+                sleep(wait)
+                wait = min(wait * 2, DB_RETRY_MAX_WAIT)
+                with self._write_lock:
+                    if self._retry:
+                        self._retry = self._write(self._retry)
+                if self._retry:
+                    continue
+                logger.info("DB writer reconnected")
+                wait = 1
+            batch = [self.rows.get()]
+            deadline = monotonic() + DB_FLUSH_INTERVAL
+            while len(batch) < DB_BATCH_SIZE:
+                wait = deadline - monotonic()
+                if wait <= 0:
+                    break
+                try:
+                    batch.append(self.rows.get(timeout=wait))
+                except queue.Empty:
+                    break
+            with self._write_lock:
+                self._retry = self._write(batch)
+
+    def flush(self):
+        """Write everything queued now, on the calling thread (e.g. at exit)."""
+        with self._write_lock:
+            batch, self._retry = self._retry, []
+            while True:
+                try:
+                    batch.append(self.rows.get_nowait())
+                except queue.Empty:
+                    break
+            if batch:
+                self._retry = self._write(batch)
+            if self._retry:
+                logger.error("DB unreachable: %d rows not written", len(self._retry))
+
+    def _write(self, batch):
+        """Write a batch; returns the rows to retry once MySQL is reachable again (empty if none)."""
+        # Statement -> rows, in first-queued order
+        statements = {}
+        for unit in batch:
+            for query, params in unit:
+                statements.setdefault(query, []).append(params)
+        started = perf_counter()
+        try:
+            with transaction() as cur:
+                for query, rows in statements.items():
+                    cur.executemany(query, rows)
+        except Exception as e:
+            if _retryable(e):
+                logger.error("DB writer cannot reach MySQL, keeping %d rows to retry: %s", len(batch), e)
+                return batch
+            logger.warning("DB writer batch of %d rows failed, writing them one by one: %s", len(batch), e)
+            return self._write_rows(batch)
+        finally:
+            DB_SAVE.observe(perf_counter() - started, "batch")
+        return []
+
+    def _write_rows(self, batch):
+        dropped, error = 0, None
+        for i, unit in enumerate(batch):
+            try:
+                with transaction() as cur:
+                    for query, params in unit:
+                        cur.execute(query, params)
+            except Exception as e:
+                if _retryable(e):
+                    logger.error("DB writer cannot reach MySQL, keeping %d rows to retry: %s", len(batch) - i, e)
+                    batch = batch[i:]
+                    break
+                dropped, error = dropped + 1, e
+        else:
+            batch = []
+        if dropped:
+            self._drop(dropped)
+            logger.error("DB writer dropped %d rows MySQL rejected: %s", dropped, error)
+        return batch
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def db_writer():
+    """The process's DB_WRITER, started on first use."""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                writer = DB_WRITER()
+                writer.start()
+                _writer = writer
+    return _writer
+
+
 def save_wallets(wallets):
+    writer = db_writer()
+    now = datetime.now()
     for curr, balance in wallets.items():
-        mysql_query(
-            "INSERT INTO balances (currency, balance, ts) VALUES (%s, %s, current_timestamp)",
-            (curr, str(balance)),
+        writer.write(
+            "INSERT INTO balances (currency, balance, ts) VALUES (%s, %s, %s)",
+            (curr, str(balance), now),
         )
 
 
-def save_order(market):
-    mysql_query(
-        "INSERT INTO orders (ts, market) VALUES (current_timestamp, %s)",
-        (market,),
+def save_trade_record(market, legs):
+    """Insert a trade into orders and the fills of all its legs into order_details, in one transaction.
+
+    Returns the new orders id, or None if nothing was saved.
+    """
+    started = perf_counter()
+    try:
+        with transaction() as cur:
+            cur.execute("INSERT INTO orders (ts, market) VALUES (current_timestamp, %s)", (market,))
+            order_id = cur.lastrowid
+            rows = [
+                (order_id, str(order["volume"]), str(order["rate"]), order["id"], td.get("exchange", ""),
+                 order.get("side", td.get("side", "")))
+                for td in legs for order in td.get("orderData", [])
+            ]
+            if rows:
+                # One multi-row INSERT
+                cur.executemany(
+                    "INSERT INTO order_details (id, volume, rate, origId, exchange, side) VALUES (%s, %s, %s, %s, %s, %s)",
+                    rows,
+                )
+        return order_id
+    except Exception as e:
+        logger.error("Could not save trade %s: %s", market, e)
+        return None
+    finally:
+        DB_SAVE.observe(perf_counter() - started, "trade")
+
+
+def save_episode(episode, dry_run):
+    """Queue a closed opportunity episode (see opportunityEpisodes.EPISODE_TRACKER)."""
+    db_writer().write(
+        "INSERT INTO opportunity_episodes "
+        "(started_at, ended_at, duration_s, route_type, route_label, buy_exchange, sell_exchange, ticks, "
+        "peak_spread_pct, avg_spread_pct, peak_buy_rate, peak_sell_rate, peak_qty_a, peak_qty_b, "
+        "executed_ticks, dry_run) "
+        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+        (datetime.fromtimestamp(episode["started_at"]), datetime.fromtimestamp(episode["ended_at"]),
+         round(episode["duration"], 3), episode["route_type"], episode["route_label"],
+         episode["buy_exchange"], episode["sell_exchange"], episode["ticks"],
+         str(episode["peak_spread_pct"]), str(episode["avg_spread_pct"]),
+         str(episode["peak_buy_rate"]), str(episode["peak_sell_rate"]),
+         str(episode["peak_qty_a"]), str(episode["peak_qty_b"]),
+         episode["executed_ticks"], dry_run),
     )
-    result = mysql_query("SELECT max(id) FROM orders")
-    if result:
-        return result[0][0]
-    return None
-
-
-def save_order_data(order_info, order_id):
-    exchange = order_info.get("exchange", "")
-    side = order_info.get("side", "")
-    for order in order_info.get("orderData", []):
-        mysql_query(
-            "INSERT INTO order_details (id, volume, rate, origId, exchange, side) VALUES (%s, %s, %s, %s, %s, %s)",
-            (order_id, str(order["volume"]), str(order["rate"]), order["id"], exchange, side),
-        )
 
 
 def save_opportunity(route_type, route_label, buy_exchange, sell_exchange,
                      spread_pct, buy_rate, sell_rate, cross_rate,
                      qty_a, qty_b, executed, dry_run):
-    mysql_query(
+    db_writer().write(
         "INSERT INTO opportunities "
-        "(route_type, route_label, buy_exchange, sell_exchange, spread_pct, "
+        "(ts, route_type, route_label, buy_exchange, sell_exchange, spread_pct, "
         "buy_rate, sell_rate, cross_rate, qty_a, qty_b, executed, dry_run) "
-        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-        (route_type, route_label, buy_exchange, sell_exchange,
+        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+        (datetime.now(), route_type, route_label, buy_exchange, sell_exchange,
          str(spread_pct), str(buy_rate), str(sell_rate),
          str(cross_rate) if cross_rate is not None else None,
          str(qty_a), str(qty_b), executed, dry_run),
     )
+
+
+class OPPORTUNITY_ROLLUPS:
+    """Hourly aggregates of every opportunity tick, upserted into the rollup tables.
+
+    add() is called for each tick, sampled into opportunities or not, and
+    only updates a dict. flush() hands the aggregates gathered since the
+    last flush to the DB writer, each hour's bucket together with its day's
+    in one unit, so the hourly and daily tables never disagree.
+    """
+
+    def __init__(self, interval=DB_FLUSH_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        # (hour, route label, buy exchange, sell exchange) -> [ticks, spread sum, min, max, executed, executed sum]
+        self._buckets = {}
+        self._flushed = monotonic()
+
+    def add(self, route_label, buy_exchange, sell_exchange, spread_pct, executed, now):
+        hour = datetime.fromtimestamp(now).replace(minute=0, second=0, microsecond=0)
+        key = (hour, route_label, buy_exchange, sell_exchange)
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [0, 0, spread_pct, spread_pct, 0, 0]
+            bucket[0] += 1
+            bucket[1] += spread_pct
+            if spread_pct < bucket[2]:
+                bucket[2] = spread_pct
+            if spread_pct > bucket[3]:
+                bucket[3] = spread_pct
+            if executed:
+                bucket[4] += 1
+                bucket[5] += spread_pct
+
+    def flush(self, force=False):
+        """Queue the aggregates, at most once per interval unless forced (e.g. at exit)."""
+        if not force and monotonic() - self._flushed < self.interval:
+            return
+        with self._lock:
+            buckets, self._buckets = self._buckets, {}
+            self._flushed = monotonic()
+        writer = db_writer() if buckets else None
+        for (hour, label, buy_exchange, sell_exchange), (ticks, total, low, high, executed, executed_total) in buckets.items():
+            rollup = (label, buy_exchange, sell_exchange, ticks, _spread(total), _spread(low), _spread(high),
+                      executed, _spread(executed_total))
+            writer.write(ROLLUP_HOURLY, (hour,) + rollup, also=((ROLLUP_DAILY, (hour.date(),) + rollup),))
+
+
+def _spread(value):
+    return str(Decimal(str(value)).quantize(SPREAD_SCALE, ROUND_HALF_UP))
+
+
+def backfill_rollups(start=None, end=None):
+    """Fill the rollups of days start..end (dates, default all of opportunities) from opportunities.
+
+    Only hours with no hourly rollup yet are aggregated from opportunities:
+    hours the bot rolled up live counted every tick, while opportunities
+    holds only sampled ones. Daily rows are then rebuilt from the hourly
+    ones. Each day is one transaction. Returns the number of days filled.
+    """
+    result = mysql_query("SELECT DATE(MIN(ts)), DATE(MAX(ts)) FROM opportunities")
+    if not result or result[0][0] is None:
+        return 0
+    first, last = result[0]
+    day, end = start or first, end or last
+    days = 0
+    while day <= end:
+        next_day = day + timedelta(days=1)
+        with transaction() as cur:
+            cur.execute(
+                "SELECT DISTINCT bucket FROM opportunity_rollup_hourly WHERE bucket >= %s AND bucket < %s",
+                (day, next_day),
+            )
+            rolled_up = {row[0] for row in cur.fetchall()}
+            hour = datetime(day.year, day.month, day.day)
+            while hour.date() == day:
+                if hour not in rolled_up:
+                    cur.execute(
+                        "INSERT INTO opportunity_rollup_hourly (" + ROLLUP_COLUMNS + ") "
+                        "SELECT %s, route_label, buy_exchange, sell_exchange, "
+                        "COUNT(*), SUM(spread_pct), MIN(spread_pct), MAX(spread_pct), "
+                        "SUM(executed), SUM(IF(executed, spread_pct, 0)) "
+                        "FROM opportunities WHERE ts >= %s AND ts < %s GROUP BY 2, 3, 4",
+                        (hour, hour, hour + timedelta(hours=1)),
+                    )
+                hour += timedelta(hours=1)
+            cur.execute("DELETE FROM opportunity_rollup_daily WHERE bucket = %s", (day,))
+            cur.execute(
+                "INSERT INTO opportunity_rollup_daily (" + ROLLUP_COLUMNS + ") "
+                "SELECT DATE(bucket), route_label, buy_exchange, sell_exchange, "
+                "SUM(opportunities), SUM(spread_sum), MIN(spread_min), MAX(spread_max), "
+                "SUM(executed), SUM(executed_spread_sum) "
+                "FROM opportunity_rollup_hourly WHERE bucket >= %s AND bucket < %s GROUP BY 1, 2, 3, 4",
+                (day, next_day),
+            )
+        logger.info("Rolled up %s", day)
+        day = next_day
+        days += 1
+    return days
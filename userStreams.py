@@ -0,0 +1,521 @@
+"""Order updates pushed by the exchanges' user data streams.
+
+Binance sends executionReport events over the WebSocket API user data
+subscription, Kraken sends the authenticated v2 "executions" channel. Both
+feed one FILL_TRACKER, which order code waits on instead of sleeping and
+then cancelling and querying each order over REST.
+
+The same connections carry balances (Binance outboundAccountPosition, the
+Kraken v2 "balances" channel), which a WALLET_TRACKER writes into the bot's
+wallets; REST balances are only polled now and then to check for drift.
+"""
+import json
+import asyncio
+import logging
+import threading
+from time import time, sleep
+from decimal import Decimal
+from datetime import datetime
+
+import websocket
+from binance import ThreadedWebsocketManager
+
+from binanceOrderBook import CUSTOM_URL_WEBSOCKET_MANAGER
+from krakenOrderBook import ws_pair_to_internal
+
+logger = logging.getLogger(__name__)
+
+# Binance order statuses that leave nothing resting on the book
+BINANCE_CLOSED = ("FILLED", "CANCELED", "REJECTED", "EXPIRED", "EXPIRED_IN_MATCH")
+# Kraken v2 order statuses for orders still on the book
+KRAKEN_OPEN = ("pending_new", "new", "partially_filled")
+
+
+class FILL_TRACKER:
+    """Latest pushed state of every order, keyed by (exchange, order id).
+
+    Stream threads call update(); order code waits for an order to close
+    with wait() or wait_async(). An event can arrive before the REST call
+    that placed the order returns, so states are kept for ids nobody waits
+    on yet, and dropped once closed for KEEP seconds.
+    """
+
+    KEEP = 600
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        # (exchange, order id) -> {"quantity", "executed", "price", "open", "t"}
+        self._orders = {}
+        # (exchange, order id) -> [(loop, future)] of wait_async() callers
+        self._waiters = {}
+        # exchange -> True while its stream is subscribed
+        self._live = {}
+        self._last_prune = time()
+
+    def set_live(self, exchange, live):
+        with self._cond:
+            self._live[exchange] = live
+
+    def live(self, exchange):
+        return self._live.get(exchange, False)
+
+    def update(self, exchange, order_id, quantity, executed, price, is_open):
+        """Record an event; quantity and price may be None when the event leaves them out."""
+        key = (exchange, order_id)
+        now = time()
+        with self._cond:
+            state = self._orders.get(key)
+            # A closed order never reopens; ignore late events for it
+            if state is not None and not state["open"]:
+                return
+            if quantity is None or price is None:
+                if state is None:
+                    return
+                quantity = state["quantity"] if quantity is None else quantity
+                price = state["price"] if price is None else price
+            self._orders[key] = state = {
+                "quantity": Decimal(quantity), "executed": Decimal(executed),
+                "price": str(price), "open": is_open, "t": now,
+            }
+            if not is_open:
+                self._cond.notify_all()
+                data = self._order_data(state)
+                for loop, future in self._waiters.pop(key, ()):
+                    loop.call_soon_threadsafe(_resolve, future, data)
+            if now - self._last_prune > self.KEEP:
+                self._prune(now)
+
+    def _prune(self, now):
+        self._last_prune = now
+        stale = [k for k, s in self._orders.items() if not s["open"] and now - s["t"] > self.KEEP]
+        for key in stale:
+            del self._orders[key]
+
+    @staticmethod
+    def _order_data(state):
+        """A closed order's state in getOrderData's format."""
+        return {
+            "quantity": str(state["quantity"]),
+            "price": state["price"],
+            "quantityRemaining": state["quantity"] - state["executed"],
+            "open": state["open"],
+        }
+
+    def _closed(self, key):
+        state = self._orders.get(key)
+        if state is None or state["open"]:
+            return None
+        return self._order_data(state)
+
+    def wait(self, exchange, order_id, timeout):
+        """Block until the order is filled or cancelled; its order data, or None on timeout."""
+        key = (exchange, order_id)
+        with self._cond:
+            self._cond.wait_for(lambda: self._closed(key) is not None, timeout)
+            return self._closed(key)
+
+    async def wait_async(self, exchange, order_id, timeout):
+        """wait() for coroutines on any event loop."""
+        key = (exchange, order_id)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._cond:
+            data = self._closed(key)
+            if data is not None:
+                return data
+            self._waiters.setdefault(key, []).append((loop, future))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            with self._cond:
+                waiters = self._waiters.get(key)
+                if waiters and (loop, future) in waiters:
+                    waiters.remove((loop, future))
+                    if not waiters:
+                        del self._waiters[key]
+
+
+def _resolve(future, data):
+    if not future.done():
+        future.set_result(data)
+
+
+def _kraken_time(stamp):
+    """Kraken v2 RFC 3339 timestamp to epoch seconds."""
+    return datetime.fromisoformat(stamp.replace("Z", "+00:00")).timestamp()
+
+
+def _kraken_asset(asset):
+    return "BTC" if asset == "XBT" else asset
+
+
+class WALLET_TRACKER:
+    """Keeps a wallets dict ({exchange: {currency: {"available", "reserved", "total"}}}) current.
+
+    Stream threads report fills and pushed balances. A fill moves the
+    balances of its market at once, as an estimate; a pushed balance is the
+    exchange's own figure and replaces it. Each currency remembers the time
+    of its last pushed balance, and a fill from before then is already in
+    it and not applied again.
+    """
+
+    def __init__(self, wallets, lock, markets):
+        self.wallets = wallets
+        self.lock = lock
+        # market -> {"trade", "base"}
+        self.markets = markets
+        # (exchange, currency) -> exchange time of the last pushed balance
+        self._stamps = {}
+        self._live = {}
+
+    def set_live(self, exchange, live):
+        self._live[exchange] = live
+
+    def live(self, exchange):
+        return self._live.get(exchange, False)
+
+    def _move(self, exchange, currency, amount, stamp):
+        if stamp <= self._stamps.get((exchange, currency), 0):
+            return
+        balance = self.wallets.get(exchange, {}).get(currency)
+        if balance is None:
+            return
+        balance["available"] += amount
+        balance["total"] += amount
+
+    def fill(self, exchange, market, side, quantity, price, stamp, fee=None, fee_currency=None):
+        """Apply a fill of quantity at price; stamp is the trade's exchange time in epoch seconds."""
+        m = self.markets.get(market)
+        if m is None:
+            return
+        quantity, price = Decimal(quantity), Decimal(price)
+        sign = 1 if side.upper() == "BUY" else -1
+        with self.lock:
+            self._move(exchange, m["trade"], sign * quantity, stamp)
+            self._move(exchange, m["base"], -sign * quantity * price, stamp)
+            if fee and fee_currency:
+                self._move(exchange, fee_currency, -Decimal(fee), stamp)
+
+    def set_balance(self, exchange, currency, available, reserved, stamp):
+        """A pushed balance; ignored for currencies the wallets do not track."""
+        with self.lock:
+            wallet = self.wallets.get(exchange)
+            if wallet is None or currency not in wallet:
+                return
+            available, reserved = Decimal(available), Decimal(reserved)
+            wallet[currency] = {"available": available, "reserved": reserved, "total": available + reserved}
+            self._stamps[(exchange, currency)] = max(stamp, self._stamps.get((exchange, currency), 0))
+
+    def reconcile(self, exchange, funds, tolerance):
+        """Replace an exchange's wallet with a REST snapshot; the currencies that drifted."""
+        drifted = []
+        with self.lock:
+            wallet = self.wallets.get(exchange, {})
+            for currency, balance in funds.items():
+                held = wallet.get(currency, {}).get("total", Decimal("0"))
+                if abs(held - balance["total"]) > tolerance * max(abs(balance["total"]), Decimal("1e-8")):
+                    drifted.append((currency, held, balance["total"]))
+            self.wallets[exchange] = funds
+        return drifted
+
+
+class WALLET_RECONCILER(threading.Thread):
+    """Polls REST balances every `interval` seconds and reports drift from the streamed wallets.
+
+    busy() is checked first: while a trade is in flight, streamed and REST
+    balances legitimately disagree, so the check waits for the next round.
+    """
+
+    # Relative difference reported as drift
+    TOLERANCE = Decimal("0.001")
+
+    def __init__(self, exchanges, tracker, interval=60, busy=lambda: False):
+        threading.Thread.__init__(self)
+        self.name = "WALLET_RECONCILER"
+        self.daemon = True
+        self.exchanges = exchanges
+        self.tracker = tracker
+        self.interval = interval
+        self.busy = busy
+
+    def run(self):
+        while True:
+            sleep(self.interval)
+            if self.busy():
+                continue
+            for name, client in self.exchanges.items():
+                try:
+                    funds = client.getBalances()
+                except Exception as e:
+                    logger.warning("Balance reconciliation for %s failed: %s", name, e)
+                    continue
+                if funds is None or self.busy():
+                    continue
+                for currency, held, fetched in self.tracker.reconcile(name, funds, self.TOLERANCE):
+                    logger.warning(
+                        "Balance drift on %s %s: tracked %s, exchange reports %s", name, currency, held, fetched,
+                    )
+
+
+class _ENTERED_SOCKET:
+    """A socket already entered, for the `async with` in start_listener()."""
+
+    def __init__(self, socket):
+        self.socket = socket
+
+    async def __aenter__(self):
+        return self.socket
+
+    async def __aexit__(self, *args):
+        return await self.socket.__aexit__(*args)
+
+
+class _REPORTED_SUBSCRIPTION:
+    """start_listener() that tells the callback how the user data subscription went.
+
+    python-binance subscribes as the listener enters the socket; a failure
+    there ends the listener task with no message at all. The callback now
+    gets {"e": "subscribed"} once Binance confirms, or an "error" event.
+    """
+
+    async def start_listener(self, socket, path, callback):
+        try:
+            await socket.__aenter__()
+        except Exception as e:
+            self._socket_running.pop(path, None)
+            callback({"e": "error", "type": e.__class__.__name__, "m": "subscribe failed: %s" % e})
+            return
+        callback({"e": "subscribed"})
+        await super().start_listener(_ENTERED_SOCKET(socket), path, callback)
+
+
+class USER_SOCKET_MANAGER(_REPORTED_SUBSCRIPTION, ThreadedWebsocketManager):
+    pass
+
+
+class CUSTOM_URL_USER_SOCKET_MANAGER(_REPORTED_SUBSCRIPTION, CUSTOM_URL_WEBSOCKET_MANAGER):
+    pass
+
+
+class BINANCE_USER_STREAM(threading.Thread):
+    """Binance user data stream feeding executionReport events to a FILL_TRACKER,
+    and fills and outboundAccountPosition balances to a WALLET_TRACKER if given.
+
+    The stream counts as live from the confirmed subscription (or its first
+    event) until an error. A watchdog restarts it when the subscription is
+    not confirmed in time or the socket manager or listener has stopped.
+    """
+
+    # Seconds the user data subscription may take before the stream is restarted
+    SUBSCRIBE_TIMEOUT = 30
+    # Seconds between the watchdog's checks
+    WATCHDOG_INTERVAL = 10
+
+    def __init__(self, threadId, name, api_details, tracker, wallets=None):
+        threading.Thread.__init__(self)
+        self.threadId = threadId
+        self.name = name
+        self.api_details = api_details
+        self.tracker = tracker
+        self.wallets = wallets
+        self.daemon = True
+        self.twm = None
+        self._socket = None
+        self._opened = 0
+        self._subscribed = threading.Event()
+        self._restart = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                self._start_ws()
+                while not self._restart.wait(self.WATCHDOG_INTERVAL):
+                    problem = self._check()
+                    if problem:
+                        logger.error("Binance user stream %s; restarting", problem)
+                        break
+            except Exception as e:
+                logger.error("Binance user stream error: %s", e)
+            self._set_live(False)
+            self._stop_ws()
+            self._restart.clear()
+            logger.info("Binance user stream reconnecting in 5s")
+            sleep(5)
+
+    def _check(self):
+        """What is wrong with the running stream, or None."""
+        if not self.twm.is_alive():
+            return "socket manager stopped"
+        if not self._subscribed.is_set():
+            if time() - self._opened > self.SUBSCRIBE_TIMEOUT:
+                return "not subscribed after %ds" % self.SUBSCRIBE_TIMEOUT
+        elif self._socket not in self.twm._socket_running:
+            return "listener stopped"
+        return None
+
+    def _set_live(self, live):
+        if live:
+            self._subscribed.set()
+        else:
+            self._subscribed.clear()
+        self.tracker.set_live("binance", live)
+        if self.wallets:
+            self.wallets.set_live("binance", live)
+
+    def _start_ws(self):
+        keys = {"api_key": self.api_details["API_KEY"], "api_secret": self.api_details["API_SECRET"]}
+        if self.api_details.get("WS_API_URL"):
+            self.twm = CUSTOM_URL_USER_SOCKET_MANAGER(
+                self.api_details["API_BASE_URL"], self.api_details.get("WS_URL"),
+                ws_api_url=self.api_details["WS_API_URL"], **keys,
+            )
+        else:
+            self.twm = USER_SOCKET_MANAGER(**keys)
+        self._opened = time()
+        self.twm.start()
+        self._socket = self.twm.start_user_socket(callback=self._on_message)
+        logger.info("Binance user stream started")
+
+    def _stop_ws(self):
+        if self.twm:
+            try:
+                self.twm.stop()
+            except Exception as e:
+                logger.warning("Error stopping Binance user stream: %s", e)
+            self.twm = None
+
+    def _on_message(self, msg):
+        event = msg.get("e")
+        if event == "error":
+            logger.error("Binance user stream error: %s", msg.get("m"))
+            self._restart.set()
+            return
+        if not self._subscribed.is_set():
+            self._set_live(True)
+            logger.info("Binance user stream subscribed")
+        if event == "subscribed":
+            return
+        if event == "outboundAccountPosition":
+            if self.wallets:
+                for balance in msg["B"]:
+                    self.wallets.set_balance("binance", balance["a"], balance["f"], balance["l"], msg["u"] / 1000)
+            return
+        if event != "executionReport":
+            return
+        status = msg["X"]
+        # A cancel carries the cancel request's id in c and the order's own in C
+        order_id = msg["C"] if status == "CANCELED" and msg.get("C") else msg["c"]
+        if self.wallets and msg["x"] == "TRADE":
+            self.wallets.fill(
+                "binance", msg["s"], msg["S"], msg["l"], msg["L"], msg["T"] / 1000, msg.get("n"), msg.get("N"),
+            )
+        self.tracker.update(
+            "binance", order_id, msg["q"], msg["z"], msg["p"], status not in BINANCE_CLOSED,
+        )
+
+
+class KRAKEN_USER_STREAM(threading.Thread):
+    """Kraken v2 executions channel feeding order updates to a FILL_TRACKER, and
+    fills and the balances channel to a WALLET_TRACKER if given."""
+
+    def __init__(self, threadId, name, client, tracker, ws_url="wss://ws-auth.kraken.com/v2", wallets=None):
+        threading.Thread.__init__(self)
+        self.threadId = threadId
+        self.name = name
+        # KRAKEN REST client, for the WebSocket token
+        self.client = client
+        self.tracker = tracker
+        self.ws_url = ws_url
+        self.wallets = wallets
+        self.daemon = True
+        self.ws = None
+        self._backoff = 1
+        self._max_backoff = 60
+
+    def run(self):
+        while True:
+            try:
+                self._connect()
+            except Exception as e:
+                logger.error("Kraken user stream error: %s", e)
+            self.tracker.set_live("kraken", False)
+            if self.wallets:
+                self.wallets.set_live("kraken", False)
+            logger.info("Kraken user stream reconnecting in %ss", self._backoff)
+            sleep(self._backoff)
+            self._backoff = min(self._backoff * 2, self._max_backoff)
+
+    def _connect(self):
+        token = self.client.getWebSocketsToken()
+        if not token:
+            raise RuntimeError("no WebSocket token")
+        self.ws = websocket.WebSocketApp(
+            self.ws_url,
+            on_open=lambda ws: self._on_open(ws, token),
+            on_message=self._on_message,
+            on_error=lambda ws, error: logger.error("Kraken user stream error: %s", error),
+        )
+        self.ws.run_forever(ping_interval=30, ping_timeout=10)
+
+    def _on_open(self, ws, token):
+        ws.send(json.dumps({
+            "method": "subscribe",
+            "params": {"channel": "executions", "token": token, "snap_orders": False, "snap_trades": False},
+        }))
+        if self.wallets:
+            ws.send(json.dumps({
+                "method": "subscribe",
+                "params": {"channel": "balances", "token": token, "snapshot": True},
+            }))
+
+    def _on_message(self, ws, message):
+        msg = json.loads(message, parse_float=Decimal)
+        if msg.get("method") == "subscribe":
+            channel = msg.get("result", {}).get("channel", "executions")
+            if msg.get("success"):
+                self._backoff = 1
+                if channel == "balances":
+                    self.wallets.set_live("kraken", True)
+                else:
+                    self.tracker.set_live("kraken", True)
+                logger.info("Kraken user stream subscribed to %s", channel)
+            else:
+                logger.error("Kraken %s subscribe failed: %s", channel, msg.get("error"))
+                ws.close()
+            return
+        if msg.get("channel") == "balances":
+            self._on_balances(msg)
+            return
+        if msg.get("channel") != "executions":
+            return
+        for execution in msg.get("data", []):
+            if self.wallets and execution.get("exec_type") == "trade":
+                self._on_fill(execution)
+            status = execution.get("order_status")
+            if "order_id" not in execution or status is None or "cum_qty" not in execution:
+                continue
+            self.tracker.update(
+                "kraken", execution["order_id"], execution.get("order_qty"), execution["cum_qty"],
+                execution.get("avg_price") or execution.get("limit_price"), status in KRAKEN_OPEN,
+            )
+
+    def _on_fill(self, execution):
+        if "last_qty" not in execution:
+            return
+        market = ws_pair_to_internal(execution.get("symbol", ""))
+        fees = execution.get("fees") or [{}]
+        self.wallets.fill(
+            "kraken", market, execution["side"], execution["last_qty"], execution["last_price"],
+            _kraken_time(execution["timestamp"]), fees[0].get("qty"), _kraken_asset(fees[0].get("asset")),
+        )
+
+    def _on_balances(self, msg):
+        # A snapshot lists each asset's balance; an update is one ledger entry with the new balance
+        for entry in msg.get("data", []):
+            if entry.get("asset_class", "currency") != "currency" or "balance" not in entry:
+                continue
+            stamp = _kraken_time(entry["timestamp"]) if "timestamp" in entry else 0
+            self.wallets.set_balance("kraken", _kraken_asset(entry["asset"]), entry["balance"], Decimal("0"), stamp)
+